@@ -25,10 +25,12 @@ __status__ = "Development"
 import argparse
 import os, sys, stat
 import itertools
+import atexit
 
 from assemble.sql2mongoDB import *
 from assemble.makeCorems import * 
 from assemble.resample import *
+from assemble.instrument import STATS
 
 QSUB_TEMPLATE_HEADER_CSH = """#!/bin/csh
 
@@ -113,6 +115,11 @@ if __name__ == '__main__':
 	parser.add_argument('--cluster', default=True, help="Run re-samples on cluster? Boolean.")
 	parser.add_argument('--finish_only', default=False, help="Finish corems only. In case session gets dropped")
 	parser.add_argument('--user', default=None, help="Cluster user name")
+	parser.add_argument('--workers', default=1, type=int, help="Number of processes used to read cMonkey runs during ingestion. Default = 1.")
+	parser.add_argument('--resume', default=False, action='store_true', help="Resume an interrupted ingestion. Partially ingested runs are rolled back to their last complete stage and finished.")
+	parser.add_argument('--expression_layout', default="cells", choices=["cells", "columns", "both"], help="Gene expression storage. 'cells': one document per gene and condition (gene_expression). 'columns': one document per condition with packed arrays (gene_expression_cols), much smaller and faster to read. Default = cells.")
+	parser.add_argument('--sqlite_indexes', default="none", choices=["sidecar", "in_place", "none"], help="How to index cMonkey run databases for extraction. 'sidecar': copy unindexed tables once to cmonkey_run.db.index.db with (iteration, cluster) indexes, leaving the run databases untouched. 'in_place': add the indexes to the run databases. 'none': read without indexes. Indexes pay off when runs are read more than once, eg with --resume. Default = none.")
+	parser.add_argument('--profile', default=False, action='store_true', help="Write cProfile stats of each assembly stage to targetdir/profile. Per-stage time, memory and MongoDB statistics are always written to ensemble.stats.json/csv")
 
 	args = parser.parse_args()
 
@@ -150,8 +157,13 @@ if __name__ == '__main__':
 	with open( os.path.abspath( os.path.join( targetdir, "ensemble.info" ) ) , 'w') as outfile:
 		outfile.write( RUN_INFO_TEMPLATE % info_d )
 
+	# per-stage time, memory and MongoDB statistics. written on exit, also if assembly fails
+	if args.profile:
+		STATS.enable_profiling( os.path.abspath( os.path.join( targetdir, "profile" ) ) )
+	atexit.register( STATS.write, targetdir )
+
 	if args.finish_only:
-		sql2mongo = sql2mongoDB( organism = args.organism, host = args.host, port = args.port, ensembledir = args.ensembledir, prefix = args.prefix, ratios_raw = args.ratios, gre2motif = args.gre2motif, col_annot = args.col_annot, ncbi_code = args.ncbi_code, dbname = args.db, db_run_override = None, genome_file = args.genome_annot, row_annot = args.row_annot, row_annot_match_col = args.row_annot_matchCol )
+		sql2mongo = sql2mongoDB( organism = args.organism, host = args.host, port = args.port, ensembledir = args.ensembledir, prefix = args.prefix, ratios_raw = args.ratios, gre2motif = args.gre2motif, col_annot = args.col_annot, ncbi_code = args.ncbi_code, dbname = args.db, db_run_override = None, genome_file = args.genome_annot, row_annot = args.row_annot, row_annot_match_col = args.row_annot_matchCol, workers = args.workers, resume = args.resume, expression_layout = args.expression_layout, sqlite_indexes = args.sqlite_indexes )
 		corems = makeCorems( organism = args.organism, host = args.host, port = args.port, db = db, dbfiles = None, backbone_pval = args.backbone_pval, out_dir = targetdir, n_subs = args.cores, link_comm_score = args.link_comm_score, link_comm_increment = args.link_comm_increment, link_comm_density_score = args.link_comm_density_score, corem_size_threshold = args.corem_size_threshold )
 		
 		corems.finishCorems()
@@ -165,12 +177,14 @@ if __name__ == '__main__':
 		pdf = os.path.join( corems.out_dir, "density_stats.pdf") 
 		if os.path.isfile(pdf):
 			add_files = add_files + pdf 
+		STATS.summary()
+		add_files = add_files + " " + " ".join( STATS.write( targetdir ) )
 		sql2mongo.mongoDump( sql2mongo.dbname, outfile, add_files = add_files.strip() )
 
 		print "Done"
 	else:
 		# Initialize to find problems early!!
-		sql2mongo = sql2mongoDB( organism = args.organism, host = args.host, port = args.port, ensembledir = args.ensembledir, prefix = args.prefix, ratios_raw = args.ratios, gre2motif = args.gre2motif, col_annot = args.col_annot, ncbi_code = args.ncbi_code, dbname = args.db, db_run_override = None, genome_file = args.genome_annot, row_annot = args.row_annot, row_annot_match_col = args.row_annot_matchCol )
+		sql2mongo = sql2mongoDB( organism = args.organism, host = args.host, port = args.port, ensembledir = args.ensembledir, prefix = args.prefix, ratios_raw = args.ratios, gre2motif = args.gre2motif, col_annot = args.col_annot, ncbi_code = args.ncbi_code, dbname = args.db, db_run_override = None, genome_file = args.genome_annot, row_annot = args.row_annot, row_annot_match_col = args.row_annot_matchCol, workers = args.workers, resume = args.resume, expression_layout = args.expression_layout, sqlite_indexes = args.sqlite_indexes )
 		if len( sql2mongo.db_files ) >0:
 		#if True:
 			# Merge sql into mongoDB
@@ -224,6 +238,8 @@ if __name__ == '__main__':
 			pdf = os.path.join( corems.out_dir, "density_stats.pdf") 
 			if os.path.isfile(pdf):
 				add_files = add_files + pdf 
+			STATS.summary()
+			add_files = add_files + " " + " ".join( STATS.write( targetdir ) )
 			sql2mongo.mongoDump( sql2mongo.dbname, outfile, add_files = add_files.strip() )
 
 			print "Done"
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+Synthetic cMonkey ensemble generator and ingestion benchmark.
+
+Generates an ensemble of cmonkey_run.db SQLite files with the tables sql2mongoDB reads, matching
+bz2 FIMO outputs, a ratios matrix, gene annotations and a motif -> GRE map, at any scale. Then
+runs each ingestion stage of sql2mongoDB.compile against a local mongod and reports wall time,
+CPU, memory, MongoDB traffic (see assemble/instrument.py) and throughput per stage. Results are
+written to benchmark.json in the work directory and appended to benchmark_history.csv to track
+performance over time.
+
+Example:
+
+python benchmark.py --workdir /tmp/egrin2_bench --n_runs 50 --n_rows 2000 --n_cols 300 --workers 4
+
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import os
+import bz2
+import gzip
+import json
+import time
+import sqlite3
+import datetime
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+from pymongo import MongoClient
+
+DESCRIPTION = """benchmark.py - generate a synthetic cMonkey ensemble and time its ingestion"""
+
+RUN_SCHEMA = """
+CREATE TABLE run_infos (start_time timestamp, finish_time timestamp, num_iterations int, last_iteration int, organism text, species text, num_rows int, num_columns int, num_clusters int, git_sha text, ncbi_code text);
+CREATE TABLE row_names (order_num int, name text);
+CREATE TABLE column_names (order_num int, name text);
+CREATE TABLE row_members (iteration int, cluster int, order_num int);
+CREATE TABLE column_members (iteration int, cluster int, order_num int);
+CREATE TABLE cluster_stats (iteration int, cluster int, num_rows int, num_cols int, residual decimal);
+CREATE TABLE motif_infos (iteration int, cluster int, seqtype text, motif_num int, evalue decimal);
+CREATE TABLE motif_pssm_rows (motif_info_id int, iteration int, row int, a decimal, c decimal, g decimal, t decimal);
+CREATE TABLE meme_motif_sites (motif_info_id int, seq_name text, reverse boolean, start int, pvalue decimal, flank_left text, seq text, flank_right text);
+"""
+
+FIMO_HEADER = "#pattern name\tsequence name\tstart\tstop\tstrand\tscore\tp-value\tq-value\tmatched sequence\tin_coding_rgn"
+
+# default scale: a small ensemble that ingests in a few minutes
+SCALE = {
+	"n_runs": 20,
+	"n_rows": 1000,
+	"n_cols": 100,
+	"n_clusters": 50,
+	"n_iterations": 2,
+	"rows_per_cluster": 20,
+	"cols_per_cluster": 30,
+	"n_motifs": 2,
+	"motif_width": 12,
+	"sites_per_motif": 10,
+	"fimo_hits": 1000,
+	"n_scaffolds": 2,
+	"n_gres": 20
+}
+
+def gene_names( n_rows ):
+	return [ "b%04d" % i for i in range( n_rows ) ]
+
+def col_names( n_cols ):
+	return [ "cond_%04d" % i for i in range( n_cols ) ]
+
+def make_run_db( db_file, scale, rng, organism = "eco", ncbi_code = "511145" ):
+	"""Write one synthetic cmonkey_run.db. Each run samples its own rows and columns"""
+	if os.path.exists( db_file ):
+		os.remove( db_file )
+	if not os.path.isdir( os.path.dirname( db_file ) ):
+		os.makedirs( os.path.dirname( db_file ) )
+	rows = gene_names( scale[ "n_rows" ] )
+	cols = col_names( scale[ "n_cols" ] )
+	conn = sqlite3.connect( db_file )
+	c = conn.cursor()
+	c.executescript( RUN_SCHEMA )
+	c.execute( "INSERT INTO run_infos VALUES (?,?,?,?,?,?,?,?,?,?,?);", ( str( datetime.datetime.utcnow() ), str( datetime.datetime.utcnow() ), 2000, 2000, organism, "synthetic", len( rows ), len( cols ), scale[ "n_clusters" ], "synthetic", ncbi_code ) )
+	c.executemany( "INSERT INTO row_names VALUES (?,?);", enumerate( rows ) )
+	c.executemany( "INSERT INTO column_names VALUES (?,?);", enumerate( cols ) )
+	for iteration in range( 1, scale[ "n_iterations" ] + 1 ):
+		for cluster in range( 1, scale[ "n_clusters" ] + 1 ):
+			members = rng.choice( len( rows ), min( scale[ "rows_per_cluster" ], len( rows ) ), replace = False )
+			conds = rng.choice( len( cols ), min( scale[ "cols_per_cluster" ], len( cols ) ), replace = False )
+			c.executemany( "INSERT INTO row_members VALUES (?,?,?);", [ ( iteration, cluster, int( i ) ) for i in members ] )
+			c.executemany( "INSERT INTO column_members VALUES (?,?,?);", [ ( iteration, cluster, int( i ) ) for i in conds ] )
+			c.execute( "INSERT INTO cluster_stats VALUES (?,?,?,?,?);", ( iteration, cluster, len( members ), len( conds ), float( rng.rand() ) ) )
+			for motif_num in range( 1, scale[ "n_motifs" ] + 1 ):
+				c.execute( "INSERT INTO motif_infos VALUES (?,?,?,?,?);", ( iteration, cluster, "upstream", motif_num, float( rng.rand() ) ) )
+				motif_info_id = c.lastrowid
+				pssm = rng.dirichlet( np.ones( 4 ), scale[ "motif_width" ] )
+				c.executemany( "INSERT INTO motif_pssm_rows VALUES (?,?,?,?,?,?,?);", [ ( motif_info_id, iteration, i, ) + tuple( pssm[ i ].tolist() ) for i in range( scale[ "motif_width" ] ) ] )
+				sites = rng.choice( members, scale[ "sites_per_motif" ] )
+				c.executemany( "INSERT INTO meme_motif_sites VALUES (?,?,?,?,?,?,?,?);", [ ( motif_info_id, "NP_%06d" % i, bool( rng.rand() < 0.5 ), int( rng.randint( 1, 200 ) ), float( rng.rand() * 1e-4 ), "ACGT", "ACGTACGTACGT", "ACGT" ) for i in sites ] )
+	conn.commit()
+	conn.close()
+
+def make_fimo( fimo_dir, scale, rng ):
+	"""Write fimo-out-<cluster>.bz2 files with 'fimo_hits' hits each, p-values log-uniform in [1e-8, 1e-3]"""
+	if not os.path.isdir( fimo_dir ):
+		os.makedirs( fimo_dir )
+	for cluster in range( 1, scale[ "n_clusters" ] + 1 ):
+		n = scale[ "fimo_hits" ]
+		start = rng.randint( 1, 4000000, n )
+		pval = 10 ** -rng.uniform( 3, 8, n )
+		lines = [ FIMO_HEADER ]
+		for i in range( n ):
+			lines.append( "%i\teco_NC_%06d.1\t%i\t%i\t%s\t%.3f\t%.3g\t%.3g\tACGTACGTACGT\t%s" % ( rng.randint( 1, scale[ "n_motifs" ] + 1 ), rng.randint( scale[ "n_scaffolds" ] ), start[ i ], start[ i ] + scale[ "motif_width" ] - 1, "+-"[ rng.randint( 2 ) ], rng.rand() * 20, pval[ i ], 0.5, [ "", "1" ][ rng.randint( 2 ) ] ) )
+		f = bz2.BZ2File( os.path.join( fimo_dir, "fimo-out-%04d.bz2" % cluster ), 'w' )
+		f.write( "\n".join( lines ) + "\n" )
+		f.close()
+
+def make_ratios( ratios_file, scale, rng ):
+	ratios = pd.DataFrame( rng.randn( scale[ "n_rows" ], scale[ "n_cols" ] ), index = gene_names( scale[ "n_rows" ] ), columns = col_names( scale[ "n_cols" ] ) )
+	f = gzip.open( ratios_file, 'wb' )
+	ratios.to_csv( f, sep = "\t" )
+	f.close()
+
+def make_row_annot( row_annot_file, scale, rng ):
+	"""MicrobesOnline-style gene annotation. Accessions match the MEME site names of make_run_db"""
+	rows = gene_names( scale[ "n_rows" ] )
+	start = rng.randint( 1, 4000000, len( rows ) )
+	annot = pd.DataFrame( {
+		"sysName": rows,
+		"name": [ "gene%i" % i for i in range( len( rows ) ) ],
+		"accession": [ "NP_%06d" % i for i in range( len( rows ) ) ],
+		"GI": range( 100000, 100000 + len( rows ) ),
+		"scaffoldId": rng.randint( scale[ "n_scaffolds" ], size = len( rows ) ),
+		"start": start,
+		"stop": start + 900,
+		"strand": [ "+-"[ i ] for i in rng.randint( 2, size = len( rows ) ) ]
+	}, columns = [ "sysName", "name", "accession", "GI", "scaffoldId", "start", "stop", "strand" ] )
+	annot.to_csv( row_annot_file, sep = "\t", index = False )
+
+def make_gre2motif( gre2motif_file, run_names, scale, rng ):
+	"""Motif -> GRE clustering file. One line per GRE, tab-delimited run_cluster_motif members"""
+	with open( gre2motif_file, 'w' ) as f:
+		n_members = min( 5, len( run_names ) * scale[ "n_clusters" ] * scale[ "n_motifs" ] )
+		for i in range( scale[ "n_gres" ] ):
+			members = set()
+			while len( members ) < n_members:
+				members.add( "%s_%i_%i" % ( run_names[ rng.randint( len( run_names ) ) ], rng.randint( 1, scale[ "n_clusters" ] + 1 ), rng.randint( 1, scale[ "n_motifs" ] + 1 ) ) )
+			f.write( "\t".join( sorted( members ) ) + "\n" )
+
+def make_ensemble( workdir, scale = None, seed = 1, prefix = "eco-out-" ):
+	"""Generate a synthetic ensemble in 'workdir'. Returns a dict of the generated input files"""
+	scale = dict( SCALE, **( scale or {} ) )
+	rng = np.random.RandomState( seed )
+	ensembledir = os.path.join( os.path.abspath( workdir ), "ensemble" ) + "/"
+	run_names = [ prefix + "%03d" % i for i in range( 1, scale[ "n_runs" ] + 1 ) ]
+	for run_name in run_names:
+		make_run_db( os.path.join( ensembledir, run_name, "cmonkey_run.db" ), scale, rng )
+		make_fimo( os.path.join( ensembledir, run_name, "fimo-outs" ), scale, rng )
+	files = {
+		"ensembledir": ensembledir,
+		"prefix": prefix,
+		"ratios": os.path.join( os.path.abspath( workdir ), "ratios.tsv.gz" ),
+		"row_annot": os.path.join( os.path.abspath( workdir ), "row_annot.tsv" ),
+		"gre2motif": os.path.join( os.path.abspath( workdir ), "gre2motif.txt" ),
+		"n_scaffolds": scale[ "n_scaffolds" ]
+	}
+	make_ratios( files[ "ratios" ], scale, rng )
+	make_row_annot( files[ "row_annot" ], scale, rng )
+	make_gre2motif( files[ "gre2motif" ], run_names, scale, rng )
+	return files
+
+def git_sha():
+	try:
+		return subprocess.check_output( [ "git", "rev-parse", "--short", "HEAD" ], cwd = os.path.dirname( os.path.abspath( __file__ ) ) ).strip()
+	except Exception:
+		return "NA"
+
+def run_benchmark( files, host = "localhost", port = 27017, dbname = "egrin2_benchmark", workers = 1, expression_layout = "cells", drop = True ):
+	"""Ingest the synthetic ensemble 'files' (see make_ensemble) stage by stage, as sql2mongoDB.compile does.
+
+	Runs and FIMO scans go through sql2mongoDB.ingest_pipeline, the only ingestion path of compile.
+	Returns one record per stage with its STATS measurements, the documents it wrote and their rate."""
+	from assemble.sql2mongoDB import sql2mongoDB
+	from assemble.indexes import ensure_indexes
+	from assemble.instrument import STATS
+
+	if drop:
+		client = MongoClient( host = host, port = port )
+		client.drop_database( dbname )
+		client.close()
+	# genome sequences are normally downloaded from MicrobesOnline. only scaffold ids are needed here
+	s = sql2mongoDB( organism = "eco", host = host, port = port, ensembledir = files[ "ensembledir" ], prefix = files[ "prefix" ], ratios_raw = files[ "ratios" ], gre2motif = files[ "gre2motif" ], ncbi_code = "511145", dbname = dbname, row_annot = files[ "row_annot" ], row_annot_match_col = "sysName", workers = workers, expression_layout = expression_layout )
+	s.db.genome.insert( [ { "scaffoldId": i, "NCBI_RefSeq": "NC_%06d" % i } for i in range( files[ "n_scaffolds" ] ) ] )
+
+	def count( collections ):
+		return sum( [ s.db[ i ].count() for i in collections ] )
+
+	stages = []
+	def stage( name, collections, f ):
+		n0 = count( collections )
+		with STATS.stage( "benchmark:" + name ):
+			result = f()
+		record = dict( STATS.records[ -1 ] )
+		record[ "stage" ] = name
+		record[ "documents" ] = count( collections ) - n0
+		record[ "docs_per_s" ] = record[ "documents" ] / max( record[ "wall_s" ], 1e-6 )
+		stages.append( record )
+		print "%-32s %8.2f s %10i docs %10.0f docs/s" % ( name, record[ "wall_s" ], record[ "documents" ], record[ "docs_per_s" ] )
+		return result
+
+	s.db_files = stage( "checkRuns", [], lambda: s.checkRuns( s.db_files, s.db_run_override, s.db ) )
+	s.run2id = stage( "get_run2id", [], lambda: s.get_run2id( s.db_files, s.db ) )
+	s.expression = stage( "loadRatios", [], lambda: s.loadRatios( s.ratios_raw ) )
+	s.expression = stage( "loadRatios (sidecar)", [], lambda: s.loadRatios( s.ratios_raw ) )
+	s.expression_standardized = stage( "standardizeRatios", [], lambda: s.standardizeRatios( s.expression ) )
+	s.row2id = stage( "get_row2id", [], lambda: s.get_row2id( s.expression_standardized, s.db ) )
+	s.row_info_collection = stage( "insert_row_info", [ "row_info" ], lambda: s.insert_row_info( s.ncbi_code, s.row2id, s.row_annot, s.row_annot_match_col ) )
+	s.col2id = stage( "get_col2id", [], lambda: s.get_col2id( s.expression_standardized, s.db ) )
+	s.col_info_collection = stage( "insert_col_info", [ "col_info" ], lambda: s.insert_col_info( s.col2id, s.col_annot ) )
+	if expression_layout in [ "cells", "both" ]:
+		stage( "insert_gene_expression", [ "gene_expression" ], lambda: s.insert_gene_expression( s.db, s.row2id, s.col2id, s.expression, s.expression_standardized ) )
+	if expression_layout in [ "columns", "both" ]:
+		stage( "insert_gene_expression_columns", [ "gene_expression_cols" ], lambda: s.insert_gene_expression_columns( s.db, s.row2id, s.col2id, s.expression, s.expression_standardized ) )
+	stage( "insert_ensemble_info", [ "ensemble_info" ], lambda: s.insert_ensemble_info( s.db_files, s.db, s.run2id, s.row2id, s.col2id ) )
+	s.motif2gre = stage( "loadGREMap", [], lambda: s.loadGREMap( s.gre2motif ) )
+	s.bicluster_info_collection = s.db.bicluster_info
+	s.accession_lookup = s.get_accession_lookup( s.row_info_collection )
+	stage( "ingest_pipeline", [ "bicluster_info", "motif_info", "fimo", "fimo_small" ], lambda: s.ingest_pipeline( s.db_files, s.workers ) )
+	stages[ -1 ][ "queues" ] = s.queue_metrics
+	stage( "ensure_indexes", [], lambda: ensure_indexes( s.db, verbose = False ) )
+	return stages
+
+def write_results( workdir, scale, stages, config ):
+	"""Write benchmark.json and append to benchmark_history.csv in 'workdir'"""
+	date = str( datetime.datetime.utcnow() )
+	results = { "date": date, "git_sha": git_sha(), "scale": scale, "config": config, "stages": stages }
+	with open( os.path.join( workdir, "benchmark.json" ), 'w' ) as outfile:
+		json.dump( results, outfile, indent = 1, sort_keys = True )
+	history = os.path.join( workdir, "benchmark_history.csv" )
+	fields = [ "wall_s", "cpu_s", "cpu_children_s", "max_rss_mb", "mongo_commands", "mongo_bytes_sent", "documents", "docs_per_s" ]
+	new = not os.path.isfile( history )
+	with open( history, 'a' ) as outfile:
+		if new:
+			outfile.write( ",".join( [ "date", "git_sha", "n_runs", "n_rows", "n_cols", "workers", "stage" ] + fields ) + "\n" )
+		for i in stages:
+			outfile.write( ",".join( [ str( j ) for j in [ date, results[ "git_sha" ], scale[ "n_runs" ], scale[ "n_rows" ], scale[ "n_cols" ], config[ "workers" ], i[ "stage" ] ] + [ i[ j ] for j in fields ] ] ) + "\n" )
+	return results
+
+
+if __name__ == '__main__':
+
+	import argparse
+
+	parser = argparse.ArgumentParser( description=DESCRIPTION )
+	parser.add_argument('--workdir', required=True, type=str, help="Directory for the synthetic ensemble and the results")
+	parser.add_argument('--host', default="localhost", type=str, help="Host for MongoDB")
+	parser.add_argument('--port', default=27017, help="MongoDB port", type=int )
+	parser.add_argument('--db', default="egrin2_benchmark", type=str, help="Database to (re)create. It is dropped first!")
+	parser.add_argument('--workers', default=1, type=int, help="Number of ingestion processes")
+	parser.add_argument('--expression_layout', default="cells", choices=["cells", "columns", "both"], help="Gene expression storage")
+	parser.add_argument('--seed', default=1, type=int, help="Random seed")
+	parser.add_argument('--reuse', default=False, action='store_true', help="Reuse an ensemble generated earlier in --workdir")
+	for i in sorted( SCALE.keys() ):
+		parser.add_argument( '--' + i, default=SCALE[ i ], type=int, help="Default = %i" % SCALE[ i ] )
+
+	args = parser.parse_args()
+
+	scale = dict( [ ( i, getattr( args, i ) ) for i in SCALE.keys() ] )
+	workdir = os.path.abspath( args.workdir )
+	if not os.path.isdir( workdir ):
+		os.makedirs( workdir )
+
+	inputs = os.path.join( workdir, "inputs.json" )
+	if args.reuse and os.path.isfile( inputs ):
+		with open( inputs ) as f:
+			files = json.load( f )
+		scale = files.pop( "scale" )
+	else:
+		print "Generating synthetic ensemble in %s" % workdir
+		t0 = time.time()
+		files = make_ensemble( workdir, scale, seed = args.seed )
+		print "Generated %i runs in %.1f s" % ( scale[ "n_runs" ], time.time() - t0 )
+		with open( inputs, 'w' ) as f:
+			json.dump( dict( files, scale = scale ), f )
+
+	stages = run_benchmark( files, host = args.host, port = args.port, dbname = args.db, workers = args.workers, expression_layout = args.expression_layout )
+	write_results( workdir, scale, stages, { "workers": args.workers, "expression_layout": args.expression_layout, "db": args.db } )
+	print "Results written to %s" % os.path.join( workdir, "benchmark.json" )
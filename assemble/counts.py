@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+"""
+Materialized bicluster counts of an egrin2 MongoDB: for every row, col and GRE, the number of
+biclusters (motifs, for GREs) it occurs in. These are the background counts of agglom.
+
+Counts are computed with the aggregation pipeline ($unwind/$group) after assembly and stored one
+document per key, { "_id": row_id, "value": count }, in row_counts, col_counts and gre_counts.
+counts_info records for each kind the runs that were counted and the ensemble version they were
+counted at: the version of "run" in the ID registry (which changes whenever runs are added) and the
+number of biclusters (motifs, for GREs), both read without scanning. When runs are added only the
+new runs are aggregated and their counts added ($inc). Runs whose manifest shows an incomplete
+bicluster_info (or, for GREs, motif_info) stage are left out until they complete.
+
+Runs are claimed atomically (moved to 'pending' in counts_info) before their counts are added or
+subtracted, so concurrent updates never count a run twice. Runs left pending by an update that
+failed make the counts out of date until rebuild_counts recomputes them from scratch. Queries only
+read counts: get_counts aggregates on the fly while the counts are out of date.
+
+Example:
+
+update_counts( client[ "eco_db" ] )
+get_counts( client[ "eco_db" ], "rows", [ 275, 276 ] )
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import datetime
+
+import pandas as pd
+try:
+	from pymongo import UpdateOne
+except ImportError:
+	# pymongo 2.x
+	UpdateOne = None
+
+from assemble.registry import idRegistry
+
+# kind -> ( counts collection, ingest stage the counted documents come from )
+COUNTS = {
+	"rows": ( "row_counts", "bicluster_info" ),
+	"columns": ( "col_counts", "bicluster_info" ),
+	"gre_id": ( "gre_counts", "motif_info" )
+}
+
+def ensemble_version( db, kind ):
+	"""[ registry version of runs, number of documents counted from ]"""
+	return [ idRegistry( db ).version( "run" ), db[ COUNTS[ kind ][ 1 ] ].count() ]
+
+def counts_info( db, kind ):
+	info = db.counts_info.find_one( { "_id": kind } )
+	if info is None:
+		return {}
+	return info
+
+def counted_runs( db, kind ):
+	return counts_info( db, kind ).get( "runs", [] )
+
+def pending_runs( db, kind ):
+	"""Runs claimed by an update that has not finished (or failed)"""
+	return counts_info( db, kind ).get( "pending", [] )
+
+def counts_current( db, kind ):
+	"""Counts of 'kind' exist, were taken at the current ensemble version and no update is pending"""
+	info = counts_info( db, kind )
+	return info.get( "version" ) == ensemble_version( db, kind ) and len( info.get( "pending", [] ) ) == 0
+
+def countable_runs( db, kind ):
+	"""run_ids with biclusters whose ingest stage for 'kind' is complete. Runs without a manifest count as complete"""
+	stage = COUNTS[ kind ][ 1 ]
+	incomplete = set( [ i[ "run_id" ] for i in db.ingest_manifest.find( { "stages." + stage + ".complete": { "$ne": True } }, { "_id": 0, "run_id": 1 } ) if "run_id" in i ] )
+	return sorted( [ i for i in db.bicluster_info.distinct( "run_id" ) if i not in incomplete ] )
+
+def aggregate( db, kind, runs ):
+	"""Counts of 'kind' over the biclusters of 'runs' as a dictionary key -> count"""
+	if kind == "gre_id":
+		cluster_ids = [ i[ "_id" ] for i in db.bicluster_info.find( { "run_id": { "$in": runs } }, { "_id": 1 } ) ]
+		collection = db.motif_info
+		pipeline = [ { "$match": { "cluster_id": { "$in": cluster_ids }, "gre_id": { "$ne": "NaN" } } }, { "$group": { "_id": "$gre_id", "value": { "$sum": 1 } } } ]
+	else:
+		collection = db.bicluster_info
+		pipeline = [ { "$match": { "run_id": { "$in": runs } } }, { "$project": { "_id": 0, kind: 1 } }, { "$unwind": "$" + kind }, { "$group": { "_id": "$" + kind, "value": { "$sum": 1 } } } ]
+	result = collection.aggregate( pipeline, allowDiskUse = True )
+	if isinstance( result, dict ):
+		# pymongo 2.x returns the whole result document
+		result = result[ "result" ]
+	counts = {}
+	for i in result:
+		counts[ i[ "_id" ] ] = i[ "value" ]
+	return counts
+
+def add_counts( db, kind, counts, sign = 1, batch_size = 10000 ):
+	"""Add (sign = -1: subtract) 'counts' to the counts collection of 'kind', 'batch_size' upserts per bulk write"""
+	collection = db[ COUNTS[ kind ][ 0 ] ]
+	items = counts.items()
+	for start in xrange( 0, len( items ), batch_size ):
+		batch = items[ start:start + batch_size ]
+		if UpdateOne is not None and hasattr( collection, "bulk_write" ):
+			collection.bulk_write( [ UpdateOne( { "_id": k }, { "$inc": { "value": sign * v } }, upsert = True ) for k, v in batch ], ordered = False )
+		else:
+			bulk = collection.initialize_unordered_bulk_op()
+			for k, v in batch:
+				bulk.find( { "_id": k } ).upsert().update( { "$inc": { "value": sign * v } } )
+			bulk.execute()
+
+def _find_and_update( collection, q, u ):
+	try:
+		return collection.find_one_and_update( q, u )
+	except AttributeError:
+		return collection.find_and_modify( q, u )
+
+def claim_runs( db, kind, runs ):
+	"""Atomically mark 'runs' pending for 'kind' if none of them is counted or pending yet. Returns whether they were claimed"""
+	db.counts_info.update( { "_id": kind }, { "$setOnInsert": { "runs": [], "pending": [] } }, upsert = True )
+	q = { "_id": kind, "runs": { "$nin": runs }, "pending": { "$nin": runs } }
+	return _find_and_update( db.counts_info, q, { "$addToSet": { "pending": { "$each": runs } } } ) is not None
+
+def update_counts( db, kinds = None, batch_size = 100, verbose = True ):
+	"""Count the runs that are not counted yet, 'batch_size' runs per aggregation, and stamp the counts with the
+	ensemble version. Each batch of runs is claimed before its counts are added, so runs claimed by another
+	update are left to it"""
+	if kinds is None:
+		kinds = sorted( COUNTS.keys() )
+	for kind in kinds:
+		version = ensemble_version( db, kind )
+		runs = countable_runs( db, kind )
+		n = 0
+		while True:
+			info = counts_info( db, kind )
+			busy = set( info.get( "runs", [] ) ) | set( info.get( "pending", [] ) )
+			new = [ i for i in runs if i not in busy ][ :batch_size ]
+			if len( new ) == 0:
+				break
+			if not claim_runs( db, kind, new ):
+				# some were claimed meanwhile. read again
+				continue
+			add_counts( db, kind, aggregate( db, kind, new ) )
+			db.counts_info.update( { "_id": kind }, { "$addToSet": { "runs": { "$each": new } }, "$pullAll": { "pending": new } } )
+			n = n + len( new )
+		db.counts_info.update( { "_id": kind }, { "$set": { "version": version, "updated": datetime.datetime.utcnow() } }, upsert = True )
+		if verbose:
+			print "%s counts: %i new runs counted" % ( kind, n )
+			pending = pending_runs( db, kind )
+			if len( pending ) > 0:
+				print "WARNING: %i %s runs are pending: being counted by another update, or left by one that failed. If no update is running, rebuild_counts" % ( len( pending ), kind )
+
+def rebuild_counts( db, kinds = None, verbose = True ):
+	"""Recompute the counts of 'kinds' from scratch into a temporary collection and rename it into place.
+	Clears runs left pending by failed updates. Must not run while other updates do"""
+	if kinds is None:
+		kinds = sorted( COUNTS.keys() )
+	for kind in kinds:
+		version = ensemble_version( db, kind )
+		runs = countable_runs( db, kind )
+		name = COUNTS[ kind ][ 0 ]
+		db[ name + "_rebuild" ].drop()
+		counts = aggregate( db, kind, runs )
+		if len( counts ) > 0:
+			db[ name + "_rebuild" ].insert( [ { "_id": k, "value": v } for k, v in counts.iteritems() ] )
+			db[ name + "_rebuild" ].rename( name, dropTarget = True )
+		else:
+			db[ name ].drop()
+		db.counts_info.update( { "_id": kind }, { "$set": { "runs": runs, "pending": [], "version": version, "updated": datetime.datetime.utcnow() } }, upsert = True )
+		if verbose:
+			print "%s counts: rebuilt from %i runs" % ( kind, len( runs ) )
+
+def remove_run( db, run_id ):
+	"""Subtract the counts of a run, eg before its biclusters are rolled back. The run is claimed first"""
+	for kind in COUNTS:
+		q = { "_id": kind, "runs": run_id, "pending": { "$ne": run_id } }
+		if _find_and_update( db.counts_info, q, { "$addToSet": { "pending": run_id } } ) is None:
+			# not counted, or claimed by another update
+			continue
+		add_counts( db, kind, aggregate( db, kind, [ run_id ] ), sign = -1 )
+		db.counts_info.update( { "_id": kind }, { "$pull": { "runs": run_id, "pending": run_id } } )
+
+def get_counts( db, kind, keys = None ):
+	"""Bicluster counts of 'keys' ( all if None ) of 'kind' as a DataFrame indexed by key, with column 'value'.
+	Read only: while the counts are out of date (runs were added, or an update is pending) they are
+	aggregated from the countable runs instead"""
+	if counts_current( db, kind ):
+		q = {} if keys is None else { "_id": { "$in": pd.Index( keys ).tolist() } }
+		counts = pd.DataFrame( list( db[ COUNTS[ kind ][ 0 ] ].find( q ) ), columns = [ "_id", "value" ] )
+		return counts.set_index( "_id" )
+	print "WARNING: %s counts are out of date (run update_counts). Aggregating them" % kind
+	counts = pd.Series( aggregate( db, kind, countable_runs( db, kind ) ) )
+	if keys is not None:
+		counts = counts[ counts.index.isin( pd.Index( keys ) ) ]
+	counts = counts.to_frame( "value" )
+	counts.index.name = "_id"
+	return counts
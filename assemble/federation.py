@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Ensemble-wide SQL over cMonkey run databases (cmonkey_run.db), one per run.
+
+Runs are ATTACHed in batches to a single SQLite connection, as many at a time as SQLite allows.
+Each batch gets TEMP views that stack a table of all its runs, tagged with run_name and the
+source rowid, eg all_row_names (run_name, src_rowid, order_num, name). The views select the
+columns listed in RUN_TABLES by name, so runs written by cMonkey versions with other column orders
+or extra columns line up; a listed column that a run lacks is NULL. Attached run databases are
+only read, never modified.
+
+Only the tables of ensemble_info are federated: sql2mongoDB builds ensemble_info this way.
+Biclusters and motifs are read run by run (see runindex.open_run), in parallel, with per-run
+ingest stages that a batched cross-run extraction could not resume.
+
+Example:
+
+fed = runFederation( glob.glob( "eco-out-???/cmonkey_run.db" ) )
+names = fed.frame( "SELECT run_name, name FROM all_row_names ORDER BY run_name, src_rowid" )
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import sqlite3
+
+import pandas as pd
+
+# table -> columns of its all_<table> view
+RUN_TABLES = {
+	"run_infos": [ "start_time", "finish_time", "num_iterations", "organism", "species", "num_rows", "num_columns", "num_clusters", "git_sha" ],
+	"row_names": [ "order_num", "name" ],
+	"column_names": [ "order_num", "name" ]
+}
+
+_attach_limit = None
+
+def attach_limit():
+	"""Number of databases that can be attached to one SQLite connection (SQLITE_MAX_ATTACHED, 10 by default)"""
+	global _attach_limit
+	if _attach_limit is None:
+		conn = sqlite3.connect( ":memory:" )
+		n = 0
+		try:
+			while n < 125:
+				conn.execute( "ATTACH DATABASE ':memory:' AS probe%i;" % n )
+				n = n + 1
+		except sqlite3.OperationalError:
+			pass
+		conn.close()
+		_attach_limit = n
+	return _attach_limit
+
+class runFederation:
+
+	def __init__( self, db_files, batch_size = None ):
+		"""'db_files' are cmonkey_run.db files, run name = name of their directory. 'batch_size'
+		runs are attached at once (default and maximum: attach_limit())"""
+		self.db_files = list( db_files )
+		limit = attach_limit()
+		if batch_size is None or batch_size > limit:
+			batch_size = limit
+		self.batch_size = max( batch_size, 1 )
+
+	def run_name( self, db_file ):
+		return db_file.split("/")[-2]
+
+	def batches( self ):
+		"""Yield ( connection, [ ( alias, run_name, db_file ) ] ) for each batch of runs. The connection
+		is closed when the next batch is requested"""
+		for start in xrange( 0, len( self.db_files ), self.batch_size ):
+			runs = [ ( "r%i" % i, self.run_name( f ), f ) for i, f in enumerate( self.db_files[ start:start + self.batch_size ] ) ]
+			conn = self.connect( runs )
+			try:
+				yield conn, runs
+			finally:
+				conn.close()
+
+	def connect( self, runs ):
+		"""Attach 'runs' to a new in-memory connection and create the views of the batch"""
+		conn = sqlite3.connect( ":memory:" )
+		conn.execute( "PRAGMA temp_store = MEMORY;" )
+		for alias, run_name, db_file in runs:
+			conn.execute( "ATTACH DATABASE ? AS %s;" % alias, ( db_file, ) )
+		for table, columns in RUN_TABLES.items():
+			selects = []
+			for alias, run_name, db_file in runs:
+				present = self.table_columns( conn, alias, table )
+				if len( present ) == 0:
+					continue
+				fields = ", ".join( [ i if i in present else "NULL AS %s" % i for i in columns ] )
+				selects.append( "SELECT '%s' AS run_name, rowid AS src_rowid, %s FROM %s.%s" % ( run_name.replace( "'", "''" ), fields, alias, table ) )
+			if len( selects ) == 0:
+				# no run of the batch has the table. an empty view keeps queries valid
+				selects.append( "SELECT NULL AS run_name, NULL AS src_rowid, %s WHERE 0" % ", ".join( [ "NULL AS %s" % i for i in columns ] ) )
+			conn.execute( "CREATE TEMP VIEW all_%s AS %s;" % ( table, " UNION ALL ".join( selects ) ) )
+		return conn
+
+	def table_columns( self, conn, alias, table ):
+		"""Columns of 'table' in the attached run 'alias'. Empty if the run has no such table"""
+		return set( [ i[ 1 ] for i in conn.execute( "PRAGMA %s.table_info(%s);" % ( alias, table ) ) ] )
+
+	def query( self, sql, params = () ):
+		"""Run 'sql' against each batch and yield the resulting rows"""
+		for conn, runs in self.batches():
+			for i in conn.execute( sql, params ):
+				yield i
+
+	def frame( self, sql, params = () ):
+		"""Results of 'sql' over all batches as one DataFrame"""
+		frames = []
+		columns = None
+		for conn, runs in self.batches():
+			cursor = conn.execute( sql, params )
+			columns = [ i[ 0 ] for i in cursor.description ]
+			frames.append( pd.DataFrame.from_records( cursor.fetchall(), columns = columns ) )
+		if len( frames ) == 0:
+			return pd.DataFrame()
+		return pd.concat( frames, ignore_index = True )
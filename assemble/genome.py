@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""
+Packed genome sequences in an egrin2 MongoDB.
+
+Each chromosome (scaffold) keeps its metadata document in the genome collection, with its length,
+the md5 of its sequence, and the chunking. The sequence itself is packed 4 bits per base (A, C, G,
+T, N and the other IUPAC codes; case is dropped) in genome_chunks documents of 'chunk_size' bases,
+so a range is read from the chunks that overlap it only. Databases assembled before the store
+existed keep the plain 'sequence' string in the genome document and are read from it.
+
+Coordinates are 1-based and inclusive, as in the fimo collection.
+
+Example:
+
+g = genomeStore( client[ "eco_db" ] )
+g.length( "7" )
+g.fetch( "7", 1001, 1020, "-" )
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import hashlib
+import string
+
+import numpy as np
+from bson.binary import Binary
+
+# code -> base. anything else is stored as N
+ALPHABET = "ACGTNRYSWKMBDHV-"
+CHUNK_SIZE = 1 << 20
+
+_encode = np.repeat( np.uint8( ALPHABET.index( "N" ) ), 256 )
+for i, base in enumerate( ALPHABET ):
+	_encode[ ord( base ) ] = i
+	_encode[ ord( base.lower() ) ] = i
+_decode = np.frombuffer( ALPHABET, dtype = np.uint8 )
+
+COMPLEMENT = string.maketrans( "ACGTNRYSWKMBDHV-", "TGCANYRSWMKVHDB-" )
+
+def pack( sequence ):
+	"""Pack a sequence string 4 bits per base, two bases per byte (first base in the high nibble)"""
+	# sequences read back from MongoDB are unicode
+	codes = _encode[ np.frombuffer( str( sequence ), dtype = np.uint8 ) ]
+	if len( codes ) % 2 == 1:
+		codes = np.append( codes, np.uint8( 0 ) )
+	return ( ( codes[ 0::2 ] << 4 ) | codes[ 1::2 ] ).astype( np.uint8 ).tostring()
+
+def unpack( data, length ):
+	"""First 'length' bases of packed 'data'"""
+	packed = np.frombuffer( data, dtype = np.uint8 )
+	codes = np.empty( len( packed ) * 2, dtype = np.uint8 )
+	codes[ 0::2 ] = packed >> 4
+	codes[ 1::2 ] = packed & 15
+	return _decode[ codes[ :length ] ].tostring()
+
+def reverse_complement( sequence ):
+	return sequence.translate( COMPLEMENT )[ ::-1 ]
+
+def normalize( sequence ):
+	"""The sequence as it is stored: upper case, unknown letters as N"""
+	return unpack( pack( sequence ), len( sequence ) )
+
+class genomeStore:
+
+	def __init__( self, db, cache_chunks = 64 ):
+		self.db = db
+		self.info_cache = {}
+		self.chunk_cache = {}
+		self.cache_order = []
+		self.cache_chunks = cache_chunks
+
+	def put( self, scaffoldId, sequence, chunk_size = CHUNK_SIZE, **metadata ):
+		"""Store a chromosome. 'metadata' (eg NCBI_RefSeq) goes into its genome document. Replaces chunks stored earlier"""
+		sequence = normalize( sequence )
+		doc = dict( metadata )
+		doc.update( {
+		"scaffoldId": scaffoldId,
+		"length": len( sequence ),
+		"md5": hashlib.md5( sequence ).hexdigest(),
+		"encoding": "4bit",
+		"alphabet": ALPHABET,
+		"chunk_size": chunk_size,
+		"n_chunks": ( len( sequence ) + chunk_size - 1 ) // chunk_size
+		} )
+		self.db.genome_chunks.remove( { "scaffoldId": scaffoldId } )
+		for i in range( doc[ "n_chunks" ] ):
+			self.db.genome_chunks.insert( { "scaffoldId": scaffoldId, "chunk": i, "data": Binary( pack( sequence[ i * chunk_size:( i + 1 ) * chunk_size ] ) ) } )
+		self.db.genome.update( { "scaffoldId": scaffoldId }, doc, upsert = True )
+		self.info_cache.pop( scaffoldId, None )
+		return doc
+
+	def info( self, locusId ):
+		"""Genome document of a chromosome, by scaffoldId or NCBI_RefSeq. Only legacy documents include the sequence"""
+		if locusId not in self.info_cache:
+			doc = self.db.genome.find_one( { "$or": [ { "scaffoldId": locusId }, { "NCBI_RefSeq": locusId } ] }, { "sequence": 0 } )
+			if doc is None:
+				raise KeyError( "No chromosome %s in genome collection" % locusId )
+			if "length" not in doc:
+				# legacy document. keep its sequence
+				doc = self.db.genome.find_one( { "_id": doc[ "_id" ] } )
+				doc[ "length" ] = len( doc[ "sequence" ] )
+			self.info_cache[ locusId ] = doc
+		return self.info_cache[ locusId ]
+
+	def length( self, locusId ):
+		return self.info( locusId )[ "length" ]
+
+	def chunks( self, scaffoldId, first, last ):
+		"""Unpacked chunks 'first'..'last' of a chromosome, reading only those not in the cache"""
+		info = self.info( scaffoldId )
+		wanted = range( first, last + 1 )
+		found = dict( [ ( i, self.chunk_cache[ ( scaffoldId, i ) ] ) for i in wanted if ( scaffoldId, i ) in self.chunk_cache ] )
+		missing = [ i for i in wanted if i not in found ]
+		if len( missing ) > 0:
+			for doc in self.db.genome_chunks.find( { "scaffoldId": info[ "scaffoldId" ], "chunk": { "$in": missing } } ):
+				n = min( info[ "chunk_size" ], info[ "length" ] - doc[ "chunk" ] * info[ "chunk_size" ] )
+				found[ doc[ "chunk" ] ] = unpack( doc[ "data" ], n )
+				self.cache( ( scaffoldId, doc[ "chunk" ] ), found[ doc[ "chunk" ] ] )
+		return [ found[ i ] for i in wanted ]
+
+	def cache( self, key, value ):
+		self.chunk_cache[ key ] = value
+		self.cache_order.append( key )
+		while len( self.cache_order ) > self.cache_chunks:
+			self.chunk_cache.pop( self.cache_order.pop( 0 ), None )
+
+	def fetch( self, scaffoldId, start = None, stop = None, strand = "+" ):
+		"""Sequence of 'scaffoldId' (or NCBI_RefSeq) from 'start' to 'stop', 1-based and inclusive, clipped
+		to the chromosome. Defaults to the whole chromosome. The reverse complement for strand '-'"""
+		info = self.info( scaffoldId )
+		start = 1 if start is None else max( int( start ), 1 )
+		stop = info[ "length" ] if stop is None else min( int( stop ), info[ "length" ] )
+		if stop < start:
+			return ""
+		if "sequence" in info:
+			sequence = normalize( info[ "sequence" ][ start - 1:stop ] )
+		else:
+			size = info[ "chunk_size" ]
+			first = ( start - 1 ) // size
+			last = ( stop - 1 ) // size
+			sequence = "".join( self.chunks( scaffoldId, first, last ) )[ start - 1 - first * size:stop - first * size ]
+		if strand == "-":
+			sequence = reverse_complement( sequence )
+		return sequence
+
+	def verify( self, scaffoldId ):
+		"""Does the stored sequence match its md5"""
+		info = self.info( scaffoldId )
+		return "md5" not in info or hashlib.md5( self.fetch( scaffoldId ) ).hexdigest() == info[ "md5" ]
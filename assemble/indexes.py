@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+Build the secondary indexes used by the EGRIN2 query layer (query/egrin2_query.py)
+in an egrin2 MongoDB. Called at the end of sql2mongoDB.compile and makeCorems.addCorems,
+or run on its own against an existing database.
+
+Example:
+
+python indexes.py --host localhost --db eco_db
+
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import time
+
+import pymongo
+from pymongo import MongoClient
+
+from assemble.instrument import instrumented
+
+DESCRIPTION = """indexes.py - build EGRIN2 MongoDB indexes"""
+
+# collection -> list of index key specs. Array fields (rows, columns, edges, cols.col_id) get multikey indexes
+INDEXES = {
+	"row_info": [ [ ( "row_id", pymongo.ASCENDING ) ], [ ( "egrin2_row_name", pymongo.ASCENDING ) ], [ ( "accession", pymongo.ASCENDING ) ], [ ( "name", pymongo.ASCENDING ) ], [ ( "sysName", pymongo.ASCENDING ) ], [ ( "GI", pymongo.ASCENDING ) ] ],
+	"col_info": [ [ ( "col_id", pymongo.ASCENDING ) ], [ ( "egrin2_col_name", pymongo.ASCENDING ) ] ],
+	"gene_expression": [ [ ( "col_id", pymongo.ASCENDING ), ( "row_id", pymongo.ASCENDING ) ], [ ( "row_id", pymongo.ASCENDING ) ] ],
+	"gene_expression_cols": [ [ ( "col_id", pymongo.ASCENDING ) ] ],
+	"genome_chunks": [ [ ( "scaffoldId", pymongo.ASCENDING ), ( "chunk", pymongo.ASCENDING ) ] ],
+	"id_registry": [ [ ( "kind", pymongo.ASCENDING ), ( "id", pymongo.ASCENDING ) ] ],
+	"ensemble_info": [ [ ( "run_name", pymongo.ASCENDING ) ] ],
+	"ingest_manifest": [ [ ( "run_name", pymongo.ASCENDING ) ] ],
+	"bicluster_info": [ [ ( "rows", pymongo.ASCENDING ) ], [ ( "columns", pymongo.ASCENDING ) ], [ ( "run_id", pymongo.ASCENDING ), ( "cluster", pymongo.ASCENDING ) ] ],
+	"motif_info": [ [ ( "gre_id", pymongo.ASCENDING ) ], [ ( "cluster_id", pymongo.ASCENDING ) ] ],
+	"fimo": [ [ ( "scaffoldId", pymongo.ASCENDING ), ( "start", pymongo.ASCENDING ), ( "stop", pymongo.ASCENDING ), ( "cluster_id", pymongo.ASCENDING ) ], [ ( "cluster_id", pymongo.ASCENDING ) ] ],
+	"fimo_small": [ [ ( "scaffoldId", pymongo.ASCENDING ), ( "start", pymongo.ASCENDING ), ( "stop", pymongo.ASCENDING ), ( "cluster_id", pymongo.ASCENDING ) ], [ ( "cluster_id", pymongo.ASCENDING ) ] ],
+	"col_resample": [ [ ( "n_rows", pymongo.ASCENDING ), ( "col_id", pymongo.ASCENDING ) ] ],
+	"corem": [ [ ( "corem_id", pymongo.ASCENDING ) ], [ ( "rows", pymongo.ASCENDING ) ], [ ( "edges", pymongo.ASCENDING ) ], [ ( "cols.col_id", pymongo.ASCENDING ) ] ]
+}
+
+def index_name( keys ):
+	"""Default MongoDB name of an index, eg scaffoldId_1_start_1"""
+	return "_".join( [ "%s_%s" % ( i[ 0 ], i[ 1 ] ) for i in keys ] )
+
+def collection_names( db ):
+	try:
+		return db.list_collection_names()
+	except AttributeError:
+		return db.collection_names()
+
+@instrumented( "indexes" )
+def ensure_indexes( db, collections = None, background = True, verbose = True ):
+	"""Build the indexes in INDEXES for 'collections' (default: all) of an egrin2 MongoDB database.
+
+	Collections that do not exist yet (eg corem before makeCorems) are skipped. Indexes are built
+	in the background so the database stays available; existing indexes are left alone. Returns
+	one record per index with its build time in seconds and size in bytes (from collstats)."""
+	if collections is None:
+		collections = sorted( INDEXES.keys() )
+	present = set( collection_names( db ) )
+	report = []
+	for i in collections:
+		if i not in present:
+			continue
+		existing = db[ i ].index_information()
+		for keys in INDEXES[ i ]:
+			name = index_name( keys )
+			t0 = time.time()
+			if name not in existing:
+				db[ i ].create_index( keys, background = background )
+			report.append( { "collection": i, "index": name, "seconds": time.time() - t0, "new": name not in existing } )
+		try:
+			sizes = db.command( "collstats", i ).get( "indexSizes", {} )
+		except Exception:
+			sizes = {}
+		for j in report:
+			if j[ "collection" ] == i:
+				j[ "size" ] = sizes.get( j[ "index" ] )
+	if verbose:
+		print_report( report )
+	return report
+
+def print_report( report ):
+	print "%-16s %-48s %10s %12s" % ( "collection", "index", "seconds", "size (MB)" )
+	for i in report:
+		size = "NA" if i[ "size" ] is None else "%.2f" % ( i[ "size" ] / 1048576.0 )
+		seconds = "%.2f" % i[ "seconds" ] if i[ "new" ] else "exists"
+		print "%-16s %-48s %10s %12s" % ( i[ "collection" ], i[ "index" ], seconds, size )
+
+
+if __name__ == '__main__':
+
+	import argparse
+
+	parser = argparse.ArgumentParser( description=DESCRIPTION )
+	parser.add_argument('--host', default="localhost", type=str, help="Host for MongoDB")
+	parser.add_argument('--port', default=27017, help="MongoDB port", type=int )
+	parser.add_argument('--db', required=True, type=str, help="Database name")
+	parser.add_argument('--collections', default=None, nargs='+', help="Collections to index. Default: all collections in the database that the query layer uses")
+	parser.add_argument('--foreground', default=False, action='store_true', help="Build indexes in the foreground. Faster, but blocks the database while building")
+
+	args = parser.parse_args()
+
+	client = MongoClient( host = args.host, port = args.port )
+	ensure_indexes( client[ args.db ], collections = args.collections, background = not args.foreground )
+	client.close()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+"""
+Per-stage instrumentation of an ensemble assembly: wall time, CPU time (own and reaped worker
+processes), peak RSS and the MongoDB commands sent by this process (counts and BSON bytes, from
+pymongo command monitoring). Stages are marked with the instrumented decorator or STATS.stage.
+
+assembler.py writes the report to ensemble.stats.json and ensemble.stats.csv next to ensemble.info.
+With profiling enabled (assembler.py --profile) each outermost stage also dumps cProfile stats,
+readable with pstats, to <stage>.prof.
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import os
+import time
+import json
+import resource
+import cProfile
+import functools
+import contextlib
+
+from bson import BSON
+
+try:
+	from pymongo import monitoring
+except ImportError:
+	# pymongo < 3.1
+	monitoring = None
+
+FIELDS = [ "stage", "parent", "start", "wall_s", "cpu_s", "cpu_children_s", "max_rss_mb", "max_rss_children_mb", "mongo_commands", "mongo_bytes_sent", "mongo_bytes_received", "mongo_failed", "mongo_ops" ]
+QUEUE_FIELDS = [ "stage", "queue", "capacity", "items", "depth_mean", "depth_max", "producer_blocked_s", "consumer_waiting_s" ]
+
+def _bson_size( doc ):
+	try:
+		return len( BSON.encode( doc ) )
+	except Exception:
+		return 0
+
+if monitoring is not None:
+	class mongoCommandCounter( monitoring.CommandListener ):
+		"""Counts MongoDB commands by name, with BSON sizes of commands and replies"""
+
+		def __init__( self ):
+			self.commands = {}
+			self.sent = 0
+			self.received = 0
+			self.n_failed = 0
+
+		def started( self, event ):
+			self.commands[ event.command_name ] = self.commands.get( event.command_name, 0 ) + 1
+			self.sent = self.sent + _bson_size( event.command )
+
+		def succeeded( self, event ):
+			self.received = self.received + _bson_size( event.reply )
+
+		def failed( self, event ):
+			self.n_failed = self.n_failed + 1
+
+		def snapshot( self ):
+			return dict( self.commands ), self.sent, self.received, self.n_failed
+
+class ensembleStats:
+
+	def __init__( self ):
+		self.records = []
+		self.queue_records = []
+		self.active = []
+		self.profile_dir = None
+		self.profiling = False
+		self.counter = None
+		if monitoring is not None:
+			# only sees clients created after this point
+			self.counter = mongoCommandCounter()
+			monitoring.register( self.counter )
+
+	def enable_profiling( self, profile_dir ):
+		"""Dump cProfile stats of every outermost stage to 'profile_dir'"""
+		if not os.path.isdir( profile_dir ):
+			os.makedirs( profile_dir )
+		self.profile_dir = profile_dir
+
+	def mongo( self ):
+		if self.counter is None:
+			return {}, 0, 0, 0
+		return self.counter.snapshot()
+
+	@contextlib.contextmanager
+	def stage( self, name ):
+		"""Record a stage. Stages can be nested"""
+		parent = self.active[ -1 ] if len( self.active ) > 0 else None
+		self.active.append( name )
+		profiler = None
+		if self.profile_dir is not None and not self.profiling:
+			# cProfile cannot nest. inner stages are part of the outer profile
+			profiler = cProfile.Profile()
+			self.profiling = True
+		commands0, sent0, received0, failed0 = self.mongo()
+		own0 = resource.getrusage( resource.RUSAGE_SELF )
+		children0 = resource.getrusage( resource.RUSAGE_CHILDREN )
+		start = time.time()
+		if profiler is not None:
+			profiler.enable()
+		try:
+			yield
+		finally:
+			if profiler is not None:
+				profiler.disable()
+				profiler.dump_stats( os.path.join( self.profile_dir, "%s.prof" % name ) )
+				self.profiling = False
+			wall = time.time() - start
+			own = resource.getrusage( resource.RUSAGE_SELF )
+			children = resource.getrusage( resource.RUSAGE_CHILDREN )
+			commands, sent, received, failed = self.mongo()
+			self.active.pop()
+			self.records.append( {
+				"stage": name,
+				"parent": parent,
+				"start": start,
+				"wall_s": wall,
+				"cpu_s": ( own.ru_utime + own.ru_stime ) - ( own0.ru_utime + own0.ru_stime ),
+				"cpu_children_s": ( children.ru_utime + children.ru_stime ) - ( children0.ru_utime + children0.ru_stime ),
+				# ru_maxrss is in KB on linux: peak of the process so far
+				"max_rss_mb": own.ru_maxrss / 1024.0,
+				"max_rss_children_mb": children.ru_maxrss / 1024.0,
+				"mongo_commands": sum( commands.values() ) - sum( commands0.values() ),
+				"mongo_bytes_sent": sent - sent0,
+				"mongo_bytes_received": received - received0,
+				"mongo_failed": failed - failed0,
+				"mongo_ops": dict( [ ( i, commands[ i ] - commands0.get( i, 0 ) ) for i in commands if commands[ i ] - commands0.get( i, 0 ) > 0 ] )
+			} )
+
+	def queues( self, stage, metrics ):
+		"""Record the depth metrics of the bounded queues of a pipelined stage (see sql2mongoDB.depthQueue)"""
+		for i in metrics:
+			record = dict( i )
+			record[ "stage" ] = stage
+			self.queue_records.append( record )
+
+	def write( self, outdir, prefix = "ensemble.stats" ):
+		"""Write the stage records to <prefix>.json and <prefix>.csv in 'outdir', and queue metrics, 
+		if any, to <prefix>.queues.csv. Returns the file names"""
+		json_file = os.path.abspath( os.path.join( outdir, prefix + ".json" ) )
+		csv_file = os.path.abspath( os.path.join( outdir, prefix + ".csv" ) )
+		records = sorted( self.records, key = lambda i: i[ "start" ] )
+		with open( json_file, 'w' ) as outfile:
+			json.dump( records, outfile, indent = 1, sort_keys = True )
+		with open( csv_file, 'w' ) as outfile:
+			outfile.write( ",".join( FIELDS ) + "\n" )
+			for i in records:
+				row = [ i[ j ] for j in FIELDS[ :-1 ] ] + [ ";".join( [ "%s:%i" % ( k, v ) for k, v in sorted( i[ "mongo_ops" ].items() ) ] ) ]
+				outfile.write( ",".join( [ "" if j is None else str( j ) for j in row ] ) + "\n" )
+		if len( self.queue_records ) == 0:
+			return json_file, csv_file
+		queues_file = os.path.abspath( os.path.join( outdir, prefix + ".queues.csv" ) )
+		with open( queues_file, 'w' ) as outfile:
+			outfile.write( ",".join( QUEUE_FIELDS ) + "\n" )
+			for i in self.queue_records:
+				outfile.write( ",".join( [ str( i[ j ] ) for j in QUEUE_FIELDS ] ) + "\n" )
+		return json_file, csv_file, queues_file
+
+	def summary( self ):
+		print "%-28s %10s %10s %10s %10s %10s" % ( "stage", "wall (s)", "cpu (s)", "rss (MB)", "commands", "sent (MB)" )
+		for i in sorted( self.records, key = lambda i: i[ "start" ] ):
+			print "%-28s %10.1f %10.1f %10.1f %10i %10.1f" % ( i[ "stage" ], i[ "wall_s" ], i[ "cpu_s" ] + i[ "cpu_children_s" ], i[ "max_rss_mb" ], i[ "mongo_commands" ], i[ "mongo_bytes_sent" ] / 1048576.0 )
+		if len( self.queue_records ) > 0:
+			print_queues( self.queue_records )
+
+def print_queues( metrics ):
+	print "%-20s %-14s %8s %10s %10s %10s %12s %12s" % ( "stage", "queue", "capacity", "items", "mean depth", "max depth", "blocked (s)", "waiting (s)" )
+	for i in metrics:
+		print "%-20s %-14s %8i %10i %10.1f %10i %12.1f %12.1f" % ( i.get( "stage", "" ), i[ "queue" ], i[ "capacity" ], i[ "items" ], i[ "depth_mean" ], i[ "depth_max" ], i[ "producer_blocked_s" ], i[ "consumer_waiting_s" ] )
+
+STATS = ensembleStats()
+
+def instrumented( name = None ):
+	"""Decorator recording each call of a function or method as a stage in STATS"""
+	def decorator( f ):
+		stage = name if name is not None else f.__name__
+		@functools.wraps( f )
+		def wrapper( *args, **kwargs ):
+			with STATS.stage( stage ):
+				return f( *args, **kwargs )
+		return wrapper
+	return decorator
@@ -39,6 +39,9 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
 
 from query.egrin2_query import *
+from assemble.indexes import ensure_indexes
+from assemble.registry import idRegistry, bump_version
+from assemble.instrument import instrumented
 
 
 class makeCorems:
@@ -91,17 +94,14 @@ class makeCorems:
 		
 		self.db = client[self.db]
 		
-		self.row2id = {}
-		self.id2row = {}
-		for i in self.db.row_info.find( { }, { "egrin2_row_name": "1", "row_id": "1" } ):
-			self.row2id[ i[ "egrin2_row_name" ] ] = i[ "row_id" ]
-			self.id2row[ i[ "row_id" ] ] = i[ "egrin2_row_name" ]
-
-		self.col2id =  {}
-		self.id2col =  {}
-		for i in self.db.col_info.find( { }, { "egrin2_col_name": "1", "col_id": "1" } ):
-			self.col2id[ i[ "egrin2_col_name" ] ] = i[ "col_id" ]
-			self.id2col[ i[ "col_id" ] ] = i[ "egrin2_col_name" ]
+		self.registry = idRegistry( self.db )
+		rows = self.registry.frame( "row" )
+		self.row2id = dict( zip( rows.egrin2_row_name.tolist(), rows.row_id.tolist() ) )
+		self.id2row = dict( zip( rows.row_id.tolist(), rows.egrin2_row_name.tolist() ) )
+
+		cols = self.registry.frame( "col" )
+		self.col2id = dict( zip( cols.egrin2_col_name.tolist(), cols.col_id.tolist() ) )
+		self.id2col = dict( zip( cols.col_id.tolist(), cols.egrin2_col_name.tolist() ) )
 
 		if backbone_pval is None:
 			self.backbone_pval = 0.05
@@ -203,6 +203,7 @@ class makeCorems:
 			backbone_data_counts[i] = pval
 		return backbone_data_counts
 
+	@instrumented()
 	def rowRow( self ):
 		"""Construct row-row co-occurrence matrix (ie gene-gene co-occurrence)"""
 		
@@ -280,6 +281,7 @@ class makeCorems:
 		# clean up
 		del self.rowrow_ref
 
+	@instrumented()
 	def runCoremCscripts( self ):
 
 		def drange(start, stop = None, step = 1, precision = None):
@@ -436,6 +438,7 @@ class makeCorems:
 
 			# end plot
 
+	@instrumented()
 	def getCorems( self, cutoff = None ):
 		"""load clusters at selected density"""
 		if self.cutoff is None:
@@ -475,6 +478,7 @@ class makeCorems:
 
 		return None
 
+	@instrumented()
 	def addCorems( self ):
 		"""Add corems to MongoDB. Will Only run if self.cutoff has been set by running C++ codes"""
 		pd.options.mode.chained_assignment = None
@@ -518,7 +522,12 @@ class makeCorems:
 		to_write = [ coremStruct( i, corems )  for i in corems.Community_ID.unique() ]
 
 		self.db.corem.insert( to_write )
+		bump_version( self.db, "corem" )
+
+		print "Indexing corem collection"
+		ensure_indexes( self.db, [ "corem" ] )
 		
+	@instrumented()
 	def finishCorems( self ):
 		"""Finish adding corem info (cols) after resampling. Assumes corem docs already exist"""
 		# get all the corems
@@ -538,6 +547,8 @@ class makeCorems:
 
 	
 		corem_col_pvals = [  computeANDwriteCol( corems.iloc[ i ] ) for i in range( corems.shape[ 0 ] ) ]
+		# once all corems have their cols, so cached corems read while they were written are reloaded
+		bump_version( self.db, "corem" )
 
 		return None
 
@@ -2,7 +2,10 @@
 
 """Initialize  mongo database from individual cMonkey 
 runs (SQLite) plus some additional tables and run_id column, 
-including motifs and motif clusters"""
+including motifs and motif clusters
+
+ensembleMerger combines egrin2 MongoDB databases that were assembled independently (eg sub-ensembles
+built on separate machines) into one, without going back to the cMonkey runs"""
 
 __author__ = "Aaron Brooks"
 __copyright__ = "Copyright 2014, cMonkey2"
@@ -19,6 +22,7 @@ import glob
 import sys
 import gzip
 import time
+import argparse
 from urllib2 import urlopen, URLError, HTTPError
 from zipfile import ZipFile
 
@@ -30,9 +34,16 @@ import pandas as pd
 import sqlite3
 import pymongo
 from pymongo import MongoClient
+from bson.objectid import ObjectId
 import gridfs
 from Bio import SeqIO
 
+from assemble.sql2mongoDB import filter_existing, insert_batches, INGEST_STAGES
+from assemble.registry import idRegistry, KINDS
+from assemble.indexes import ensure_indexes
+from assemble.counts import update_counts, remove_run
+from assemble.packing import packArray, unpackArray
+
 
 # ratios_raw = "/Users/abrooks/Desktop/Active/Eco_ensemble_python_m3d/ratios_eco_m3d.tsv.gz"
 # col_annot = "/Users/abrooks/Desktop/Active/Eco_ensemble_python_m3d/E_coli_v4_Build_6.experiment_feature_descriptions.tsv.gz"
@@ -211,7 +222,7 @@ class sql2mongoDB:
 		genome_collection = self.db.genome
 	    
 	    	# Check whether documents are already present in the collection before insertion
-	    	seqs_f = filter( None, [ self.check4existence( genome_collection, i ) for i in seqs_b ] )
+	    	seqs_f = filter_existing( genome_collection, seqs_b, [ "scaffoldId" ] )
 
 	    	print "%s new records to write" % len( seqs_f )
 	    	if len(seqs_f) > 0:
@@ -305,7 +316,7 @@ class sql2mongoDB:
 		row_info_collection = self.db.row_info
 		# Check whether documents are already present in the collection before insertion
 		d = row_table.to_dict( outtype='records' )
-	    	d_f = filter( None, [ self.check4existence( row_info_collection, i ) for i in d ] )
+	    	d_f = filter_existing( row_info_collection, d, [ "egrin2_row_name" ] )
 
 	    	print "%s new records to write" % len( d_f )
 	    	
@@ -361,7 +372,7 @@ class sql2mongoDB:
 		col_info_collection = self.db.col_info
 		
 		# Check whether documents are already present in the collection before insertion
-	    	d_f = filter( None, [ self.check4existence( col_info_collection, i ) for i in col_info_4_mongoDB ] )
+	    	d_f = filter_existing( col_info_collection, col_info_4_mongoDB, [ "egrin2_col_name" ] )
 
 	    	print "%s new records to write" % len( d_f )
 	    	
@@ -417,7 +428,7 @@ class sql2mongoDB:
 		gene_expression_collection = db.gene_expression
 		
 		# Check whether documents are already present in the collection before insertion
-	    	d_f = filter( None, [ self.check4existence( gene_expression_collection, i ) for i in exp_data ] )
+	    	d_f = filter_existing( gene_expression_collection, exp_data, [ "row_id", "col_id" ] )
 
 	    	print "%s new records to write" % len( d_f )
 	    	
@@ -463,7 +474,7 @@ class sql2mongoDB:
 	    	ensemble_info_collection = db.ensemble_info
 	    	
 	    	# Check whether documents are already present in the collection before insertion
-	    	d_f = filter( None, [ self.check4existence( ensemble_info_collection, i, "run_name", i["run_name"] ) for i in to_insert ] )
+	    	d_f = filter_existing( ensemble_info_collection, to_insert, [ "run_name" ] )
 
 	    	print "%s new records to write" % len( d_f )
 	    	
@@ -512,7 +523,7 @@ class sql2mongoDB:
 		biclusters = [self.assemble_bicluster_info_single( db, e_dir, db_file, c, last_run, i[0], run2id, row2id, col2id, motif2gre, row_info_collection ) for i in c.fetchall()]
 		bicluster_info_collection = self.db.bicluster_info
 	    	# Check whether documents are already present in the collection before insertion
-	    	d_f = filter( None, [ self.check4existence( bicluster_info_collection, i, "run_id", i["run_id"], "cluster", i["cluster"] ) for i in biclusters ] )
+	    	d_f = filter_existing( bicluster_info_collection, biclusters, [ "run_id", "cluster" ], { "run_id": { "$in": list( set( [ i[ "run_id" ] for i in biclusters ] ) ) } } )
 
 	    	print "%s new records to write" % len( d_f )
 	    	
@@ -684,4 +695,300 @@ class sql2mongoDB:
 	    	return None
 
 
-
+class ensembleMerger:
+
+	def __init__( self, target, sources, host = "localhost", port = 27017, batch_size = 10000, client = None ):
+		"""Merge the egrin2 databases 'sources' into 'target'.
+
+		Databases are given by name on 'host':'port', or as "host:port/name". The ids (run_id, row_id,
+		col_id, gre_id) of each source are translated through its ID registry (or its info collections,
+		if assembled before the registry existed) to the target's registry, where new names get new
+		ids. Biclusters get new _ids, and cluster_id references follow them. Collections are streamed
+		from the source and written in unordered batches of 'batch_size'; only the id translations and
+		the bicluster _ids of a source are held in memory. Runs already in the target are skipped,
+		along with their biclusters, motifs and fimo hits. The ensemble_info of a run is written last, so
+		an interrupted merge can be rerun: runs it left incomplete are removed and copied again."""
+		self.host = host
+		self.port = port
+		self.clients = {}
+		if client is not None:
+			self.clients[ ( host, port ) ] = client
+		self.target = self.database( target )
+		self.sources = [ self.database( i ) for i in sources ]
+		self.registry = idRegistry( self.target )
+		self.batch_size = batch_size
+		self.report = {}
+
+	def database( self, spec ):
+		"""Database "name" on the default host, or "host:port/name" """
+		host, port, name = self.host, self.port, spec
+		if "/" in spec:
+			address, name = spec.rsplit( "/", 1 )
+			host, port = address.split( ":" ) if ":" in address else ( address, self.port )
+			port = int( port )
+		if ( host, port ) not in self.clients:
+			self.clients[ ( host, port ) ] = MongoClient( host, port )
+		return self.clients[ ( host, port ) ][ name ]
+
+	def source_names( self, source, kind ):
+		"""( ids, names ) of 'kind' in 'source', read without registering anything in the source"""
+		collection, name_field, id_field, first_id = KINDS[ kind ]
+		if source.id_counters.find_one( { "_id": kind } ) is not None:
+			docs = [ ( i[ "id" ], i[ "name" ] ) for i in source.id_registry.find( { "kind": kind }, { "_id": 0, "id": 1, "name": 1 } ) ]
+		elif collection is not None:
+			docs = [ ( i[ id_field ], i[ name_field ] ) for i in source[ collection ].find( {}, { "_id": 0, name_field: 1, id_field: 1 } ) if name_field in i and id_field in i ]
+		else:
+			# unnamed GREs of a legacy database are only meaningful within it
+			docs = [ ( i, "%s:%s" % ( source.name, i ) ) for i in source.motif_info.distinct( "gre_id" ) if i != "NaN" ]
+		return [ int( i[ 0 ] ) for i in docs ], [ i[ 1 ] for i in docs ]
+
+	def translation( self, source, kind ):
+		"""source id -> target id for all names of 'kind' in 'source'. New names are registered in the target"""
+		ids, names = self.source_names( source, kind )
+		if len( ids ) == 0:
+			return {}
+		return dict( zip( ids, self.registry.allocate( kind, names ).tolist() ) )
+
+	def remap( self, mapping, ids, kind ):
+		try:
+			return [ mapping[ i ] for i in ids ]
+		except KeyError as e:
+			raise ValueError( "%s_id %s is not registered in the source database" % ( kind, e.args[ 0 ] ) )
+
+	def written( self, source, collection, n ):
+		self.report.setdefault( source.name, {} )[ collection ] = self.report.get( source.name, {} ).get( collection, 0 ) + n
+		print "%s: %i %s documents merged" % ( source.name, n, collection )
+
+	def stream( self, collection, query = {}, projection = None ):
+		return collection.find( query, projection ).batch_size( self.batch_size )
+
+	def stream_clusters( self, collection, clusters, projection = None ):
+		"""Stream the documents of 'collection' whose cluster_id is one of 'clusters', querying by chunks of batch_size ids"""
+		ids = sorted( clusters )
+		for i in range( 0, len( ids ), self.batch_size ):
+			for doc in self.stream( collection, { "cluster_id": { "$in": ids[ i:i + self.batch_size ] } }, projection ):
+				yield doc
+
+	def merge_genome( self, source ):
+		"""Copy chromosomes (and their packed chunks) that are not in the target"""
+		existing = set( self.target.genome.distinct( "scaffoldId" ) )
+		n = 0
+		for doc in self.stream( source.genome ):
+			if doc[ "scaffoldId" ] in existing:
+				continue
+			doc.pop( "_id" )
+			chunks = ( dict( [ ( k, v ) for k, v in i.items() if k != "_id" ] ) for i in self.stream( source.genome_chunks, { "scaffoldId": doc[ "scaffoldId" ] } ) )
+			insert_batches( self.target.genome_chunks, chunks, self.batch_size )
+			self.target.genome.insert( doc )
+			n = n + 1
+		self.written( source, "genome", n )
+
+	def merge_info( self, source, collection, kind, mapping ):
+		"""Copy row_info or col_info documents of names that are not in the target, with translated ids"""
+		name_field, id_field = KINDS[ kind ][ 1 ], KINDS[ kind ][ 2 ]
+		existing = set( self.target[ collection ].distinct( name_field ) )
+		def docs():
+			for doc in self.stream( source[ collection ] ):
+				if doc.get( name_field ) in existing:
+					continue
+				doc.pop( "_id" )
+				doc[ id_field ] = self.remap( mapping, [ doc[ id_field ] ], kind )[ 0 ]
+				yield doc
+		self.written( source, collection, insert_batches( self.target[ collection ], docs(), self.batch_size ) )
+
+	def merge_gene_expression( self, source, maps ):
+		"""Merge gene_expression by ( row_id, col_id ), one condition at a time. Values already in the target are kept"""
+		if source.gene_expression.count() == 0:
+			return
+		n = 0
+		for col_id, target_col in sorted( maps[ "col" ].items() ):
+			existing = set( [ i[ "row_id" ] for i in self.target.gene_expression.find( { "col_id": target_col }, { "_id": 0, "row_id": 1 } ) ] )
+			def docs():
+				for doc in self.stream( source.gene_expression, { "col_id": col_id }, { "_id": 0 } ):
+					doc[ "row_id" ] = self.remap( maps[ "row" ], [ doc[ "row_id" ] ], "row" )[ 0 ]
+					if doc[ "row_id" ] in existing:
+						continue
+					doc[ "col_id" ] = target_col
+					yield doc
+			n = n + insert_batches( self.target.gene_expression, docs(), self.batch_size )
+		self.written( source, "gene_expression", n )
+
+	def merge_gene_expression_cols( self, source, maps ):
+		"""Merge gene_expression_cols. Rows of a condition that is already in the target are added to its document"""
+		fields = [ "raw_expression", "standardized_expression" ]
+		updated = [ 0 ]
+		def docs():
+			for doc in self.stream( source.gene_expression_cols, {}, { "_id": 0 } ):
+				rows = np.array( self.remap( maps[ "row" ], unpackArray( doc[ "row_ids" ], "<i4" ).tolist(), "row" ), dtype = np.int64 )
+				values = dict( [ ( i, unpackArray( doc[ i ] ) ) for i in fields ] )
+				col_id = self.remap( maps[ "col" ], [ doc[ "col_id" ] ], "col" )[ 0 ]
+				current = self.target.gene_expression_cols.find_one( { "col_id": col_id } )
+				if current is not None:
+					current_rows = unpackArray( current[ "row_ids" ], "<i4" ).astype( np.int64 )
+					new = ~np.in1d( rows, current_rows )
+					if not new.any():
+						continue
+					rows = np.concatenate( [ current_rows, rows[ new ] ] )
+					values = dict( [ ( i, np.concatenate( [ unpackArray( current[ i ] ), values[ i ][ new ] ] ) ) for i in fields ] )
+				# rows stay sorted by row_id, as written by sql2mongoDB.insert_gene_expression_columns
+				order = np.argsort( rows, kind = "mergesort" )
+				merged = { "col_id": col_id, "n_rows": len( rows ), "row_ids": packArray( rows[ order ], "<i4" ) }
+				for i in fields:
+					merged[ i ] = packArray( values[ i ][ order ] )
+				if current is not None:
+					self.target.gene_expression_cols.update( { "_id": current[ "_id" ] }, { "$set": merged } )
+					updated[ 0 ] = updated[ 0 ] + 1
+				else:
+					yield merged
+		written = insert_batches( self.target.gene_expression_cols, docs(), self.batch_size )
+		self.written( source, "gene_expression_cols", written + updated[ 0 ] )
+
+	def merge_runs( self, source, maps ):
+		"""Start copying the runs of 'source' that are not in the target. Returns the source run_ids to copy.
+
+		A run is in the target once its ensemble_info is, which finish_runs writes after the biclusters,
+		motifs and fimo hits of the run. Until then the target ingest_manifest of the run has every stage
+		incomplete, and documents left by an interrupted merge are removed here before the run is copied again"""
+		existing = set( self.target.ensemble_info.distinct( "run_name" ) )
+		runs = set()
+		for doc in self.stream( source.ensemble_info, {}, { "_id": 0, "run_id": 1, "run_name": 1 } ):
+			if doc[ "run_name" ] in existing:
+				print "WARNING: Run %s of %s is already in %s. Skipping it" % ( doc[ "run_name" ], source.name, self.target.name )
+				continue
+			runs.add( doc[ "run_id" ] )
+			run_id = maps[ "run" ][ doc[ "run_id" ] ]
+			self.remove_partial( doc[ "run_name" ], run_id )
+			stages = dict( [ ( i, { "complete": False, "count": 0, "updated": datetime.datetime.utcnow() } ) for i in INGEST_STAGES ] )
+			self.target.ingest_manifest.update( { "run_name": doc[ "run_name" ] }, { "$set": { "run_id": run_id, "stages": stages } }, upsert = True )
+		return runs
+
+	def remove_partial( self, run_name, run_id ):
+		"""Remove the biclusters, motifs and fimo hits that an interrupted merge left for a run that has no ensemble_info"""
+		cluster_ids = [ i[ "_id" ] for i in self.target.bicluster_info.find( { "run_id": run_id }, { "_id": 1 } ) ]
+		if len( cluster_ids ) == 0:
+			return
+		print "WARNING: Removing %i biclusters of run %s left by an interrupted merge" % ( len( cluster_ids ), run_name )
+		remove_run( self.target, run_id )
+		for i in range( 0, len( cluster_ids ), self.batch_size ):
+			chunk = cluster_ids[ i:i + self.batch_size ]
+			for collection in [ "fimo", "fimo_small", "motif_info" ]:
+				self.target[ collection ].remove( { "cluster_id": { "$in": chunk } } )
+		self.target.bicluster_info.remove( { "run_id": run_id } )
+
+	def finish_runs( self, source, runs, maps ):
+		"""Copy the ingest_manifest and ensemble_info of 'runs', once their biclusters, motifs and fimo hits are in the target.
+		The manifest goes first: a run whose ensemble_info is missing is copied again by the next merge"""
+		n = 0
+		for run_id in sorted( runs ):
+			run_name = source.ensemble_info.find_one( { "run_id": run_id }, { "run_name": 1 } )[ "run_name" ]
+			manifest = source.ingest_manifest.find_one( { "run_name": run_name }, { "_id": 0 } )
+			if manifest is None:
+				# source assembled before the manifest existed. No manifest means complete
+				self.target.ingest_manifest.remove( { "run_name": run_name } )
+				continue
+			manifest[ "run_id" ] = maps[ "run" ][ run_id ]
+			self.target.ingest_manifest.update( { "run_name": run_name }, manifest, upsert = True )
+			n = n + 1
+		self.written( source, "ingest_manifest", n )
+		def docs():
+			for doc in self.stream( source.ensemble_info, { "run_id": { "$in": sorted( runs ) } } ):
+				doc.pop( "_id" )
+				doc[ "run_id" ] = self.remap( maps[ "run" ], [ doc[ "run_id" ] ], "run" )[ 0 ]
+				doc[ "rows" ] = self.remap( maps[ "row" ], doc.get( "rows", [] ), "row" )
+				doc[ "cols" ] = self.remap( maps[ "col" ], doc.get( "cols", [] ), "col" )
+				yield doc
+		self.written( source, "ensemble_info", insert_batches( self.target.ensemble_info, docs(), self.batch_size ) )
+
+	def merge_biclusters( self, source, runs, maps ):
+		"""Copy bicluster_info of 'runs' with new _ids. Returns source _id -> target _id"""
+		clusters = {}
+		def docs():
+			for doc in self.stream( source.bicluster_info, { "run_id": { "$in": sorted( runs ) } } ):
+				clusters[ doc[ "_id" ] ] = doc[ "_id" ] = ObjectId()
+				doc[ "run_id" ] = maps[ "run" ][ doc[ "run_id" ] ]
+				doc[ "rows" ] = self.remap( maps[ "row" ], doc.get( "rows", [] ), "row" )
+				doc[ "columns" ] = self.remap( maps[ "col" ], doc.get( "columns", [] ), "col" )
+				yield doc
+		self.written( source, "bicluster_info", insert_batches( self.target.bicluster_info, docs(), self.batch_size ) )
+		return clusters
+
+	def merge_motifs( self, source, clusters, maps ):
+		"""Copy motif_info of the copied biclusters, with translated cluster_id, gre_id and MEME site row_ids"""
+		if len( clusters ) == 0:
+			self.written( source, "motif_info", 0 )
+			return
+		def docs():
+			for doc in self.stream_clusters( source.motif_info, clusters ):
+				doc.pop( "_id" )
+				doc[ "cluster_id" ] = clusters[ doc[ "cluster_id" ] ]
+				if doc.get( "gre_id", "NaN" ) != "NaN":
+					doc[ "gre_id" ] = self.remap( maps[ "gre" ], [ doc[ "gre_id" ] ], "gre" )[ 0 ]
+				for site in doc.get( "meme_motif_site", [] ):
+					if site.get( "row_id", "NaN" ) != "NaN":
+						site[ "row_id" ] = self.remap( maps[ "row" ], [ site[ "row_id" ] ], "row" )[ 0 ]
+				yield doc
+		self.written( source, "motif_info", insert_batches( self.target.motif_info, docs(), self.batch_size ) )
+
+	def merge_fimo( self, source, collection, clusters ):
+		"""Copy fimo or fimo_small hits of the copied biclusters"""
+		if len( clusters ) == 0:
+			self.written( source, collection, 0 )
+			return
+		def docs():
+			for doc in self.stream_clusters( source[ collection ], clusters, { "_id": 0 } ):
+				doc[ "cluster_id" ] = clusters[ doc[ "cluster_id" ] ]
+				yield doc
+		self.written( source, collection, insert_batches( self.target[ collection ], docs(), self.batch_size ) )
+
+	def merge_col_resample( self, source, maps ):
+		"""Copy col_resample distributions for ( n_rows, col_id ) pairs that the target lacks"""
+		existing = set( [ ( i[ "n_rows" ], i[ "col_id" ] ) for i in self.target.col_resample.find( {}, { "_id": 0, "n_rows": 1, "col_id": 1 } ) ] )
+		def docs():
+			for doc in self.stream( source.col_resample, {}, { "_id": 0 } ):
+				doc[ "col_id" ] = self.remap( maps[ "col" ], [ doc[ "col_id" ] ], "col" )[ 0 ]
+				if ( doc[ "n_rows" ], doc[ "col_id" ] ) not in existing:
+					yield doc
+		self.written( source, "col_resample", insert_batches( self.target.col_resample, docs(), self.batch_size ) )
+
+	def merge( self, source ):
+		"""Merge one source database into the target"""
+		print "Merging %s into %s" % ( source.name, self.target.name )
+		maps = dict( [ ( kind, self.translation( source, kind ) ) for kind in KINDS ] )
+		self.merge_genome( source )
+		self.merge_info( source, "row_info", "row", maps[ "row" ] )
+		self.merge_info( source, "col_info", "col", maps[ "col" ] )
+		self.merge_gene_expression( source, maps )
+		self.merge_gene_expression_cols( source, maps )
+		runs = self.merge_runs( source, maps )
+		clusters = self.merge_biclusters( source, runs, maps )
+		self.merge_motifs( source, clusters, maps )
+		self.merge_fimo( source, "fimo", clusters )
+		self.merge_fimo( source, "fimo_small", clusters )
+		self.finish_runs( source, runs, maps )
+		self.merge_col_resample( source, maps )
+		if source.corem.count() > 0:
+			print "WARNING: corems of %s are not merged. Rerun makeCorems on %s" % ( source.name, self.target.name )
+
+	def run( self ):
+		self.registry.migrate()
+		for source in self.sources:
+			self.merge( source )
+		ensure_indexes( self.target )
+		update_counts( self.target )
+		return self.report
+
+if __name__ == '__main__':
+
+	DESCRIPTION = """Merge independently assembled egrin2 MongoDB databases into one"""
+
+	parser = argparse.ArgumentParser(description=DESCRIPTION)
+	parser.add_argument('target', help="Target database. Name, or host:port/name")
+	parser.add_argument('sources', nargs='+', help="Databases to merge into the target. Name, or host:port/name")
+	parser.add_argument('--host', default="localhost", help="MongoDB host of databases given by name")
+	parser.add_argument('--port', default=27017, type=int, help="MongoDB port of databases given by name")
+	parser.add_argument('--batch_size', default=10000, type=int, help="Documents per bulk insert")
+
+	args = parser.parse_args()
+
+	merger = ensembleMerger( args.target, args.sources, host = args.host, port = args.port, batch_size = args.batch_size )
+	merger.run()
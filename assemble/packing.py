@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+"""
+Numeric arrays packed into BSON binary, as stored in the gene_expression_cols collection (one
+document per condition with the row_ids as int32 and the expression values as float64, all
+little-endian), and expressionRecords, which reads gene expression from either layout.
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import numpy as np
+import pandas as pd
+from bson.binary import Binary
+
+def packArray( values, dtype = "<f8" ):
+	"""Pack a numeric array into BSON binary, little-endian"""
+	return Binary( np.ascontiguousarray( values, dtype = dtype ).tostring() )
+
+def unpackArray( data, dtype = "<f8" ):
+	"""Inverse of packArray"""
+	return np.frombuffer( data, dtype = dtype )
+
+EXPRESSION_FIELDS = [ "raw_expression", "standardized_expression" ]
+
+def expressionRecords( client, db, rows = None, cols = None, fields = EXPRESSION_FIELDS ):
+	"""
+	Gene expression for row_ids 'rows' in col_ids 'cols' (None: all) as a long DataFrame with columns row_id, col_id and 'fields'.
+
+	Reads the columnar gene_expression_cols collection (one document per col_id with packed arrays, see 
+	sql2mongoDB.insert_gene_expression_columns) if it is populated, otherwise the gene_expression collection 
+	with one document per (row_id, col_id).
+	"""
+	if client[ db ].gene_expression_cols.find_one( {}, { "_id": 1 } ) is None:
+		q = {}
+		if rows is not None:
+			q[ "row_id" ] = { "$in": rows }
+		if cols is not None:
+			q[ "col_id" ] = { "$in": cols }
+		o = dict( [ ( i, 1 ) for i in [ "row_id", "col_id" ] + fields ] )
+		o[ "_id" ] = 0
+		return pd.DataFrame( list( client[ db ].gene_expression.find( q, o ) ), columns = [ "row_id", "col_id" ] + fields )
+
+	q = {}
+	if cols is not None:
+		q[ "col_id" ] = { "$in": cols }
+	o = dict( [ ( i, 1 ) for i in [ "row_ids", "col_id" ] + fields ] )
+	o[ "_id" ] = 0
+	row_ids = []
+	col_ids = []
+	values = dict( [ ( i, [] ) for i in fields ] )
+	for i in client[ db ].gene_expression_cols.find( q, o ):
+		r = unpackArray( i[ "row_ids" ], "<i4" )
+		keep = np.in1d( r, rows ) if rows is not None else slice( None )
+		r = r[ keep ]
+		row_ids.append( r )
+		col_ids.append( np.repeat( i[ "col_id" ], len( r ) ) )
+		for j in fields:
+			values[ j ].append( unpackArray( i[ j ] )[ keep ] )
+	if len( row_ids ) == 0:
+		return pd.DataFrame( None, columns = [ "row_id", "col_id" ] + fields )
+	to_r = pd.DataFrame( { "row_id": np.concatenate( row_ids ).astype( np.int64 ), "col_id": np.concatenate( col_ids ).astype( np.int64 ) } )
+	for j in fields:
+		to_r[ j ] = np.concatenate( values[ j ] )
+	return to_r.loc[ :, [ "row_id", "col_id" ] + fields ]
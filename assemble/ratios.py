@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Load gene expression ratios (genes x conditions, gzip compressed or plain, tab or comma delimited)
+through a binary sidecar. The first load parses the text file and writes next to it
+
+	<ratios file>.npy         the matrix, opened with zero-copy memory mapping on later loads
+	<ratios file>.names.json  row and column names, dtype and the md5 checksum, size and mtime of the source
+
+A source file whose size or mtime changed is checked against the md5 and, if different, parsed again.
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import os
+import gzip
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+SIDECAR_VERSION = 1
+
+def md5sum( file_in, blocksize = 1 << 20 ):
+	m = hashlib.md5()
+	with open( file_in, 'rb' ) as f:
+		for block in iter( lambda: f.read( blocksize ), "" ):
+			m.update( block )
+	return m.hexdigest()
+
+def sidecar_files( file_in ):
+	return file_in + ".npy", file_in + ".names.json"
+
+def parse_ratios( file_in ):
+	"""Parse a ratios text file. Tries tab, then comma delimiters"""
+	def opener():
+		with open( file_in, 'rb' ) as f:
+			gzipped = f.read( 2 ) == "\x1f\x8b"
+		return gzip.open( file_in, 'rb' ) if gzipped else open( file_in, 'rb' )
+	ratios = pd.read_csv( opener(), index_col=0, sep="\t" )
+	if ratios.shape[1] == 0:
+		# wrong delimiter? try comma
+		ratios = pd.read_csv( opener(), index_col=0, sep="," )
+	if ratios.shape[1] == 0:
+		# still wrong delimiter
+		print "Cannot read ratios file. Check delimiter. Should be '\t' or ',' "
+	return ratios
+
+def _native( names ):
+	# json gives unicode. read_csv gives str
+	return [ i.encode( "utf-8" ) if isinstance( i, unicode ) else i for i in names ]
+
+def read_sidecar( file_in, mmap = True ):
+	"""Ratios from the sidecar of 'file_in', or None if there is none or it is stale"""
+	npy_file, names_file = sidecar_files( file_in )
+	if not ( os.path.isfile( npy_file ) and os.path.isfile( names_file ) ):
+		return None
+	try:
+		with open( names_file ) as f:
+			info = json.load( f )
+	except ValueError:
+		return None
+	if info.get( "version" ) != SIDECAR_VERSION:
+		return None
+	st = os.stat( file_in )
+	if info[ "size" ] != st.st_size or info[ "mtime" ] != st.st_mtime:
+		# touched or changed. compare contents
+		if info[ "md5" ] != md5sum( file_in ):
+			return None
+		info[ "size" ] = st.st_size
+		info[ "mtime" ] = st.st_mtime
+		write_json( names_file, info )
+	# copy-on-write mapping: nothing is read until used and the source is never modified
+	values = np.load( npy_file, mmap_mode = "c" if mmap else None )
+	if values.shape != ( len( info[ "rows" ] ), len( info[ "cols" ] ) ):
+		return None
+	ratios = pd.DataFrame( values, index = _native( info[ "rows" ] ), columns = _native( info[ "cols" ] ), copy = False )
+	ratios.index.name = info.get( "index_name" )
+	return ratios
+
+def write_json( file_out, d ):
+	tmp = file_out + ".tmp%i" % os.getpid()
+	with open( tmp, 'w' ) as f:
+		json.dump( d, f )
+	os.rename( tmp, file_out )
+
+def write_sidecar( file_in, ratios ):
+	"""Write the sidecar of 'file_in'. Returns False if it could not be written (eg read-only directory)"""
+	npy_file, names_file = sidecar_files( file_in )
+	st = os.stat( file_in )
+	info = {
+		"version": SIDECAR_VERSION,
+		"md5": md5sum( file_in ),
+		"size": st.st_size,
+		"mtime": st.st_mtime,
+		"dtype": str( ratios.values.dtype ),
+		"index_name": ratios.index.name,
+		"rows": ratios.index.tolist(),
+		"cols": ratios.columns.tolist()
+	}
+	try:
+		# np.save appends .npy to names without it
+		tmp = npy_file[ :-len( ".npy" ) ] + ".tmp%i.npy" % os.getpid()
+		np.save( tmp, np.ascontiguousarray( ratios.values ) )
+		os.rename( tmp, npy_file )
+		write_json( names_file, info )
+	except ( IOError, OSError ) as e:
+		print "Could not write ratios sidecar for %s: %s" % ( file_in, e )
+		return False
+	return True
+
+def load_ratios( file_in, dtype = None, cache = True, mmap = True ):
+	"""
+	Load ratios file 'file_in' as a DataFrame, through its binary sidecar if 'cache'.
+
+	'dtype' (eg np.float32) converts the matrix before it is cached. With 'mmap' the matrix is a
+	copy-on-write memory map of the sidecar. Set 'cache' False to always parse the text file.
+	"""
+	if cache:
+		ratios = read_sidecar( file_in, mmap = mmap )
+		if ratios is not None and ( dtype is None or ratios.values.dtype == np.dtype( dtype ) ):
+			return ratios
+	ratios = parse_ratios( file_in )
+	if dtype is not None:
+		ratios = ratios.astype( dtype )
+	if cache and ratios.shape[1] > 0 and ratios.values.dtype in ( np.float32, np.float64 ):
+		write_sidecar( file_in, ratios )
+	return ratios
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""
+Ensemble ID registry. Assigns the integer ids of rows (genes), cols (conditions), runs and GREs
+of an egrin2 MongoDB and translates between names and ids.
+
+Names and ids are persisted in the id_registry collection, one document per name. New ids are
+allocated in blocks from a per-kind counter in id_counters with an atomic $inc, so concurrent
+writers never hand out the same id; a unique (kind, name) index makes the first writer of a name
+win. Each allocation bumps the kind's version, which readers can use to invalidate caches.
+Collections that are updated in place (eg corem, by makeCorems) bump their own version in
+collection_versions for the same purpose.
+Databases assembled before the registry existed are read from row_info, col_info and ensemble_info.
+Loading never writes: they are registered ("seeded") by migrate, an assembly step run by
+sql2mongoDB.compile and ensembleMerger, or when ids are first allocated.
+
+Example:
+
+reg = idRegistry( client[ "eco_db" ] )
+reg.allocate( "row", [ "b0001", "b0002" ] )
+reg.to_id( "row", [ "b0002", "b0001" ] )
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import numpy as np
+import pandas as pd
+
+import pymongo
+from pymongo.errors import DuplicateKeyError
+
+# kind -> ( legacy collection, name field, id field, first id )
+KINDS = {
+	"row": ( "row_info", "egrin2_row_name", "row_id", 0 ),
+	"col": ( "col_info", "egrin2_col_name", "col_id", 0 ),
+	"run": ( "ensemble_info", "run_name", "run_id", 0 ),
+	"gre": ( None, "gre_name", "gre_id", 1 )
+}
+
+def bump_version( db, name ):
+	"""Bump the version of collection 'name', eg after its documents were updated in place"""
+	db.collection_versions.update( { "_id": name }, { "$inc": { "version": 1 } }, upsert = True )
+
+def collection_version( db, name ):
+	"""Version of collection 'name'. 0 if it was never bumped"""
+	doc = db.collection_versions.find_one( { "_id": name } )
+	if doc is None:
+		return 0
+	return doc[ "version" ]
+
+class idRegistry:
+
+	def __init__( self, db ):
+		self.db = db
+		self.names = {}
+		self.ids = {}
+		self.versions = {}
+
+	def version( self, kind ):
+		"""Version of 'kind' in the database. Changes whenever ids are allocated"""
+		counter = self.db.id_counters.find_one( { "_id": kind } )
+		if counter is None:
+			return 0
+		return counter[ "version" ]
+
+	def load( self, kind ):
+		"""(Re)load all names and ids of 'kind' from the database. A kind that was never seeded is read
+		from its legacy collection (see KINDS), without registering anything"""
+		if self.seeded( kind ):
+			docs = [ ( i[ "name" ], i[ "id" ] ) for i in self.db.id_registry.find( { "kind": kind }, { "_id": 0, "name": 1, "id": 1 } ) ]
+		else:
+			docs = self.legacy( kind ).items()
+		names = [ i[ 0 ] for i in docs ]
+		ids = [ i[ 1 ] for i in docs ]
+		order = np.argsort( ids, kind = "mergesort" )
+		self.names[ kind ] = pd.Index( names, dtype = object )[ order ]
+		self.ids[ kind ] = np.array( ids, dtype = np.int64 )[ order ]
+		self.versions[ kind ] = self.version( kind )
+
+	def seeded( self, kind ):
+		return self.db.id_counters.find_one( { "_id": kind } ) is not None
+
+	def legacy( self, kind ):
+		"""name -> id of 'kind' in its collection of a database assembled before the registry existed"""
+		collection, name_field, id_field, first_id = KINDS[ kind ]
+		docs = {}
+		if collection is not None:
+			for i in self.db[ collection ].find( {}, { "_id": 0, name_field: 1, id_field: 1 } ):
+				if name_field in i and id_field in i:
+					docs[ i[ name_field ] ] = int( i[ id_field ] )
+		return docs
+
+	def seed( self, kind ):
+		"""Register the names and ids of a database assembled before the registry existed. Does nothing if 'kind' is seeded"""
+		if self.seeded( kind ):
+			return
+		collection, name_field, id_field, first_id = KINDS[ kind ]
+		docs = self.legacy( kind )
+		self.register( [ { "kind": kind, "name": name, "id": id } for name, id in docs.items() ] )
+		next_id = max( docs.values() ) + 1 if len( docs ) > 0 else first_id
+		try:
+			self.db.id_counters.insert( { "_id": kind, "next_id": next_id, "version": 1 } )
+		except DuplicateKeyError:
+			# seeded concurrently
+			pass
+		if kind in self.names:
+			self.load( kind )
+
+	def migrate( self ):
+		"""Seed every kind. An assembly step: writes to the database"""
+		for kind in KINDS:
+			self.seed( kind )
+
+	def loaded( self, kind ):
+		if kind not in self.names:
+			self.load( kind )
+
+	def refresh( self, kind ):
+		"""Reload 'kind' if it was changed in the database since it was loaded"""
+		if kind not in self.names or self.versions[ kind ] != self.version( kind ):
+			self.load( kind )
+
+	def allocate( self, kind, names ):
+		"""Ids of 'names', registering names that are new. Returns an int64 array aligned with 'names'"""
+		self.seed( kind )
+		self.loaded( kind )
+		names = pd.Index( names, dtype = object )
+		new = names[ self.names[ kind ].get_indexer( names ) < 0 ].unique()
+		if len( new ) > 0:
+			# reserve a block of ids, then register. names registered meanwhile by someone else keep their id
+			counter = self.reserve( kind, len( new ) )
+			self.register( [ { "kind": kind, "name": name, "id": counter + i } for i, name in enumerate( new.tolist() ) ] )
+			self.load( kind )
+		return self.to_id( kind, names )
+
+	def register( self, documents ):
+		"""Insert name documents. Names that are already registered keep their first id"""
+		if len( documents ) == 0:
+			return
+		self.db.id_registry.ensure_index( [ ( "kind", pymongo.ASCENDING ), ( "name", pymongo.ASCENDING ) ], unique = True )
+		try:
+			if hasattr( self.db.id_registry, "insert_many" ):
+				self.db.id_registry.insert_many( documents, ordered = False )
+			else:
+				self.db.id_registry.insert( documents, continue_on_error = True )
+		except pymongo.errors.BulkWriteError as e:
+			if len( [ i for i in e.details.get( "writeErrors", [] ) if i.get( "code" ) != 11000 ] ) > 0:
+				raise
+		except DuplicateKeyError:
+			pass
+
+	def reserve( self, kind, n ):
+		"""Atomically reserve 'n' ids of 'kind'. Returns the first one"""
+		self.loaded( kind )
+		q = { "_id": kind }
+		u = { "$inc": { "next_id": n, "version": 1 } }
+		try:
+			counter = self.db.id_counters.find_one_and_update( q, u )
+		except AttributeError:
+			counter = self.db.id_counters.find_and_modify( q, u )
+		return counter[ "next_id" ]
+
+	def to_id( self, kind, names, missing = -1 ):
+		"""Translate 'names' to ids in one vectorized lookup. Unknown names get 'missing'"""
+		self.loaded( kind )
+		idx = self.names[ kind ].get_indexer( pd.Index( names, dtype = object ) )
+		if len( self.ids[ kind ] ) == 0:
+			return np.repeat( missing, len( idx ) )
+		return np.where( idx >= 0, self.ids[ kind ][ idx ], missing )
+
+	def to_name( self, kind, ids, missing = None ):
+		"""Translate 'ids' to names in one vectorized lookup. Unknown ids get 'missing'"""
+		self.loaded( kind )
+		idx = pd.Index( self.ids[ kind ] ).get_indexer( np.asarray( ids, dtype = np.int64 ) )
+		if len( self.ids[ kind ] ) == 0:
+			return [ missing ] * len( idx )
+		return np.where( idx >= 0, self.names[ kind ].values[ idx ], missing ).tolist()
+
+	def frame( self, kind ):
+		"""All names and ids of 'kind' as a DataFrame indexed by name, eg columns row_id, egrin2_row_name"""
+		self.loaded( kind )
+		collection, name_field, id_field, first_id = KINDS[ kind ]
+		return pd.DataFrame( { id_field: self.ids[ kind ], name_field: self.names[ kind ].values }, index = self.names[ kind ].values, columns = [ id_field, name_field ] )
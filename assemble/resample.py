@@ -30,6 +30,10 @@ from pymongo import MongoClient
 import numpy as np
 import pandas as pd
 
+from assemble.registry import idRegistry
+from assemble.instrument import instrumented
+from assemble.packing import expressionRecords
+
 from query.egrin2_query import *
  
 DESCRIPTION = """resample.py - prepare brute force random resamples"""
@@ -69,6 +73,7 @@ def choose_n( col, vals, n, add, client, db, n_rows, n_resamples, old_records, k
 		ras = ras[ 0: int( n2keep ) ]
 		client[ db ][ "col_resample" ].update( { "n_rows": n_rows, "col_id": col }, { "$set": { "resamples": resamples, "lowest_raw": ran, "lowest_standardized": ras } } )
 
+@instrumented()
 def colResampleInd( host, db, n_rows, cols, n_resamples = 1000, keepP = 0.1, port = 27017):
 	"""Resample gene expression for a given number of genes in a particular condition using RSD, brute force."""
 
@@ -103,7 +108,7 @@ def colResampleInd( host, db, n_rows, cols, n_resamples = 1000, keepP = 0.1, por
 		nbins = int( math.ceil( len( toAdd )/100.0 ) )
 		bins = split_list( toAdd, nbins)
 		for b in bins:
-			df = pd.DataFrame( list( client[db].gene_expression.find( { "col_id": { "$in": b } }, { "col_id":1, "raw_expression":1, "standardized_expression":1 } ) ) )
+			df = expressionRecords( client, db, cols = b ).drop( "row_id", axis = 1 )
 			if df.shape != (0,0):
 				df = df.groupby("col_id")
 				df_rsd = pd.concat( [ df.aggregate( resample, n_rows ) for i in range( 0, n_resamples ) ] )
@@ -118,7 +123,7 @@ def colResampleInd( host, db, n_rows, cols, n_resamples = 1000, keepP = 0.1, por
 		nbins = int( math.ceil( len( toUpdate )/100.0 ) )
 		bins = split_list( toUpdate, nbins)
 		for b in bins:
-			df = pd.DataFrame( list( client[db].gene_expression.find( { "col_id": { "$in": b } }, { "col_id":1, "raw_expression":1, "standardized_expression":1 } ) ) )
+			df = expressionRecords( client, db, cols = b ).drop( "row_id", axis = 1 )
 			if df.shape != (0,0):
 				df = df.groupby("col_id")
 				resamples = n_resamples - np.min( [ i[ "resamples" ] for i in old_records.values( ) ] )
@@ -152,7 +157,7 @@ if __name__ == '__main__':
 	client = MongoClient( host = args.host, port= args.port )
 	
 	if args.cols is None:
-		cols = pd.DataFrame( list ( client[ args.db ][ "col_info" ].find({},{"col_id":1}) ) ).col_id.tolist()
+		cols = idRegistry( client[ args.db ] ).frame( "col" ).col_id.tolist()
 	else:
 		# not supported yet
 		print "Not supported yet"
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""
+Covering indexes for reading the last iteration of a cMonkey run database (cmonkey_run.db).
+
+cMonkey writes row_members, column_members, cluster_stats and motif_infos without indexes, and
+row_members holds the memberships of every iteration, so each WHERE iteration = ? is a full table
+scan. The same goes for the motif sites and PSSM rows joined to motif_infos. Tables of a run that
+lack an index on their key ((iteration, cluster), or motif_info_id) are copied, once, to a
+sidecar index database with covering indexes and planner statistics (ANALYZE):
+
+	<run>/cmonkey_run.db.index.db    tables keyed by the source rowid (so ORDER BY rowid is kept)
+
+Queries should order by +rowid: a plain ORDER BY rowid makes SQLite scan the table in rowid order
+rather than search the index.
+
+If the run directory is not writable the sidecar goes to the temporary directory. Sidecars are
+rebuilt when the size or mtime of the run database changes. The run database itself is never
+modified, unless indexes are explicitly requested in place.
+
+Example:
+
+conn, tables = open_run( "eco-out-001/cmonkey_run.db" )
+conn.execute( "SELECT cluster, residual FROM %s AS cluster_stats WHERE iteration = ? ORDER BY +rowid" % tables[ "cluster_stats" ], ( 2001, ) )
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "1.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import os
+import sqlite3
+import hashlib
+import tempfile
+
+SIDECAR_VERSION = 1
+
+# table -> ( key columns, other covered columns ), as used by sql2mongoDB.extract_run
+INDEXED_TABLES = {
+	"cluster_stats": ( [ "iteration", "cluster" ], [ "residual" ] ),
+	"row_members": ( [ "iteration", "cluster" ], [ "order_num" ] ),
+	"column_members": ( [ "iteration", "cluster" ], [ "order_num" ] ),
+	"motif_infos": ( [ "iteration", "cluster" ], [ "motif_num", "seqtype", "evalue" ] ),
+	"meme_motif_sites": ( [ "motif_info_id" ], [ "seq_name", "reverse", "start", "pvalue" ] ),
+	"motif_pssm_rows": ( [ "motif_info_id" ], [ "row", "a", "c", "g", "t" ] )
+}
+
+MODES = [ "sidecar", "in_place", "none" ]
+
+def has_index( conn, table, schema = "main" ):
+	"""Does 'table' have an index that leads with its key columns (in any order), eg iteration and cluster"""
+	key = set( INDEXED_TABLES[ table ][ 0 ] )
+	for i in conn.execute( "PRAGMA %s.index_list( %s );" % ( schema, table ) ).fetchall():
+		columns = [ j[ 2 ] for j in conn.execute( "PRAGMA %s.index_info( %s );" % ( schema, i[ 1 ] ) ).fetchall() ]
+		if set( columns[ :len( key ) ] ) == key:
+			return True
+	return False
+
+def missing_indexes( conn ):
+	"""Tables of INDEXED_TABLES in the run database of 'conn' without an index on their key"""
+	tables = set( [ i[ 0 ] for i in conn.execute( "SELECT name FROM sqlite_master WHERE type = 'table';" ) ] )
+	return sorted( [ i for i in INDEXED_TABLES if i in tables and not has_index( conn, i ) ] )
+
+def index_name( table ):
+	return "%s_%s" % ( table, "_".join( INDEXED_TABLES[ table ][ 0 ] ) )
+
+def sidecar_file( db_file ):
+	"""Sidecar of 'db_file': next to it if its directory is writable, otherwise in the temporary directory"""
+	db_file = os.path.abspath( db_file )
+	if os.access( os.path.dirname( db_file ), os.W_OK ):
+		return db_file + ".index.db"
+	return os.path.join( tempfile.gettempdir(), "cmonkey_run_%s.index.db" % hashlib.md5( db_file ).hexdigest() )
+
+def _source( db_file ):
+	st = os.stat( db_file )
+	return st.st_size, st.st_mtime
+
+def sidecar_current( sidecar, db_file, tables ):
+	"""Sidecar exists, was built from the current 'db_file' and covers 'tables'"""
+	if not os.path.isfile( sidecar ):
+		return False
+	try:
+		conn = sqlite3.connect( sidecar )
+		try:
+			info = dict( conn.execute( "SELECT key, value FROM sidecar_info;" ).fetchall() )
+			present = set( [ i[ 0 ] for i in conn.execute( "SELECT name FROM sqlite_master WHERE type = 'table';" ) ] )
+		finally:
+			conn.close()
+	except sqlite3.Error:
+		return False
+	size, mtime = _source( db_file )
+	return info.get( "version" ) == str( SIDECAR_VERSION ) and info.get( "size" ) == str( size ) and info.get( "mtime" ) == repr( mtime ) and set( tables ) <= present
+
+def build_sidecar( db_file, tables, sidecar = None ):
+	"""Copy 'tables' of 'db_file' to its sidecar index database with covering indexes. Returns the sidecar file"""
+	if sidecar is None:
+		sidecar = sidecar_file( db_file )
+	# build under a temporary name, so concurrent readers never see a partial sidecar
+	tmp = sidecar + ".tmp%i" % os.getpid()
+	if os.path.isfile( tmp ):
+		os.remove( tmp )
+	size, mtime = _source( db_file )
+	conn = sqlite3.connect( tmp )
+	try:
+		conn.execute( "ATTACH DATABASE ? AS src;", ( db_file, ) )
+		for table in tables:
+			columns = INDEXED_TABLES[ table ][ 0 ] + INDEXED_TABLES[ table ][ 1 ]
+			# src_rowid is the rowid, so joins on and ordering by rowid work as in the source
+			conn.execute( "CREATE TABLE %s ( src_rowid INTEGER PRIMARY KEY, %s );" % ( table, ", ".join( columns ) ) )
+			conn.execute( "INSERT INTO %s SELECT rowid, %s FROM src.%s;" % ( table, ", ".join( columns ), table ) )
+			conn.execute( "CREATE INDEX %s ON %s ( %s );" % ( index_name( table ), table, ", ".join( columns ) ) )
+		conn.commit()
+		# ANALYZE would also write statistics into an attached run database
+		conn.execute( "DETACH DATABASE src;" )
+		conn.execute( "ANALYZE main;" )
+		conn.execute( "CREATE TABLE sidecar_info ( key TEXT PRIMARY KEY, value TEXT );" )
+		conn.executemany( "INSERT INTO sidecar_info VALUES ( ?, ? );", [ ( "version", str( SIDECAR_VERSION ) ), ( "source", os.path.abspath( db_file ) ), ( "size", str( size ) ), ( "mtime", repr( mtime ) ) ] )
+		conn.commit()
+	finally:
+		conn.close()
+	os.rename( tmp, sidecar )
+	return sidecar
+
+def add_indexes( conn, tables ):
+	"""Create the covering indexes in the run database itself. Only on request: it modifies run output"""
+	for table in tables:
+		conn.execute( "CREATE INDEX IF NOT EXISTS %s ON %s ( %s );" % ( index_name( table ), table, ", ".join( INDEXED_TABLES[ table ][ 0 ] + INDEXED_TABLES[ table ][ 1 ] ) ) )
+	conn.execute( "ANALYZE main;" )
+	conn.commit()
+
+def open_run( db_file, mode = "sidecar" ):
+	"""Connect to a cMonkey run database, with indexes on the keys of all of INDEXED_TABLES.
+
+	'mode' is one of MODES: "sidecar" builds or reuses the sidecar index database and attaches it as
+	'idx', "in_place" adds the indexes to the run database, "none" reads the tables as they are.
+	Returns ( connection, tables ) where tables maps each table name to the name to query it by,
+	eg "idx.row_members"."""
+	if mode not in MODES:
+		raise ValueError( "Unknown index mode %s. Use one of %s" % ( mode, ", ".join( MODES ) ) )
+	conn = sqlite3.connect( db_file )
+	tables = dict( [ ( i, i ) for i in INDEXED_TABLES ] )
+	if mode == "none":
+		return conn, tables
+	missing = missing_indexes( conn )
+	if len( missing ) == 0:
+		return conn, tables
+	if mode == "in_place":
+		add_indexes( conn, missing )
+		return conn, tables
+	sidecar = sidecar_file( db_file )
+	try:
+		if not sidecar_current( sidecar, db_file, missing ):
+			build_sidecar( db_file, missing, sidecar )
+		conn.execute( "ATTACH DATABASE ? AS idx;", ( sidecar, ) )
+	except ( sqlite3.Error, IOError, OSError ) as e:
+		print "WARNING: Could not build index sidecar for %s. Reading without indexes. %s" % ( db_file, e )
+		return conn, tables
+	for i in missing:
+		tables[ i ] = "idx." + i
+	return conn, tables
@@ -24,6 +24,9 @@ import time
 from urllib2 import urlopen, URLError, HTTPError
 from zipfile import ZipFile
 import itertools
+import multiprocessing
+import threading
+import Queue
 
 import numpy as np
 import pandas as pd
@@ -34,6 +37,16 @@ from pymongo import MongoClient
 from bson.objectid import ObjectId
 from Bio import SeqIO
 
+from assemble.indexes import ensure_indexes
+from assemble.counts import update_counts, remove_run
+from assemble.federation import runFederation
+from assemble.genome import genomeStore
+from assemble.ratios import load_ratios
+from assemble.runindex import INDEXED_TABLES, open_run
+from assemble.registry import idRegistry
+from assemble.instrument import STATS, instrumented, print_queues
+from assemble.packing import packArray
+
 
 # ratios_raw = "/Users/abrooks/Desktop/Active/Eco_ensemble_python_m3d/ratios_eco_m3d.tsv.gz"
 # col_annot = "/Users/abrooks/Desktop/Active/Eco_ensemble_python_m3d/E_coli_v4_Build_6.experiment_feature_descriptions.tsv.gz"
@@ -43,9 +56,185 @@ from Bio import SeqIO
 
 # sql2mongoDB( ratios_raw = "/Users/abrooks/Desktop/Active/Eco_ensemble_python_m3d/ratios_eco_m3d.tsv.gz",  col_annot = "/Users/abrooks/Desktop/Active/Eco_ensemble_python_m3d/E_coli_v4_Build_6.experiment_feature_descriptions.tsv.gz", ncbi_code = "511145")
 
+def insert_batches( collection, documents, batch_size = 10000 ):
+	"""Stream an iterable of documents into 'collection' with unordered bulk inserts of 'batch_size'.
+
+	Duplicate key errors (eg from unique indexes) are ignored. Returns the number of documents inserted."""
+	written = 0
+	batch = []
+	for d in documents:
+		batch.append( d )
+		if len( batch ) >= batch_size:
+			written = written + _insert_batch( collection, batch )
+			batch = []
+	if len( batch ) > 0:
+		written = written + _insert_batch( collection, batch )
+	return written
+
+def filter_existing( collection, documents, keys, query = None ):
+	"""Return the documents whose natural key (values of the fields in 'keys') is not already in 'collection'.
+
+	Existing keys are fetched with a single projection query (restricted by 'query' if given)
+	and compared in memory, rather than one query per document."""
+	documents = list( documents )
+	if len( documents ) == 0 or collection.count() == 0:
+		return documents
+	projection = dict( [ ( k, 1 ) for k in keys ] )
+	projection[ "_id" ] = 0
+	if query is None:
+		query = {}
+	existing = set( [ tuple( [ i.get( k ) for k in keys ] ) for i in collection.find( query, projection ) ] )
+	return [ i for i in documents if tuple( [ i.get( k ) for k in keys ] ) not in existing ]
+
+def _insert_batch( collection, batch ):
+	try:
+		if hasattr( collection, "insert_many" ):
+			collection.insert_many( batch, ordered = False )
+		else:
+			collection.insert( batch, continue_on_error = True )
+		return len( batch )
+	except pymongo.errors.BulkWriteError as e:
+		if len( [ i for i in e.details.get( "writeErrors", [] ) if i.get( "code" ) != 11000 ] ) > 0:
+			raise
+		return e.details.get( "nInserted", 0 )
+	except pymongo.errors.DuplicateKeyError:
+		# pymongo 2.x continue_on_error. remaining documents were still inserted, count includes duplicates
+		return len( batch )
+
+# ingest stages of a run, in order. recorded in the ingest_manifest collection
+INGEST_STAGES = [ "ensemble_info", "bicluster_info", "motif_info", "fimo" ]
+
+_ingest_worker = None
+_fimo_refseq2scaffold = None
+
+def _init_pipeline_worker( s2m, refseq2scaffold, connect = True ):
+	"""Pool initializer for sql2mongoDB.ingest_pipeline. Workers both read runs and parse FIMO files.
+	MongoDB clients are not fork-safe, so with 'connect' each worker opens its own."""
+	global _ingest_worker, _fimo_refseq2scaffold
+	_ingest_worker = s2m
+	_fimo_refseq2scaffold = refseq2scaffold
+	if connect:
+		_ingest_worker.db = MongoClient( 'mongodb://'+s2m.host+':'+str(s2m.port)+'/' )[ s2m.dbname ]
+		_ingest_worker.row_info_collection = _ingest_worker.db.row_info
+
+def _ingest_run( db_file ):
+	return _ingest_worker._ingest_run( db_file )
+
+def _parse_fimo( task ):
+	"""Parse one bz2 FIMO output in chunks, keeping hits with p-value <= cutoff. 
+
+	task is ( file, cluster_id, pval_cutoff, chunksize ). Returns ( file, cluster_id, DataFrame, error ). 
+	DataFrame is None if the file does not exist (error None) or could not be read."""
+	f, cluster_id, pval_cutoff, chunksize = task
+	if not os.path.isfile( f ):
+		return f, cluster_id, None, None
+	try:
+		fimo = pd.concat( [ i.loc[ i[ "p-value" ] <= pval_cutoff, : ] for i in pd.read_csv( f, sep="\t", compression = "bz2", chunksize = chunksize ) ], ignore_index = True )
+		# change sequence_name to scaffoldId
+		fimo.rename(columns={'matched sequence': 'matched_sequence', 'sequence name': 'scaffoldId', "#pattern name": "motif_num"}, inplace=True)
+		trans_d = {}
+		for i in fimo.scaffoldId.unique():
+			NCBI_RefSeq = "_".join(i.split('.')[-2].split("_")[::-1][0:2][::-1])
+			trans_d[i] = _fimo_refseq2scaffold[ NCBI_RefSeq ]
+		fimo[ "scaffoldId" ] = [ trans_d[ i ] for i in fimo.scaffoldId.values ]
+		fimo[ "cluster_id" ] = cluster_id
+		# only keep specific columns
+		fimo = fimo.loc[ : , [ 'scaffoldId', 'start', 'stop', 'strand', 'score', 'p-value', 'in_coding_rgn', 'cluster_id', 'motif_num' ] ]
+		return f, cluster_id, fimo, None
+	except Exception as e:
+		return f, cluster_id, None, "%s: %s" % ( type( e ).__name__, e )
+
+class inlinePool:
+	"""Stands in for multiprocessing.Pool when there is a single worker: apply_async runs the task in the
+	calling thread, then its callback"""
+
+	def apply_async( self, func, args = (), callback = None ):
+		result = func( *args )
+		if callback is not None:
+			callback( result )
+
+	def close( self ):
+		pass
+
+	def join( self ):
+		pass
+
+class depthQueue( Queue.Queue ):
+	"""Bounded Queue.Queue that records its depth.
+
+	put blocks while the queue holds 'maxsize' items, which holds back the producer (backpressure). 
+	metrics() reports the depth seen at each put (mean and maximum) and the seconds producers 
+	spent blocked in put and consumers spent waiting in get."""
+
+	def __init__( self, name, maxsize = 0 ):
+		Queue.Queue.__init__( self, maxsize )
+		self.name = name
+		self.n_put = 0
+		self.depth_sum = 0
+		self.depth_max = 0
+		self.put_wait = 0.0
+		self.get_wait = 0.0
+
+	def put( self, item, block = True, timeout = None ):
+		t0 = time.time()
+		Queue.Queue.put( self, item, block, timeout )
+		depth = self.qsize()
+		with self.mutex:
+			self.put_wait = self.put_wait + time.time() - t0
+			self.n_put = self.n_put + 1
+			self.depth_sum = self.depth_sum + depth
+			self.depth_max = max( self.depth_max, depth )
+
+	def get( self, block = True, timeout = None ):
+		t0 = time.time()
+		item = Queue.Queue.get( self, block, timeout )
+		with self.mutex:
+			self.get_wait = self.get_wait + time.time() - t0
+		return item
+
+	def metrics( self ):
+		return {
+			"queue": self.name,
+			"capacity": self.maxsize,
+			"items": self.n_put,
+			"depth_mean": self.depth_sum / float( self.n_put ) if self.n_put > 0 else 0.0,
+			"depth_max": self.depth_max,
+			"producer_blocked_s": self.put_wait,
+			"consumer_waiting_s": self.get_wait
+		}
+
+def standardize_rows( values, out = None, chunksize = None ):
+	"""Row standardize (z-score) a 2D float array in one pass per block of rows.
+
+	NaN-aware. Matches pandas ( x - x.mean() ) / x.std() per row, ie ddof = 1 and NaN for rows 
+	with fewer than 2 observations. 'out' may be 'values' itself to standardize in place. Either 
+	may be a np.memmap. If 'chunksize' is given only that many rows are held in memory at once, 
+	so matrices that do not fit in memory can be standardized from/to disk."""
+	if out is None:
+		out = np.empty( values.shape, dtype = values.dtype )
+	n_rows = values.shape[ 0 ]
+	if chunksize is None or chunksize < 1:
+		chunksize = max( n_rows, 1 )
+	with np.errstate( invalid = "ignore", divide = "ignore" ):
+		for start in xrange( 0, n_rows, chunksize ):
+			# accumulate in float64 regardless of storage type
+			block = np.array( values[ start:start + chunksize ], dtype = np.float64 )
+			missing = np.isnan( block )
+			n = ( ~missing ).sum( axis = 1 ).astype( np.float64 )
+			block[ missing ] = 0
+			mean = block.sum( axis = 1 ) / n
+			block -= mean[ :, None ]
+			block[ missing ] = 0
+			std = np.sqrt( ( block * block ).sum( axis = 1 ) / ( n - 1 ) )
+			std[ n < 2 ] = np.nan
+			block /= std[ :, None ]
+			block[ missing ] = np.nan
+			out[ start:start + chunksize ] = block
+	return out
+
 class sql2mongoDB:
     
-	def __init__( self, organism = None, host = None, port = None, ensembledir = None, targetdir = None, prefix = None,ratios_raw = None, gre2motif = None, col_annot = None, ncbi_code = None, dbname = None , db_run_override = None, genome_file = None, row_annot = None, row_annot_match_col = None ):
+	def __init__( self, organism = None, host = None, port = None, ensembledir = None, targetdir = None, prefix = None,ratios_raw = None, gre2motif = None, col_annot = None, ncbi_code = None, dbname = None , db_run_override = None, genome_file = None, row_annot = None, row_annot_match_col = None, workers = None, resume = False, expression_layout = None, sqlite_indexes = None ):
 		
 		# connect to database
 		# make sure mongodb is running
@@ -83,6 +272,7 @@ class sql2mongoDB:
 		else:
 			print "Initializing MongoDB database: %s" % self.dbname
 		self.db = client[self.dbname]
+		self.registry = idRegistry( self.db )
 
 		# get db files in directory
 		if prefix is None:
@@ -127,6 +317,24 @@ class sql2mongoDB:
     		self.genome_file = genome_file
     		self.row_annot = row_annot
     		self.row_annot_match_col = row_annot_match_col
+    		if workers is None:
+    			# number of processes reading cMonkey runs
+    			self.workers = 1
+    		else:
+    			self.workers = workers
+    		# redo incomplete runs recorded in the ingest_manifest collection
+    		self.resume = resume
+    		if expression_layout is None:
+    			# "cells": one gene_expression document per (row, col). "columns": one gene_expression_cols document per col. "both"
+    			self.expression_layout = "cells"
+    		else:
+    			self.expression_layout = expression_layout
+    		if sqlite_indexes is None:
+    			# how to index cMonkey run databases for extraction, see runindex.MODES. building a sidecar
+    			# costs more than one unindexed read, so it pays off only for runs that are read repeatedly
+    			self.sqlite_indexes = "none"
+    		else:
+    			self.sqlite_indexes = sqlite_indexes
 
     		if len(self.db_files) < 1:
 	    		print "I cannot find any cMonkey SQLite databases in the current directory: %s\nMake sure 'ensembledir' variable points to the location of your cMonkey-2 ensemble results." % os.getcwd()
@@ -178,7 +386,8 @@ class sql2mongoDB:
 						# check for existence
 						run_name = i.split("/")[-2]
 						if ensemble_info_collection.find( { "run_name": run_name } ).count() > 0:
-							pass
+							if self.resume and not self.run_complete( run_name ):
+								to_keep.append( i )
 						else:
 							to_keep.append( i )
 					else:
@@ -188,22 +397,9 @@ class sql2mongoDB:
 		return to_keep
 
 	def get_run2id( self, dbfiles, db ):
-		"""make run2id"""
-		ensemble_info_collection = db.ensemble_info
-		run_name = []
-		run_id = []
-		for i in ensemble_info_collection.find():
-			run_name.append(i["run_name"])
-			run_id.append(i["run_id"])
-		for i in dbfiles:
-			if i.split("/")[-2] not in run_name:
-				run_name.append(i.split("/")[-2])
-				if len(run_id) > 0:
-					run_id.append(max(run_id)+1)
-				else:
-					run_id.append(0)
-		run_info =  pd.DataFrame( zip( run_id, run_name ), index = run_name, columns = [ "run_id", "run_name"] )
-		return run_info
+		"""make run2id. Runs are registered in the ID registry (see assemble/registry.py)"""
+		self.registry.allocate( "run", [ i.split("/")[-2] for i in dbfiles ] )
+		return self.registry.frame( "run" )
 
 	def check4existence( self, collection, document, key1 = None, value1 = None, key2 = None, value2 = None ):
 		if key1 == None:
@@ -216,6 +412,7 @@ class sql2mongoDB:
 		if d_check == 0:
 			return document
 
+	@instrumented()
 	def loadGenome (self, ncbi_code, genome_file):
 
 		if genome_file == None:
@@ -243,17 +440,18 @@ class sql2mongoDB:
 		genome_collection = self.db.genome
 
 		# Check whether documents are already present in the collection before insertion
-		if genome_collection.count() > 0:
-			seqs_f = filter( None, [ self.check4existence( genome_collection, i ) for i in seqs_b ] )
-		else:
-			seqs_f = seqs_b
+		seqs_f = filter_existing( genome_collection, seqs_b, [ "scaffoldId" ] )
 
 		print "%s new records to write" % len( seqs_f )
-		if len(seqs_f) > 0:
-			genome_collection.insert( seqs_f )
+		# sequences are stored packed, in chunks. see genome.genomeStore
+		store = genomeStore( self.db )
+		for i in seqs_f:
+			sequence = i.pop( "sequence" )
+			store.put( i.pop( "scaffoldId" ), sequence, **i )
 
 		return genome_collection
 	
+	@instrumented()
 	def loadRatios( self, file_in ):
 		"""Loads ratios from individual cMonkey runs (unfinished) or single flat file (gzip compressed)."""
 		if file_in == None:
@@ -262,42 +460,35 @@ class sql2mongoDB:
 			file_in = np.sort( np.array( glob.glob( ensembledir + prefix + "???/ratios.tsv.gz" ) ) )
 		else:
 			print "Loading gene expression file from %s" % file_in
-			# load directly from gzip file
-			ratios= pd.read_csv( gzip.open( file_in, 'rb' ), index_col=0, sep="\t" )
-			if ratios.shape[1] == 0:
-				# wrong delimiter? try comma
-				 ratios= pd.read_csv( gzip.open( file_in, 'rb' ), index_col=0, sep="," )
-			if ratios.shape[1] == 0:
-				# still wrong delimiter 
-				print "Cannot read ratios file. Check delimiter. Should be '\t' or ',' "
+			# parsed once, then memory mapped from the binary sidecar (see assemble/ratios.py)
+			ratios = load_ratios( file_in )
 		return ratios
 
-	def standardizeRatios( self, ratios ):
-		"""compute standardized ratios (global). row standardized"""
-		ratios_standardized = ratios.copy()
-		zscore = lambda x: ( x - x.mean() ) / x.std()
-		for row in ratios.iterrows():
-			ratios_standardized.loc[ row[0] ] = zscore( row[1] )
-		return ratios_standardized
+	@instrumented()
+	def standardizeRatios( self, ratios, inplace = False, chunksize = None ):
+		"""compute standardized ratios (global). row standardized
+
+		Same values as ( x - x.mean() ) / x.std() applied to each row. 'inplace' overwrites the
+		float values of 'ratios' rather than copying the matrix. 'chunksize' standardizes that many 
+		rows at a time (see standardize_rows)"""
+		values = ratios.values
+		if inplace and values.dtype in ( np.float32, np.float64 ):
+			standardize_rows( values, out = values, chunksize = chunksize )
+			if not np.may_share_memory( values, ratios.values ):
+				# frame was not backed by a single block. copy values back
+				ratios.loc[ :, : ] = values
+			return ratios
+		if values.dtype not in ( np.float32, np.float64 ):
+			values = values.astype( np.float64 )
+		ratios_standardized = standardize_rows( values, chunksize = chunksize )
+		return pd.DataFrame( ratios_standardized, index = ratios.index, columns = ratios.columns )
 
 	def get_row2id( self, ratios_standardized, db ):
-		"""make row2id and id2row dicts for lookup"""
-		row_info_collection = db.row_info
-		row_name = []
-		row_id = []
-		for i in row_info_collection.find():
-			row_name.append( i["egrin2_row_name"] )
-			row_id.append( i["row_id"] )
-		for i in ratios_standardized.index.values:
-			if i not in row_name:
-				row_name.append( i )
-			if len(row_id) > 0:
-				row_id.append( max(row_id)+1 )
-			else:
-				row_id.append(0)
-		row_info =  pd.DataFrame( zip(row_id, row_name), index = row_name, columns = [ "row_id", "egrin2_row_name"] )
-		return row_info
+		"""make row2id lookup table. Rows are registered in the ID registry (see assemble/registry.py)"""
+		self.registry.allocate( "row", ratios_standardized.index.values )
+		return self.registry.frame( "row" )
 
+	@instrumented()
 	def insert_row_info( self, ncbi_code, row_info, row_annot, row_annot_match_col ):
 		"""
 		Insert row_info into mongoDB database
@@ -339,6 +530,9 @@ class sql2mongoDB:
 			    	row_table = row_info
 	    	else:
 			row_annot = pd.read_csv( open( row_annot, 'rb' ), sep="\t" )	
+			left_on="egrin2_row_name"
+			if row_annot_match_col == None:
+				row_annot_match_col="sysName"
 			# join with row_annot
 		    	row_table = pd.merge( row_info, row_annot, left_on=left_on, right_on=row_annot_match_col )	
 
@@ -347,10 +541,7 @@ class sql2mongoDB:
 		# Check whether documents are already present in the collection before insertion
 		d = row_table.to_dict( 'records' )
 
-		if row_info_collection.count() > 0:
-			d_f = filter( None, [ self.check4existence( row_info_collection, i ) for i in d ] )
-		else:
-			d_f = d
+		d_f = filter_existing( row_info_collection, d, [ "egrin2_row_name" ] )
 
 		print "%s new records to write" % len( d_f )
 
@@ -360,23 +551,11 @@ class sql2mongoDB:
 		return row_info_collection
 
 	def get_col2id( self, ratios_standardized, db ):
-		"""make cond2id and id2cond dicts for lookup"""
-		col_info_collection = db.col_info
-		col_name = []
-		col_id = []
-		for i in col_info_collection.find():
-			col_name.append(i["egrin2_col_name"])
-			col_id.append(i["col_id"])
-		for i in ratios_standardized.columns.values:
-	    		if i not in col_name:
-	    			col_name.append( i )
-	    			if len(col_id) > 0:
-					col_id.append(max(col_id)+1)
-				else:
-					col_id.append(0)
-	    	col_info =  pd.DataFrame( zip( col_id, col_name ), index = col_name, columns = [ "col_id", "egrin2_col_name"] )
-	    	return col_info
+		"""make col2id lookup table. Cols are registered in the ID registry (see assemble/registry.py)"""
+		self.registry.allocate( "col", ratios_standardized.columns.values )
+		return self.registry.frame( "col" )
 
+	@instrumented()
 	def insert_col_info( self, col_info, col_annot ):
 		"""
 		Insert col_info into mongoDB database
@@ -399,18 +578,13 @@ class sql2mongoDB:
 			col_table = pd.merge( col_info, col_annot, left_on="egrin2_col_name", right_on="experiment_name" )
 		else:
 			col_table = col_info
-		col_info_4_mongoDB = []
-		for i in range( 0, len( col_info.egrin2_col_name ) ):
-			col_info_4_mongoDB.append( self.condInfo2Dict( col_table, col_info.egrin2_col_name[i] ) )
+		col_info_4_mongoDB = self.col_info_documents( col_info, col_table )
 		
 		# write to mongoDB collection 
 		col_info_collection = self.db.col_info
 		
 		# Check whether documents are already present in the collection before insertion
-		if col_info_collection.count() > 0:
-			d_f = filter( None, [ self.check4existence( col_info_collection, i ) for i in col_info_4_mongoDB ] )
-		else:
-			d_f = col_info_4_mongoDB
+		d_f = filter_existing( col_info_collection, col_info_4_mongoDB, [ "egrin2_col_name" ] )
 		
 		print "%s new records to write" % len( d_f )
 
@@ -419,13 +593,24 @@ class sql2mongoDB:
 
 		return col_info_collection
 	    	 	
-	def condInfo2Dict( self, col_table, cond_name):
-		cond_data = col_table[col_table.egrin2_col_name==cond_name]
-		cond_dict = { "col_id": np.unique( cond_data.col_id )[0], "egrin2_col_name": np.unique( cond_data.egrin2_col_name )[0], "additional_info": [] }
-		if "feature_name" in cond_data.columns and "value" in cond_data.columns and "feature_units" in cond_data.columns:
-			for i in range(0,cond_data.shape[0]):
-				cond_dict[ "additional_info" ].append( { "name": cond_data.irow(i)["feature_name" ], "value": cond_data.irow(i)["value"], "units": cond_data.irow(i)["feature_units"] } )
-		return cond_dict
+	def col_info_documents( self, col_info, col_table ):
+		"""col_info documents, one per condition in 'col_info' and in its order, built in one groupby pass.
+
+		The feature_name, value and feature_units columns of 'col_table' (col_info merged with the 
+		annotations) become the condition's 'additional_info' triples, in table order. Conditions 
+		without annotations get an empty 'additional_info'."""
+		docs = [ { "col_id": i, "egrin2_col_name": j, "additional_info": [] } for i, j in zip( col_info.col_id.tolist(), col_info.egrin2_col_name.tolist() ) ]
+		if not all( [ i in col_table.columns for i in [ "feature_name", "value", "feature_units" ] ] ) or col_table.shape[ 0 ] == 0:
+			return docs
+		position = dict( [ ( j[ "egrin2_col_name" ], i ) for i, j in enumerate( docs ) ] )
+		# convert each column once, to python types
+		names = col_table.feature_name.values.tolist()
+		values = col_table[ "value" ].values.tolist()
+		units = col_table.feature_units.values.tolist()
+		for cond, idx in col_table.groupby( "egrin2_col_name", sort = False ).indices.items():
+			if cond in position:
+				docs[ position[ cond ] ][ "additional_info" ] = [ { "name": names[ i ], "value": values[ i ], "units": units[ i ] } for i in idx ]
+		return docs
 
 	def parseRatios( self, ratios_files ):
 		"""Compile ratios from available runs. Note that each run stores only the ratios that were used for that run."""
@@ -439,45 +624,90 @@ class sql2mongoDB:
 		# 		rats_df = rats_df + new_df
 		# 	i = i+1 
 
-	def insert_gene_expression( self, db, row2id, col2id, ratios, ratios_standardized ):
+	@instrumented()
+	def insert_gene_expression( self, db, row2id, col2id, ratios, ratios_standardized, batch_size = 10000 ):
 		"""
 		Insert gene_expression into mongoDB database
 
+		Documents are built a block of rows at a time from the flattened (melted) matrices and 
+		streamed to MongoDB in unordered batches of 'batch_size'. (row_id, col_id) pairs already in 
+		the collection are skipped.
 
 		example queries
 		------------------------------
 
 		"""
-		exp_data = []
-		counter = 0
-		for i in ratios.index.values:
-			if counter%200 == 0:
-				print "%s percent done" % round( ( float(counter)/ratios.shape[0] )*100,1 )
-			for j in ratios.columns.values:
-				exp_data.append(
-					{
-				    	"row_id": row2id.loc[i].row_id,
-				    	"col_id": col2id.loc[j].col_id,
-			 		"raw_expression": ratios.loc[i,j],
-			 		"standardized_expression": ratios_standardized.loc[i,j]
-				    	} )
-			counter = counter + 1
+		row_ids = row2id.loc[ ratios.index.values ].row_id.values.astype( np.int64 )
+		col_ids = col2id.loc[ ratios.columns.values ].col_id.values.astype( np.int64 )
+		raw = ratios.values
+		standardized = ratios_standardized.loc[ ratios.index, ratios.columns ].values
 
 		# write to mongoDB collection 
 		gene_expression_collection = db.gene_expression
-		
+
 		# Check whether documents are already present in the collection before insertion
-		if gene_expression_collection.count() > 0:
-			d_f = filter( None, [ self.check4existence( gene_expression_collection, i ) for i in exp_data ] )
-		else:
-			d_f = exp_data 
+		# pairs are encoded as single integers ( row_id << 32 | col_id ) so membership can be tested with np.in1d.
+		# the cursor is streamed into one preallocated array, never held as documents
+		existing = None
+		n_existing = gene_expression_collection.count()
+		if n_existing > 0:
+			existing = np.empty( n_existing, dtype = np.int64 )
+			n = 0
+			for i in gene_expression_collection.find( {}, { "_id": 0, "row_id": 1, "col_id": 1 } ).batch_size( batch_size ):
+				if n == n_existing:
+					# inserted meanwhile
+					break
+				existing[ n ] = ( int( i[ "row_id" ] ) << 32 ) | int( i[ "col_id" ] )
+				n = n + 1
+			existing = np.unique( existing[ :n ] )
+
+		chunk = max( 1, batch_size / max( len( col_ids ), 1 ) )
+		written = 0
+		for start in xrange( 0, len( row_ids ), chunk ):
+			print "%s percent done" % round( ( float( start )/len( row_ids ) )*100, 1 )
+			r = np.repeat( row_ids[ start:start + chunk ], len( col_ids ) )
+			c = np.tile( col_ids, len( row_ids[ start:start + chunk ] ) )
+			x = raw[ start:start + chunk ].ravel()
+			y = standardized[ start:start + chunk ].ravel()
+			if existing is not None:
+				keep = ~np.in1d( ( r << 32 ) | c, existing )
+				r, c, x, y = r[ keep ], c[ keep ], x[ keep ], y[ keep ]
+			docs = ( { "row_id": i[ 0 ], "col_id": i[ 1 ], "raw_expression": i[ 2 ], "standardized_expression": i[ 3 ] } for i in itertools.izip( r.tolist(), c.tolist(), x.tolist(), y.tolist() ) )
+			written = written + insert_batches( gene_expression_collection, docs, batch_size )
+
+		print "%s new records written" % written
 
-		print "%s new records to write" % len( d_f )
+		return gene_expression_collection
 
-		if len(d_f) > 0:
-			gene_expression_collection.insert( d_f )
+	@instrumented()
+	def insert_gene_expression_columns( self, db, row2id, col2id, ratios, ratios_standardized, batch_size = 100 ):
+		"""
+		Insert gene expression into the columnar gene_expression_cols collection
 
-		return gene_expression_collection
+		One document per col_id holds the packed row_ids (int32) and raw and standardized 
+		values (float64) of all rows, in ascending row_id order. Columns already in the 
+		collection are skipped. Read with query.egrin2_query.expressionRecords.
+		"""
+		row_ids = row2id.loc[ ratios.index.values ].row_id.values.astype( np.int64 )
+		col_ids = col2id.loc[ ratios.columns.values ].col_id.values.astype( np.int64 )
+		order = np.argsort( row_ids, kind = "mergesort" )
+		row_ids = row_ids[ order ]
+		raw = ratios.values[ order ]
+		standardized = ratios_standardized.loc[ ratios.index, ratios.columns ].values[ order ]
+
+		gene_expression_cols_collection = db.gene_expression_cols
+
+		existing = set()
+		if gene_expression_cols_collection.count() > 0:
+			existing = set( gene_expression_cols_collection.distinct( "col_id" ) )
+
+		packed_rows = packArray( row_ids, "<i4" )
+		docs = ( { "col_id": int( col_ids[ i ] ), "n_rows": len( row_ids ), "row_ids": packed_rows, "raw_expression": packArray( raw[ :, i ] ), "standardized_expression": packArray( standardized[ :, i ] ) } for i in xrange( len( col_ids ) ) if col_ids[ i ] not in existing )
+		written = insert_batches( gene_expression_cols_collection, docs, batch_size )
+
+		print "%s new columns written" % written
+
+		return gene_expression_cols_collection
 
 	def assemble_ensemble_info( self, db_file, run2id, row2id, col2id ):
 		"""Create python ensemble_info dictionary for bulk import into MongoDB collections"""  
@@ -510,157 +740,202 @@ class sql2mongoDB:
 	    	conn.close()
 	    	return d
 
+	def assemble_ensemble_infos( self, db_files, run2id, row2id, col2id ):
+		"""ensemble_info documents of all runs, as assemble_ensemble_info builds them, with three
+		ensemble-wide queries per batch of attached runs (see federation.runFederation)"""
+		fed = runFederation( db_files )
+		names = { "rows": {}, "cols": {} }
+		info = {}
+		for conn, runs in fed.batches():
+			for i in conn.execute( "SELECT run_name, start_time, finish_time, num_iterations, organism, species, num_rows, num_columns, num_clusters, git_sha FROM all_run_infos ORDER BY src_rowid;" ):
+				info.setdefault( i[ 0 ], i[ 1: ] )
+			for key, table in [ ( "rows", "all_row_names" ), ( "cols", "all_column_names" ) ]:
+				for run_name, name in conn.execute( "SELECT run_name, name FROM %s ORDER BY run_name, src_rowid;" % table ):
+					names[ key ].setdefault( run_name, [] ).append( str( name ) )
+		docs = []
+		for db_file in db_files:
+			run_name = db_file.split("/")[-2]
+			run_info = info[ run_name ]
+			docs.append( {
+			"run_id": run2id.loc[run_name].run_id,
+			"run_name": run_name,
+			"start_time": str( run_info[0] ),
+			"finish_time": str( run_info[1] ),
+			"num_iterations": int( run_info[2] ),
+			"organism": str( run_info[3] ),
+			"species": str( run_info[4] ),
+			"num_rows": int( run_info[5] ),
+			"rows": row2id.loc[ names[ "rows" ].get( run_name, [] ) ].row_id.tolist(),
+			"num_columns": int( run_info[6] ),
+			"cols": col2id.loc[ names[ "cols" ].get( run_name, [] ) ].col_id.tolist(),
+			"num_clusters": int( run_info[7] ),
+			"git_sha": str( run_info[8] ),
+			"added_to_ensemble": datetime.datetime.utcnow()
+			} )
+		return docs
+
+	@instrumented()
 	def insert_ensemble_info( self, db_files, db, run2id, row2id, col2id ):
 		"""Compile and insert ensemble_info collection into MongoDB collection"""
-		to_insert = [ self.assemble_ensemble_info( i, run2id, row2id, col2id ) for i in db_files ]
+		to_insert = self.assemble_ensemble_infos( db_files, run2id, row2id, col2id )
 		ensemble_info_collection = db.ensemble_info
 
 		# Check whether documents are already present in the collection before insertion
-		if ensemble_info_collection.count() > 0:
-			d_f = filter( None, [ self.check4existence( ensemble_info_collection, i, "run_name", i["run_name"] ) for i in to_insert ] )
-		else:
-			d_f = to_insert
+		d_f = filter_existing( ensemble_info_collection, to_insert, [ "run_name" ] )
 
 		print "%s new records to write" % len( d_f )
 
+		for i in d_f:
+			self.mark_stage( i[ "run_name" ], "ensemble_info", complete = False )
 		if len(d_f) > 0:
 			ensemble_info_collection.insert( d_f )
+		for i in to_insert:
+			self.mark_stage( i[ "run_name" ], "ensemble_info", 1 )
 
 		return ensemble_info_collection
 
- 	def loadGREMap( self, gre2motif ):
- 		if gre2motif is not None:
-	 		count = 1
-	 		mots = {}
-	 		with open(gre2motif, 'r') as f: 
-	 			for line in f:
-	 				# only consider motif clusters with > 3 motifs
-	 				if len( line.strip("\n").split( "\t" ) ) > 3:
-		 				for motif in line.strip("\n").split( "\t" ):
-		 					elements = motif.split("_")
-		 					# cluster
-		 					elements[1] = int(elements[1])
-		 					# motif_num
-		 					elements[2] = int(elements[2])
-		 					# elements[0] = run_name
-		 					if elements[0] in mots.keys():
-		 						if elements[1] in mots[elements[0]].keys():
-		 							mots[elements[0]][elements[1]][elements[2]] = count
-		 						else:
-		 							mots[elements[0]][elements[1]] = {}
-		 							mots[elements[0]][elements[1]][elements[2]] = count
-		 					else:
-								mots[elements[0]] = {}
-								mots[elements[0]][elements[1]] = {}
-								mots[elements[0]][elements[1]][elements[2]] = count
-						count = count + 1
-	 		return mots
+	def get_manifest( self, run_name ):
+		"""Ingest manifest of a run: which stages (see INGEST_STAGES) completed, with document counts"""
+		return self.db.ingest_manifest.find_one( { "run_name": run_name } )
+
+	def stage_complete( self, manifest, stage ):
+		return manifest is not None and manifest.get( "stages", {} ).get( stage, {} ).get( "complete", False )
+
+	def run_complete( self, run_name ):
+		"""All ingest stages of the run completed. Runs without a manifest (assembled before it existed) count as complete"""
+		manifest = self.get_manifest( run_name )
+		return manifest is None or all( [ self.stage_complete( manifest, i ) for i in INGEST_STAGES ] )
+
+	def mark_stage( self, run_name, stage, count = 0, complete = True ):
+		"""Record the start (complete = False) or completion of an ingest stage for a run in the ingest_manifest collection"""
+		self.db.ingest_manifest.update( { "run_name": run_name }, { "$set": { "run_id": int( self.run2id.loc[ run_name ].run_id ), "stages." + stage: { "complete": complete, "count": count, "updated": datetime.datetime.utcnow() } } }, upsert = True )
+
+	def rollback_run( self, run_name ):
+		"""Remove the documents of the first incomplete ingest stage of a run and of every later stage.
+
+		Later stages reference the documents of earlier ones (eg motif_info -> bicluster _id), so 
+		they are redone too. Returns the stages that were rolled back."""
+		manifest = self.get_manifest( run_name )
+		if manifest is None:
+			return []
+		incomplete = [ i for i in INGEST_STAGES if not self.stage_complete( manifest, i ) ]
+		if len( incomplete ) == 0:
+			return []
+		stages = INGEST_STAGES[ INGEST_STAGES.index( incomplete[ 0 ] ): ]
+		run_id = manifest[ "run_id" ]
+		cluster_ids = [ i[ "_id" ] for i in self.db.bicluster_info.find( { "run_id": run_id }, { "_id": 1 } ) ]
+		if "bicluster_info" in stages or "motif_info" in stages:
+			remove_run( self.db, run_id )
+		if "fimo" in stages:
+			self.db.fimo.remove( { "cluster_id": { "$in": cluster_ids } } )
+			self.db.fimo_small.remove( { "cluster_id": { "$in": cluster_ids } } )
+		if "motif_info" in stages:
+			self.db.motif_info.remove( { "cluster_id": { "$in": cluster_ids } } )
+		if "bicluster_info" in stages:
+			self.db.bicluster_info.remove( { "run_id": run_id } )
+		if "ensemble_info" in stages:
+			self.db.ensemble_info.remove( { "run_name": run_name } )
+		self.db.ingest_manifest.update( { "run_name": run_name }, { "$set": dict( [ ( "stages." + i, { "complete": False, "count": 0, "updated": datetime.datetime.utcnow() } ) for i in stages ] ) } )
+		print "Rolled back %s for run %s" % ( ", ".join( stages ), run_name )
+		return stages
+
+	def loadGREMap( self, gre2motif ):
+		"""run_name -> cluster -> motif_num -> gre_id. GRE ids come from the ID registry, where each GRE is named by its sorted member motifs"""
+		if gre2motif is not None:
+			gres = []
+			with open(gre2motif, 'r') as f: 
+				for line in f:
+					# only consider motif clusters with > 3 motifs
+					if len( line.strip("\n").split( "\t" ) ) > 3:
+						gres.append( line.strip("\n").split( "\t" ) )
+			gre_ids = self.registry.allocate( "gre", [ ",".join( sorted( i ) ) for i in gres ] )
+			mots = {}
+			for gre, gre_id in zip( gres, gre_ids.tolist() ):
+				for motif in gre:
+					elements = motif.split("_")
+					# elements[0] = run_name, elements[1] = cluster, elements[2] = motif_num
+					mots.setdefault( elements[0], {} ).setdefault( int( elements[1] ), {} )[ int( elements[2] ) ] = gre_id
+			return mots
 		else:
 			return None
 
-	def insert_bicluster_info( self, db, db_file, run2id, row2id, col2id ): 
-		"""Find all biclusters in a cMonkey run, process and add as documents to bicluster collection
-
-		example queries
-		------------------------------
+	def get_run_documents( self, db_file ):
+		"""Read a single cMonkey run (SQLite) and build its bicluster_info and motif_info documents.
 
-		bicluster_info_collection.find({"rows":{"$all":[26,27]}}).count()
+		Does not write to MongoDB, so it can run in a worker process. Returns ( biclusters, motifs )
+		where motifs maps cluster -> motif_info documents. Their 'cluster_id' is filled in by 
+		insert_run_documents once the bicluster _ids are known.
 		"""
-		# Get all biclusters from cmonkey run
-		conn = sqlite3.connect(db_file)
-	    	c = conn.cursor()
-	    	c.execute("SELECT max(iteration) FROM cluster_stats;")
-	    	last_run = c.fetchone()[0] # i think there is an indexing problem in cMonkey python!! 
-	    	w = (last_run,)
-	    	c.execute("SELECT cluster FROM cluster_stats WHERE iteration = ?;",w)
-		biclusters = [self.assemble_bicluster_info_single( db, db_file, c, last_run, i[0], run2id, row2id, col2id ) for i in c.fetchall()]
-		bicluster_info_collection = self.db.bicluster_info
-
-		# Check whether documents are already present in the collection before insertion
-		if bicluster_info_collection.count() > 0:
-			d_f = filter( None, [ self.check4existence( bicluster_info_collection, i, "run_id", i["run_id"], "cluster", i["cluster"] ) for i in biclusters ] )
-		else:
-			d_f = biclusters
-		
-
-		print "%s new records to write" % len( d_f )
-
-		if len(d_f) > 0:
-			bicluster_info_collection.insert( d_f )
-
-		return bicluster_info_collection
-
-	def assemble_bicluster_info_single( self, db, db_file, cursor, iteration, cluster, run2id, row2id, col2id ):
-		"""Create python ensemble_info dictionary for bulk import into MongoDB collections"""
-		#print cluster
 		run_name = db_file.split("/")[-2]
-	    	w = (cluster,iteration)
-	    	cursor.execute("SELECT residual FROM cluster_stats WHERE cluster = ? AND iteration = ?;", w )
-	    	residual = cursor.fetchone()[0]
-	    	cursor.execute("SELECT name FROM row_members JOIN row_names ON row_members.order_num = row_names.order_num WHERE row_members.cluster = ? AND row_members.iteration = ?;", w )
-	    	rows = [ row2id.loc[ str(i[0]) ].row_id for i in cursor.fetchall() ]
-	    	cursor.execute("SELECT name FROM column_members JOIN column_names ON column_members.order_num = column_names.order_num WHERE column_members.cluster = ? AND column_members.iteration = ?;", w )
-	    	cols = [ col2id.loc[ str(i[0]) ].col_id for i in cursor.fetchall() ]
-	    
-	    	d = {
-	    	"run_id": run2id.loc[run_name].run_id,
-	    	"cluster": cluster,
-	    	"rows": rows,
-	    	"columns": cols,
-	    	"residual": residual,
-	    	}
-
-	    	return d
-
-	def insert_motif_info( self, db, db_file, run2id, motif2gre, row_info_collection ): 
-		"""
-		"""
-		# Get all biclusters from cmonkey run
-		conn = sqlite3.connect(db_file)
-	    	c = conn.cursor()
-	    	c.execute("SELECT max(iteration) FROM cluster_stats;")
-	    	last_run = c.fetchone()[0] # i think there is an indexing problem in cMonkey python!! 
-	    	w = (last_run,)
-	    	
-	    	c.execute("SELECT cluster FROM cluster_stats WHERE iteration = ?;",w)
-		d_f = [ self.assemble_motif_info_single( db, db_file, c, last_run, i[ 0 ], run2id, motif2gre, row_info_collection )  for i in c.fetchall() ]
-		d_f = list( itertools.chain( *d_f ) ) 
-		d_f = filter( None, d_f )
-
-	    	if len(d_f) > 0:
-	    		db.motif_info.insert( d_f )
-	    	
-	    	return None
-
-    	def assemble_motif_info_single( self, db, db_file, cursor, iteration, cluster, run2id, motif2gre, row_info_collection ):
-    		
-    		run_name = db_file.split("/")[-2]
-    		cluster_id = list( db.bicluster_info.find( { "run_id": run2id.loc[ run_name ].run_id, "cluster": cluster}, { "_id":1 } ) )
-    		if len(cluster_id) > 1:
-    			print "Cluster %s from run %s matches more than one entry in MongoDB. You have a problem. Refusing to add motif_info." % ( cluster,run_name )
-    			return None
-		else:
-			cluster_id = ObjectId( cluster_id[ 0 ][ "_id" ] )
-    		
-	    	w = (cluster,iteration)
-    		cursor.execute("SELECT motif_num FROM motif_infos WHERE cluster = ? AND iteration = ?;", w )
-	    	motif_nums = [ i[0] for i in cursor.fetchall() ]
-
-    		motif_info = [ self.get_motif_info_single( db, cursor, iteration, run_name, cluster, i, motif2gre, row_info_collection, cluster_id) for i in motif_nums ]
-    		
-    		return motif_info
-
-	def get_motif_info_single( self, db, cursor, iteration, run_name, cluster, motif_num, motif2gre, row_info_collection, cluster_id):
-		w = (cluster, iteration, motif_num)
-		cursor.execute("SELECT seqtype, evalue FROM motif_infos WHERE cluster = ? AND iteration = ? AND motif_num = ?;", w )
-		motif_data = cursor.fetchone()
-		cursor.execute("SELECT meme_motif_sites.rowid FROM meme_motif_sites JOIN motif_infos ON meme_motif_sites.motif_info_id = motif_infos.rowid WHERE motif_infos.cluster = ? AND motif_infos.iteration = ? AND motif_infos.motif_num = ?;", w )
-		meme_site = [ i[0] for i in cursor.fetchall()]
-		cursor.execute("SELECT row FROM motif_pssm_rows JOIN motif_infos ON motif_pssm_rows.motif_info_id = motif_infos.rowid WHERE motif_infos.cluster = ? AND motif_infos.iteration = ? AND motif_infos.motif_num = ?;", w )
-		rows = [ i[0] for i in cursor.fetchall()]
-
+		run_id = self.run2id.loc[ run_name ].run_id
+		conn, tables = open_run( db_file, self.sqlite_indexes )
+		run = self.extract_run( conn.cursor(), tables )
+		conn.close()
+
+		row2id = dict( zip( self.row2id.index, self.row2id.row_id.tolist() ) )
+		col2id = dict( zip( self.col2id.index, self.col2id.col_id.tolist() ) )
+
+		# translate all MEME site accessions in the run at once
+		accessions = list( set( [ j[ 0 ] for i in run[ "meme_motif_sites" ].values() for j in i ] ) )
+		accessions = dict( zip( accessions, zip( *self.resolve_accessions( accessions ) ) ) )
+
+		biclusters = []
+		motifs = {}
+		for cluster, residual in run[ "clusters" ]:
+			biclusters.append( {
+			"run_id": run_id,
+			"cluster": cluster,
+			"rows": [ row2id[ str( i ) ] for i in run[ "rows" ].get( cluster, [] ) ],
+			"columns": [ col2id[ str( i ) ] for i in run[ "columns" ].get( cluster, [] ) ],
+			"residual": residual,
+			} )
+			motifs[ cluster ] = [ self.motif_info_document( run_name, cluster, i, run[ "meme_motif_sites" ].get( i[ 0 ], [] ), run[ "pssms" ].get( i[ 0 ], [] ), accessions ) for i in run[ "motifs" ].get( cluster, [] ) ]
+		return biclusters, motifs
+
+	def extract_run( self, cursor, tables = None ):
+		"""Pull the last iteration of a cMonkey run with one query per table. Results are grouped in memory.
+
+		'tables' maps the tables in runindex.INDEXED_TABLES to the tables to read them from, eg 
+		their indexed copies in a sidecar (see runindex.open_run).
+
+		Returns a dictionary with 'iteration', 'clusters' [ ( cluster, residual ) ], and dictionaries
+		'rows' and 'columns' (cluster -> member names), 'motifs' (cluster -> [ ( motif_info_id, 
+		motif_num, seqtype, evalue ) ]), 'meme_motif_sites' (motif_info_id -> [ ( seq_name, reverse, 
+		start, pvalue ) ]) and 'pssms' (motif_info_id -> [ ( row, a, c, g, t ) ])."""
+		def group( records ):
+			grouped = {}
+			for i in records:
+				grouped.setdefault( i[ 0 ], [] ).append( i[ 1 ] if len( i ) == 2 else i[ 1: ] )
+			return grouped
+
+		if tables is None:
+			tables = dict( [ ( i, i ) for i in INDEXED_TABLES ] )
+
+		cursor.execute("SELECT max(iteration) FROM %(cluster_stats)s AS cluster_stats;" % tables)
+		last_run = cursor.fetchone()[0] # i think there is an indexing problem in cMonkey python!! 
+		w = (last_run,)
+		run = { "iteration": last_run }
+		cursor.execute( "SELECT cluster, residual FROM %(cluster_stats)s AS cluster_stats WHERE iteration = ? ORDER BY +rowid;" % tables, w )
+		run[ "clusters" ] = cursor.fetchall()
+		cursor.execute( "SELECT row_members.cluster, row_names.name FROM %(row_members)s AS row_members JOIN row_names ON row_members.order_num = row_names.order_num WHERE row_members.iteration = ? ORDER BY +row_members.rowid;" % tables, w )
+		run[ "rows" ] = group( cursor.fetchall() )
+		cursor.execute( "SELECT column_members.cluster, column_names.name FROM %(column_members)s AS column_members JOIN column_names ON column_members.order_num = column_names.order_num WHERE column_members.iteration = ? ORDER BY +column_members.rowid;" % tables, w )
+		run[ "columns" ] = group( cursor.fetchall() )
+		cursor.execute( "SELECT cluster, rowid, motif_num, seqtype, evalue FROM %(motif_infos)s AS motif_infos WHERE iteration = ? ORDER BY +rowid;" % tables, w )
+		run[ "motifs" ] = group( cursor.fetchall() )
+		cursor.execute( "SELECT meme_motif_sites.motif_info_id, meme_motif_sites.seq_name, meme_motif_sites.reverse, meme_motif_sites.start, meme_motif_sites.pvalue FROM %(meme_motif_sites)s AS meme_motif_sites JOIN %(motif_infos)s AS motif_infos ON meme_motif_sites.motif_info_id = motif_infos.rowid WHERE motif_infos.iteration = ? ORDER BY +meme_motif_sites.rowid;" % tables, w )
+		run[ "meme_motif_sites" ] = group( cursor.fetchall() )
+		cursor.execute( "SELECT motif_pssm_rows.motif_info_id, motif_pssm_rows.row, motif_pssm_rows.a, motif_pssm_rows.c, motif_pssm_rows.g, motif_pssm_rows.t FROM %(motif_pssm_rows)s AS motif_pssm_rows JOIN %(motif_infos)s AS motif_infos ON motif_pssm_rows.motif_info_id = motif_infos.rowid WHERE motif_infos.iteration = ? ORDER BY +motif_pssm_rows.rowid;" % tables, w )
+		run[ "pssms" ] = group( cursor.fetchall() )
+		return run
+
+	def motif_info_document( self, run_name, cluster, motif, sites, pssm, accessions, cluster_id = None ):
+		"""Build a motif_info document from a motif_infos record ( motif_info_id, motif_num, seqtype, evalue ) and its sites and PSSM rows.
+
+		'accessions' maps site seq_names to ( row_id, scaffoldId ), see resolve_accessions"""
+		motif_num = motif[ 1 ]
 		try:
-			gre_id = motif2gre[run_name][cluster][motif_num] 
+			gre_id = self.motif2gre[run_name][cluster][motif_num] 
 		except:
 			gre_id = "NaN"
 
@@ -668,111 +943,293 @@ class sql2mongoDB:
 		"cluster_id": cluster_id,
 		"gre_id": gre_id,
 		"motif_num": motif_num,
-		"seqtype": motif_data[0],
-		"evalue": motif_data[1],
-		"meme_motif_site": [self.get_meme_motif_site_single( cursor, iteration, run_name, cluster, motif_num, i, row_info_collection ) for i in meme_site],
-		"pwm": [self.get_pwm_single( cursor, iteration, run_name, cluster, motif_num, i, row_info_collection ) for i in rows]
+		"seqtype": motif[ 2 ],
+		"evalue": motif[ 3 ],
+		"meme_motif_site": [ self.meme_motif_site_document( i, accessions[ i[ 0 ] ] ) for i in sites ],
+		"pwm": [ { "row": i[ 0 ], "a": i[ 1 ], "c": i[ 2 ], "g": i[ 3 ], "t": i[ 4 ] } for i in pssm ]
 		}
 		return d
 
-	def get_meme_motif_site_single( self, cursor, iteration, run_name, cluster, motif_num, rowid, row_info_collection ):
-		w = (str(rowid),)
-		cursor.execute("SELECT seq_name, reverse, start, pvalue, flank_left, seq, flank_right FROM meme_motif_sites WHERE rowid = ?", w )
-		data = cursor.fetchone()
-
-		# try to match accession to row_id
-		try:
-			row_id = row_info_collection.find( { "accession" : data[0] } )[0]["row_id"] #translate from accession to row_id, requires microbes online
-		except:
-			row_id = "NaN"
-
-		try:
-			scaffoldId = row_info_collection.find( { "accession" : data[0] } )[0]["scaffoldId"]
-		except:
-			scaffoldId = "NaN"
-
+	def meme_motif_site_document( self, site, translation ):
+		"""Build a MEME motif site from a meme_motif_sites record ( seq_name, reverse, start, pvalue ) and its ( row_id, scaffoldId )"""
 		d = {
-		"row_id": row_id,
-		"reverse": data[1],
-		"scaffoldId": scaffoldId,
-		"start": data[2],
+		"row_id": translation[ 0 ],
+		"reverse": site[1],
+		"scaffoldId": translation[ 1 ],
+		"start": site[2],
 		# do not store this info
 		# anb 01/22/2015
-		# "flank_left": data[4],
-		# "seq": data[5],
-		# "flank_right": data[6]
-		"pvalue": data[3],
+		# "flank_left",
+		# "seq",
+		# "flank_right"
+		"pvalue": site[3],
 		}
 		return d
 
-	def get_pwm_single( self, cursor, iteration, run_name, cluster, motif_num, row, row_info_collection ):
-		w = (cluster, iteration, motif_num, row)
-		cursor.execute("SELECT row, a, c, g, t FROM motif_pssm_rows JOIN motif_infos ON motif_pssm_rows.motif_info_id = motif_infos.rowid WHERE motif_infos.cluster = ? AND motif_infos.iteration = ? AND motif_infos.motif_num = ? AND motif_pssm_rows.row = ?;", w )
-		data = cursor.fetchone()
+	def get_accession_lookup( self, row_info_collection ):
+		"""Make accession -> ( row_id, scaffoldId ) lookup table from row_info with a single query.
 
-		d = {
-		"row": data[0],
-		"a": data[1],
-		"c": data[2],
-		"g": data[3],
-		"t": data[4]
-		}
-		return d
+		Used to translate MEME motif sites. The first row_info document with an accession wins, 
+		missing fields are "NaN"."""
+		accession = []
+		row_id = []
+		scaffoldId = []
+		for i in row_info_collection.find( { "accession": { "$exists": True } }, { "_id": 0, "accession": 1, "row_id": 1, "scaffoldId": 1 } ):
+			accession.append( i[ "accession" ] )
+			row_id.append( i.get( "row_id", "NaN" ) )
+			scaffoldId.append( i.get( "scaffoldId", "NaN" ) )
+		lookup = pd.DataFrame( { "row_id": pd.Series( row_id, dtype = object ), "scaffoldId": pd.Series( scaffoldId, dtype = object ) } )
+		lookup.index = accession
+		return lookup[ ~lookup.index.duplicated() ]
+
+	def resolve_accessions( self, accessions ):
+		"""Translate accessions (eg MEME site seq_names) to lists of row_ids and scaffoldIds in one vectorized lookup. Unknown accessions are "NaN".
+
+		The lookup table is built once per session (self.accession_lookup) and shared with worker processes."""
+		if getattr( self, "accession_lookup", None ) is None:
+			self.accession_lookup = self.get_accession_lookup( self.db.row_info )
+		if len( accessions ) == 0:
+			return [], []
+		idx = self.accession_lookup.index.get_indexer( accessions )
+		found = idx >= 0
+		row_id = np.array( [ "NaN" ] * len( accessions ), dtype = object )
+		scaffoldId = np.array( [ "NaN" ] * len( accessions ), dtype = object )
+		row_id[ found ] = self.accession_lookup.row_id.values[ idx[ found ] ]
+		scaffoldId[ found ] = self.accession_lookup.scaffoldId.values[ idx[ found ] ]
+		return row_id.tolist(), scaffoldId.tolist()
+
+	def insert_run_documents( self, run_name, biclusters, motifs ):
+		"""Write the documents built by get_run_documents for one run and record them in the ingest manifest. 
+
+		Motifs are written for new biclusters, or for all biclusters of the run if its motif_info 
+		stage was rolled back (see rollback_run)."""
+		bicluster_info_collection = self.db.bicluster_info
+		run_id = self.run2id.loc[ run_name ].run_id
+		manifest = self.get_manifest( run_name )
+		redo_motifs = manifest is not None and not self.stage_complete( manifest, "motif_info" )
 
-	def assemble_fimo( self ):
+		# Check whether documents are already present in the collection before insertion
+		d_f = filter_existing( bicluster_info_collection, biclusters, [ "run_id", "cluster" ], { "run_id": run_id } )
 
-		def get_fimo_scans_single( i, db, ensembledir, run2id ):
-			cluster = i.cluster
-			run_name =run2id[ run2id[ "run_id" ]==i.run_id ][ "run_name" ][ 0 ]
-			cluster_id = i._id
-			try:
-				# get all fimo scans in the dir
-				f = ensembledir + run_name + "/fimo-outs/fimo-out-" + "%04d" % (cluster,) + ".bz2" 
-				#print motif_num
-
-				fimo = pd.read_csv( f, sep="\t", compression = "bz2" )
-				# change sequence_name to scaffoldId
-				fimo.rename(columns={'matched sequence': 'matched_sequence', 'sequence name': 'scaffoldId', "#pattern name": "motif_num"}, inplace=True)
-
-				trans_d = {}
-				for i in np.unique(fimo.scaffoldId):
-					NCBI_RefSeq = "_".join(i.split('.')[-2].split("_")[::-1][0:2][::-1])
-					scaffoldId = db.genome.find_one( { "NCBI_RefSeq": NCBI_RefSeq } )["scaffoldId"]
-					trans_d[i] = scaffoldId
-
-				trans_v = [trans_d[i] for i in fimo.scaffoldId.values]
-				fimo.scaffoldId = trans_v
-				fimo["cluster_id"] = cluster_id
-				#fimo["cluster"] = cluster
-
-				# only keep specific columns
-				fimo = fimo.loc[ : , [ 'scaffoldId', 'start', 'stop', 'strand', 'score', 'p-value', 'in_coding_rgn', 'cluster_id', 'motif_num' ] ]
-				# only store hits with p-value lte 1e-5
-				fimo = fimo.loc[ fimo[ "p-value" ] <= 1e-5, ]
-
-				d_f = fimo.to_dict( 'records' )
-
-
-				db.fimo.insert( d_f )
-
-				# insert into fimo_small only if the motif maps to a GRE and the pval is less than 1e-5
-
-				mot2gre = pd.DataFrame( list( db.motif_info.find( { "cluster_id": cluster_id },{ "motif_num": 1,"gre_id":1 } ) ) )
-				#print mot2gre
-				for x in range( mot2gre.shape[ 0 ] ):
-					#print "Doing fimo_small! : %s" % x
-					if mot2gre.iloc[ x ].gre_id != "NaN":
-						tmp_fimo = fimo.loc[ fimo[ "motif_num" ] == mot2gre.iloc[ x ].motif_num, ]
-						d_f = tmp_fimo.to_dict( 'records' )
-						db.fimo_small.insert( d_f )
-		    		return None
-			except Exception:
-				return None
+		print "%s new records to write" % len( d_f )
 
-		# get all biclusters
-		bcs = pd.DataFrame( list( self.db.bicluster_info.find( {}, { "cluster" : 1, "run_id": 1 } ) ) )
-		tmp = bcs.apply( get_fimo_scans_single, axis=1, db = self.db, ensembledir = self.ensembledir, run2id = self.run2id  )
-		return None
+		self.mark_stage( run_name, "bicluster_info", complete = False )
+		if len(d_f) > 0:
+			bicluster_info_collection.insert( d_f )
+		self.mark_stage( run_name, "bicluster_info", bicluster_info_collection.find( { "run_id": run_id } ).count() )
+
+		if redo_motifs:
+			d_f = biclusters
+		self.mark_stage( run_name, "motif_info", complete = False )
+		cluster2id = dict( [ ( i[ "cluster" ], i[ "_id" ] ) for i in bicluster_info_collection.find( { "run_id": run_id }, { "cluster": 1 } ) ] )
+		to_insert = []
+		for i in d_f:
+			for j in motifs.get( i[ "cluster" ], [] ):
+				j[ "cluster_id" ] = cluster2id[ i[ "cluster" ] ]
+				to_insert.append( j )
+		if len( to_insert ) > 0:
+			self.db.motif_info.insert( to_insert )
+		self.mark_stage( run_name, "motif_info", self.db.motif_info.find( { "cluster_id": { "$in": cluster2id.values() } } ).count() )
+
+		return bicluster_info_collection
+
+	def _ingest_run( self, db_file ):
+		try:
+			biclusters, motifs = self.get_run_documents( db_file )
+			return db_file, biclusters, motifs, None
+		except Exception as e:
+			return db_file, None, None, "%s: %s" % ( type( e ).__name__, e )
+
+	@instrumented()
+	def ingest_pipeline( self, db_files, workers = None, writers = 2, run_queue = None, fimo_queue = None, write_queue = None, pval_cutoff = 1e-5, batch_size = 10000, chunksize = 100000 ):
+		"""Add biclusters, motifs and FIMO scans of each cMonkey run in one pipelined pass.
+
+		Stages are connected by bounded queues, so a slow stage holds back the ones before it and 
+		memory stays capped:
+
+			readers      a pool of 'workers' processes reads runs from SQLite and builds their bicluster 
+			             and motif documents (at most 'run_queue' runs read ahead, default workers + 1).
+			             With workers = 1 nothing is forked: a thread of this process reads the runs
+			run writer   this thread writes each run's biclusters and motifs (motifs need the bicluster 
+			             _ids), then hands the run's FIMO files to the same pool ('fimo_queue' files in 
+			             flight, default 16 * workers)
+			transformer  a thread turns parsed FIMO hits into fimo and fimo_small batches of 'batch_size'
+			writers      'writers' threads insert the batches ('write_queue' batches queued, default 2 * writers)
+
+		With workers = 1 the run writer parses the FIMO files itself. FIMO files of early runs are parsed 
+		while later runs are still being read. The fimo stage of a run is recorded in the ingest manifest 
+		once all of its batches are written. Depth metrics of each queue are printed and kept in 
+		self.queue_metrics. Returns the list of failed runs."""
+		if workers is None:
+			workers = self.workers
+		if run_queue is None:
+			run_queue = workers + 1
+		if fimo_queue is None:
+			fimo_queue = 16 * workers
+		if write_queue is None:
+			write_queue = 2 * writers
+
+		refseq2scaffold = dict( [ ( i[ "NCBI_RefSeq" ], i[ "scaffoldId" ] ) for i in self.db.genome.find( {}, { "NCBI_RefSeq": 1, "scaffoldId": 1 } ) ] )
+		if workers > 1:
+			pool = multiprocessing.Pool( processes = workers, initializer = _init_pipeline_worker, initargs = ( self, refseq2scaffold ) )
+		else:
+			_init_pipeline_worker( self, refseq2scaffold, connect = False )
+			pool = inlinePool()
+
+		runs = depthQueue( "runs", run_queue )
+		parsed = depthQueue( "fimo_files", fimo_queue )
+		batches = depthQueue( "write_batches", write_queue )
+		# the pool hides its own queues. slots bound what is submitted to it but not yet taken off 'runs' or 'parsed'
+		run_slots = threading.BoundedSemaphore( run_queue )
+		fimo_slots = threading.BoundedSemaphore( fimo_queue )
+
+		# run_name -> FIMO files not yet transformed, batches not yet written, rows written, failures
+		progress = {}
+		gre_motifs = {}
+		lock = threading.Lock()
+		failed = []
+		fimo_failed = []
+
+		def settle( run_name, files = 0, pending = 0, rows = 0, errors = 0 ):
+			with lock:
+				p = progress[ run_name ]
+				p[ "files" ] = p[ "files" ] + files
+				p[ "batches" ] = p[ "batches" ] + pending
+				p[ "rows" ] = p[ "rows" ] + rows
+				p[ "failed" ] = p[ "failed" ] + errors
+				done = p[ "files" ] == 0 and p[ "batches" ] == 0
+			if done:
+				# a run with unreadable FIMO files stays incomplete, to be redone on --resume
+				self.mark_stage( run_name, "fimo", p[ "rows" ], complete = p[ "failed" ] == 0 )
+
+		def read():
+			for db_file in db_files:
+				run_slots.acquire()
+				pool.apply_async( _ingest_run, ( db_file, ), callback = runs.put )
+
+		def transform():
+			buffers = {}
+			n = 0
+			expected = None
+			while expected is None or n < expected:
+				run_name, result = parsed.get()
+				if run_name is None:
+					# end of input: number of files submitted
+					expected = result
+					continue
+				fimo_slots.release()
+				n = n + 1
+				f, cluster_id, fimo, error = result
+				fimo_buffer, small_buffer = buffers.setdefault( run_name, ( [], [] ) )
+				try:
+					if fimo is None and error is not None:
+						fimo_failed.append( "%s (%s)" % ( f, error ) )
+						settle( run_name, errors = 1 )
+					elif fimo is not None:
+						fimo_buffer.extend( fimo.to_dict( 'records' ) )
+						small = fimo.loc[ fimo.motif_num.isin( list( gre_motifs.get( cluster_id, [] ) ) ), : ]
+						small_buffer.extend( small.to_dict( 'records' ) )
+				except Exception as e:
+					fimo_failed.append( "%s (%s: %s)" % ( f, type( e ).__name__, e ) )
+					settle( run_name, errors = 1 )
+				with lock:
+					last = progress[ run_name ][ "files" ] == 1
+				if len( fimo_buffer ) >= batch_size or len( small_buffer ) >= batch_size or last:
+					if len( fimo_buffer ) > 0 or len( small_buffer ) > 0:
+						settle( run_name, pending = 1 )
+						batches.put( ( run_name, fimo_buffer, small_buffer ) )
+					del buffers[ run_name ]
+				settle( run_name, files = -1 )
+
+		def write():
+			while True:
+				item = batches.get()
+				if item is None:
+					return
+				run_name, fimo_docs, small_docs = item
+				try:
+					insert_batches( self.db.fimo, fimo_docs, batch_size )
+					insert_batches( self.db.fimo_small, small_docs, batch_size )
+					settle( run_name, pending = -1, rows = len( fimo_docs ) )
+				except Exception as e:
+					print "WARNING: Could not insert FIMO hits of %s. %s: %s" % ( run_name, type( e ).__name__, e )
+					settle( run_name, pending = -1, errors = 1 )
+
+		threads = [ threading.Thread( target = read ), threading.Thread( target = transform ) ] + [ threading.Thread( target = write ) for i in range( writers ) ]
+		for i in threads:
+			# do not keep the interpreter alive if the run writer fails
+			i.daemon = True
+			i.start()
+
+		n_files = 0
+		t0 = time.time()
+		try:
+			for n in xrange( len( db_files ) ):
+				db_file, biclusters, motifs, error = runs.get()
+				run_slots.release()
+				print db_file
+				if error is not None:
+					print "WARNING: Could not read cMonkey run %s. Skipping it. %s" % ( db_file, error )
+					failed.append( db_file )
+					continue
+				run_name = db_file.split("/")[-2]
+				try:
+					self.bicluster_info_collection = self.insert_run_documents( run_name, biclusters, motifs )
+					tasks = self.get_fimo_tasks( run_name, motifs, gre_motifs, pval_cutoff, chunksize )
+				except Exception as e:
+					print "WARNING: Could not insert cMonkey run %s. Skipping it. %s: %s" % ( db_file, type( e ).__name__, e )
+					failed.append( db_file )
+					continue
+				if tasks is None:
+					continue
+				progress[ run_name ] = { "files": len( tasks ), "batches": 0, "rows": 0, "failed": 0 }
+				self.mark_stage( run_name, "fimo", complete = False )
+				if len( tasks ) == 0:
+					self.mark_stage( run_name, "fimo", 0 )
+				for task in tasks:
+					fimo_slots.acquire()
+					pool.apply_async( _parse_fimo, ( task, ), callback = lambda result, run_name = run_name: parsed.put( ( run_name, result ) ) )
+				n_files = n_files + len( tasks )
+			parsed.put( ( None, n_files ) )
+			threads[ 1 ].join()
+			for i in range( writers ):
+				batches.put( None )
+			for i in threads:
+				i.join()
+		finally:
+			pool.close()
+			pool.join()
+
+		elapsed = max( time.time() - t0, 1e-6 )
+		n_rows = sum( [ i[ "rows" ] for i in progress.values() ] )
+		print "%i runs, %i FIMO files, %i FIMO hits in %.1f s. %.0f rows/s" % ( len( db_files ) - len( failed ), n_files, n_rows, elapsed, n_rows / elapsed )
+		if len( fimo_failed ) > 0:
+			print "WARNING: Could not read %i FIMO files: %s" % ( len( fimo_failed ), ", ".join( fimo_failed ) )
+		if len( failed ) > 0:
+			print "%i of %i runs failed: %s" % ( len( failed ), len( db_files ), ", ".join( failed ) )
+		self.queue_metrics = [ dict( i.metrics(), stage = "ingest_pipeline" ) for i in ( runs, parsed, batches ) ]
+		print_queues( self.queue_metrics )
+		STATS.queues( "ingest_pipeline", self.queue_metrics )
+		return failed
+
+	def get_fimo_tasks( self, run_name, motifs, gre_motifs, pval_cutoff = 1e-5, chunksize = 100000 ):
+		"""FIMO parse tasks (see _parse_fimo) of the biclusters of a run that are not yet in the fimo collection.
+
+		Adds the motifs of each bicluster that map to a GRE to 'gre_motifs' (cluster_id -> motif_nums). 
+		Returns None if the fimo stage of the run is already complete."""
+		if self.stage_complete( self.get_manifest( run_name ), "fimo" ):
+			return None
+		run_id = self.run2id.loc[ run_name ].run_id
+		cluster2id = dict( [ ( i[ "cluster" ], i[ "_id" ] ) for i in self.db.bicluster_info.find( { "run_id": run_id }, { "cluster": 1 } ) ] )
+		done = set( self.db.fimo.find( { "cluster_id": { "$in": cluster2id.values() } }, { "cluster_id": 1 } ).distinct( "cluster_id" ) )
+		tasks = []
+		for cluster in sorted( cluster2id.keys() ):
+			cluster_id = cluster2id[ cluster ]
+			gre_motifs[ cluster_id ] = set( [ i[ "motif_num" ] for i in motifs.get( cluster, [] ) if i[ "gre_id" ] != "NaN" ] )
+			if cluster_id not in done:
+				f = self.ensembledir + run_name + "/fimo-outs/fimo-out-" + "%04d" % ( cluster, ) + ".bz2"
+				tasks.append( ( f, cluster_id, pval_cutoff, chunksize ) )
+		return tasks
 
 	def mongoDump( self, db, outfile, add_files = None ):
 		"""Write contents from MongoDB instance to binary file"""
@@ -798,8 +1255,13 @@ class sql2mongoDB:
 	def compile( self ):
 		"""Compile EGRIN2 ensemble"""
 		# print "Compiling EGRIN2 ensemble..."  
+		self.registry.migrate()
 		self.db_files = self.checkRuns( self.db_files, self.db_run_override, self.db )
 		self.run2id = self.get_run2id( self.db_files, self.db )
+		if self.resume:
+			print "Resuming. Rolling back partially ingested runs"
+			for i in self.db_files:
+				self.rollback_run( i.split("/")[-2] )
 
 		print "Downloading genome information for NCBI taxonomy ID:", self.ncbi_code
 		self.genome_collection = self.loadGenome( self.ncbi_code, self.genome_file )
@@ -817,32 +1279,25 @@ class sql2mongoDB:
 		self.col_info_collection = self.insert_col_info( self.col2id, self.col_annot )
 
 		print "Inserting gene expression into database"
-		self.gene_expression_collection = self.insert_gene_expression( self.db, self.row2id, self.col2id, self.expression, self.expression_standardized )
-		self.gene_expression_collection.ensure_index( "row_id" )
-		self.gene_expression_collection.ensure_index( "col_id" )
+		if self.expression_layout in [ "cells", "both" ]:
+			self.gene_expression_collection = self.insert_gene_expression( self.db, self.row2id, self.col2id, self.expression, self.expression_standardized )
+		if self.expression_layout in [ "columns", "both" ]:
+			self.gene_expression_cols_collection = self.insert_gene_expression_columns( self.db, self.row2id, self.col2id, self.expression, self.expression_standardized )
 
 		print "Inserting into ensemble_info collection"
 		self.ensemble_info_collection = self.insert_ensemble_info( self.db_files, self.db, self.run2id, self.row2id, self.col2id )
 		self.motif2gre = self.loadGREMap( self.gre2motif )
 
-		print "Inserting into bicluster collection"
-		for i in self.db_files:
-			print i
-			self.bicluster_info_collection = self.insert_bicluster_info( self.db, i, self.run2id, self.row2id, self.col2id )
-			self.insert_motif_info( self.db, i, self.run2id, self.motif2gre, self.row_info_collection ) 
-
-		print "Indexing bicluster collection"
-		self.bicluster_info_collection.ensure_index( "rows" )
-		self.bicluster_info_collection.ensure_index( "columns" )
-		self.db.motif_info.ensure_index( "cluster_id" )
-		self.db.motif_info.ensure_index( "gre_id" ) 
+		print "Inserting into bicluster, motif and fimo collections. This might take awhile..."
+		self.bicluster_info_collection = self.db.bicluster_info
+		self.accession_lookup = self.get_accession_lookup( self.row_info_collection )
+		self.ingest_pipeline( self.db_files, self.workers )
 
-		print "Inserting into fimo collection. This might take awhile..."
-		self.assemble_fimo( )
+		print "Indexing collections"
+		ensure_indexes( self.db )
 
-		print "Indexing fimo collection"
-		self.db.fimo.ensure_index( [ ( "scaffoldId", pymongo.ASCENDING ), ( "start", pymongo.ASCENDING ), ( "stop", pymongo.ASCENDING ),( "p-value", pymongo.ASCENDING ), ( "cluster_id", pymongo.ASCENDING ) ] ) 
-		self.db.fimo_small.ensure_index( [ ( "scaffoldId", pymongo.ASCENDING ), ( "start", pymongo.ASCENDING ), ( "stop", pymongo.ASCENDING ),( "p-value", pymongo.ASCENDING ), ( "cluster_id", pymongo.ASCENDING ) ] ) 
+		print "Counting biclusters per row, col and GRE"
+		update_counts( self.db )
 
 		#outfile =  self.prefix + str(datetime.datetime.utcnow()).split(" ")[0] + ".mongodump"
 
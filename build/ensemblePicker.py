@@ -31,6 +31,8 @@ from pymongo import MongoClient
 import gridfs
 from Bio import SeqIO
 
+from assemble.ratios import load_ratios
+
 # eg. how to run
 
 # from egrin2.ensemblePicker import *
@@ -94,7 +96,7 @@ class ensemblePicker:
 		    except AttributeError:
 		        return text
 
-		self.ratios = pd.read_csv( ratios, index_col=0, sep="," )
+		self.ratios = load_ratios( ratios )
 		self.blocks2col = pd.read_csv( blocks, sep=",", names=[ "sample", "block" ], converters = {'sample' : strip,
                                     'block' : strip,
                                     } ).icol( [0,1] )
@@ -12,30 +12,37 @@ __email__ = "brooksan@uw.edu"
 __status__ = "Development"
 
 import random
+import multiprocessing
 
 from pymongo import MongoClient
 import numpy as np
 import pandas as pd
 from scipy.stats import hypergeom
+from scipy.special import gammaln
 from statsmodels.sandbox.stats.multicomp import multipletests
 import itertools
-from bson.code import Code
 import matplotlib.pyplot as plt
 from scipy.cluster.hierarchy import linkage, dendrogram
 from scipy.spatial.distance import pdist, squareform
 
 from assemble.resample import *
+from assemble.registry import idRegistry
+from assemble.genome import genomeStore
+from assemble.counts import get_counts
+from assemble.packing import packArray, unpackArray, expressionRecords, EXPRESSION_FIELDS
+from query.session import egrin2Session, getSession
 
 def rsd( vals ):
 	return abs( np.std( vals ) / np.mean( vals ) )
 
-def check_colResamples( col, n_rows, n_resamples, host="localhost", port=27017, db="" ):
-	# connect to db
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' ) 
-	if client[db].col_resample.find_one( { "n_rows": n_rows, "col_id": col, "resamples": { "$gte": n_resamples } } ) is None:
-		client.close()
+def check_colResamples( col, n_rows, n_resamples, host="localhost", port=27017, db="", session = None ):
+	session = getSession( host, port, db, session )
+	if session.db.col_resample.find_one( { "n_rows": n_rows, "col_id": col, "resamples": { "$gte": n_resamples } } ) is None:
 		return col
-	client.close()
+
+def getRegistry( host="localhost", port=27017, db="", session = None ):
+	"""ID registry of database 'db', kept with the session for the life of the process. Call refresh( kind ) before use"""
+	return getSession( host, port, db, session ).registry
 
 def findMatch( x, df, return_field ):
 	print x
@@ -46,97 +53,66 @@ def findMatch( x, df, return_field ):
 		counter = counter + 1
 	return df.iloc[ counter ][ return_field ]
 
-def row2id( row, host="localhost", port=27017, db="",  verbose = False, return_field = "row_id" ):
-	"""Check name format of rows. If necessary, translate."""
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
-	query = list( client[db].row_info.find( { "$or": [ { "row_id": row }, { "egrin2_row_name": row }, { "GI": row }, { "accession": row }, { "name": row }, { "sysName": row } ] } ) )
-	client.close()
-	if len( query ) == 1: 
-		if return_field == "all":
-			row = query[0]
-		else:
-			try:
-				row = query[ 0 ][ return_field ]
-			except Exception:
-				row = query[ 0 ][ "row_id" ]
-		return row
-	elif len( query ) > 0:
-		print "ERROR: Multiple rows match the row name: %s" % row
-		if verbose:
-			print query
-		return None
-	else:
-		print "ERROR: Cannot identify row name: %s" % row
-		return None
+def row2id( row, host="localhost", port=27017, db="",  verbose = False, return_field = "row_id", session = None ):
+	"""Check name format of rows. If necessary, translate.
+
+	The name is looked up in the first identifier field that holds it, in the order row_id, egrin2_row_name, 
+	GI, accession, name, sysName. If it also matches another row through a later field (eg a number that 
+	is both a row_id and a GI) a warning is printed."""
+	return getSession( host, port, db, session ).translate( "row", [ row ], return_field, verbose = verbose )[ 0 ]
 
-def row2id_batch( rows, host="localhost", port=27017, db="",  verbose = True, return_field = "row_id", input_type = None ):
-	"""Check name format of rows. If necessary, translate."""
+def row2id_batch( rows, host="localhost", port=27017, db="",  verbose = True, return_field = "row_id", input_type = None, session = None ):
+	"""Check name format of rows. If necessary, translate.
+
+	Without 'input_type' the identifier type is detected from the names: the first of row_id, egrin2_row_name, 
+	GI, accession, name and sysName that holds all of them. Numeric names that are row_ids are therefore 
+	read as row_ids even if they are GIs too. A list of mixed types is translated name by name, each through 
+	the first field that holds it. Names that also match other rows through another field are translated 
+	anyway, with a warning; only names that match several rows in the field used become None. All lookups 
+	are in memory."""
 
 	if return_field == input_type:
 		return rows
-	
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
-	query = pd.DataFrame( list( client[db].row_info.find( { "$or": [ { "row_id": { "$in": rows } }, { "egrin2_row_name": { "$in": rows } }, { "GI": { "$in": rows } }, { "accession": {"$in": rows } }, { "name": { "$in": rows } }, { "sysName": { "$in": rows }  } ] }, { "row_id": 1, "egrin2_row_name": 1, "GI": 1, "accession" : 1, "name" : 1 } ) ) )
 
-	if input_type in [  "row_id", "egrin2_row_name", "GI", "accession", "name", "sysName" ]:
-		query = query.set_index(input_type)
-		to_r = query.loc[ rows ][ return_field ].tolist()
-	else:
-		#try to match input_type automatically
-		if verbose:
-			print "Reverting to translation by single matches. Defining 'input_type' will dramatically speed up query."
-		to_r= [ row2id( x, host, port, db, return_field = return_field ) for x in rows ]
+	session = getSession( host, port, db, session )
 
-	client.close()
-	
-	return to_r
-	
+	if input_type in [ "row_id", "egrin2_row_name" ] and return_field in [ "row_id", "egrin2_row_name" ]:
+		# translate in memory through the ID registry
+		registry = session.registry
+		registry.refresh( "row" )
+		if input_type == "row_id":
+			return registry.to_name( "row", rows )
+		return registry.to_id( "row", rows, missing = None ).tolist()
 
-def col2id( col, host="localhost", port=27017, db="",  verbose = False, return_field = "col_id" ):
-	"""Check name format of rows. If necessary, translate."""
+	return session.translate( "row", rows, return_field, input_type, verbose = verbose )
+	
 
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
-	query = list( client[db].col_info.find( { "$or": [ { "col_id": col }, { "egrin2_col_name": col } ] } ) )
-	client.close()
-	if len( query ) == 1: 
-		try:
-			col = query[ 0 ][ return_field ]
-		except Exception:
-			col = query[ 0 ][ "col_id" ]
-		return col
-	elif len( query ) > 0:
-		print "ERROR: Multiple cols match the col name: %s" % col
-		if verbose:
-			print query
-		return None
-	else:
-		print "ERROR: Cannot identify col name: %s" % col
-		return None
+def col2id( col, host="localhost", port=27017, db="",  verbose = False, return_field = "col_id", session = None ):
+	"""Check name format of cols. If necessary, translate. The name is looked up as col_id, then as
+	egrin2_col_name, as in row2id"""
+	return getSession( host, port, db, session ).translate( "col", [ col ], return_field, verbose = verbose )[ 0 ]
 
 
-def col2id_batch( cols, host="localhost", port=27017, db="",  verbose = True, return_field = "col_id", input_type = None ):
-	"""Check name format of rows. If necessary, translate."""
+def col2id_batch( cols, host="localhost", port=27017, db="",  verbose = True, return_field = "col_id", input_type = None, session = None ):
+	"""Check name format of cols. If necessary, translate. Without 'input_type' it is detected from the names
+	(col_id, then egrin2_col_name), and mixed lists are translated name by name, as in row2id_batch"""
 
 	if return_field == input_type:
 		return cols
 
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
-	query = pd.DataFrame( list( client[db].col_info.find( { "$or": [ { "col_id": { "$in": cols } }, { "egrin2_col_name": { "$in":cols } } ] }, { "col_id": 1, "egrin2_col_name":1 } ) ) )
+	session = getSession( host, port, db, session )
 
-	if input_type in [  "col_id", "egrin2_col_name" ]:
-		query = query.set_index( input_type )
-		to_r = query.loc[ cols ][ return_field ].tolist()
-	else:
-		#try to match input_type automatically
-		if verbose:
-			print "Reverting to translation by single matches. Defining 'input_type' will dramatically speed up query."
-		to_r= [ col2id( x, host, port, db, return_field = return_field ) for x in cols ]
-	
-	client.close()
+	if input_type in [ "col_id", "egrin2_col_name" ] and return_field in [ "col_id", "egrin2_col_name" ]:
+		# translate in memory through the ID registry
+		registry = session.registry
+		registry.refresh( "col" )
+		if input_type == "col_id":
+			return registry.to_name( "col", cols )
+		return registry.to_id( "col", cols, missing = None ).tolist()
 
-	return to_r
+	return session.translate( "col", cols, return_field, input_type, verbose = verbose )
 
-def colResamplePval( rows = None, row_type = None, cols = None, col_type = None, n_resamples = None, host = "localhost", port = 27017, db = "", standardized = None, sig_cutoff = None, sort = True, add_override = False, n_jobs = 4, keepP = 0.1, verbose = True, col_outtype = "col_id" ):
+def colResamplePval( rows = None, row_type = None, cols = None, col_type = None, n_resamples = None, host = "localhost", port = 27017, db = "", standardized = None, sig_cutoff = None, sort = True, add_override = False, n_jobs = 4, keepP = 0.1, verbose = True, col_outtype = "col_id", session = None ):
 
 	def empirical_pval( i, random_rsd, resamples ):
 		for x in range( 0, len( i ) ):
@@ -150,14 +126,17 @@ def colResamplePval( rows = None, row_type = None, cols = None, col_type = None,
 			else:
 				return val
 
+	session = getSession( host, port, db, session )
+	db = session.dbname
+
 	rows_o = rows
-	rows = row2id_batch( rows, host, port, db, input_type = row_type )
+	rows = row2id_batch( rows, host, port, db, session = session, input_type = row_type )
 	if len( rows ) == 0:
 		print "Please provide an appropriately named array of rows"
 		return None 
 	
 	cols_o = cols
-	cols = col2id_batch( cols, host, port, db, input_type = col_type )
+	cols = col2id_batch( cols, host, port, db, session = session, input_type = col_type )
 	if len( cols ) == 0:
 		print "Please provide an appropriately named array of cols"
 		return None
@@ -176,7 +155,7 @@ def colResamplePval( rows = None, row_type = None, cols = None, col_type = None,
 		n_resamples = 1000
 
 	# Determine what/how many resamples need to be added to db
-	toAdd = [ check_colResamples( i, len( rows ), n_resamples, host, port , db ) for i in cols]
+	toAdd = [ check_colResamples( i, len( rows ), n_resamples, host, port, db, session = session ) for i in cols]
 	toAdd = [ i for i in toAdd if i is not None]
 
 	count = 1
@@ -192,8 +171,8 @@ def colResamplePval( rows = None, row_type = None, cols = None, col_type = None,
 	if verbose:
 		print "Calculating pvals"
 
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
-	exp_df = pd.DataFrame( list( client[ db ].gene_expression.find( { "col_id": { "$in" : cols }, "row_id": { "$in" : rows } }, { "_id":0, "col_id":1, "normalized_expression":1, "standardized_expression":1 } ) ) )
+	client = session.client
+	exp_df = expressionRecords( client, db, rows = rows, cols = cols ).drop( "row_id", axis = 1 )
 	random_rsd = pd.DataFrame( list( client[ db ].col_resample.find( { "n_rows": len( rows ), "col_id": { "$in" : cols } }, { "_id":0 } ) ) )
 	
 	if random_rsd.shape[0] == 0:
@@ -216,7 +195,7 @@ def colResamplePval( rows = None, row_type = None, cols = None, col_type = None,
 
 	pvals = exp_df_rsd.groupby( level=0 ).aggregate(empirical_pval, random_rsd, resamples )
 	pvals.columns = ["pval"]
-	pvals.index = col2id_batch( pvals.index.values, host, port, db, input_type = "col_id", return_field = col_outtype )
+	pvals.index = col2id_batch( pvals.index.values, host, port, db, session = session, input_type = "col_id", return_field = col_outtype )
 
 	if sig_cutoff is not None:
 		pvals = pvals[ pvals <= sig_cutoff ]
@@ -230,11 +209,10 @@ def colResamplePval( rows = None, row_type = None, cols = None, col_type = None,
 	if pvals.shape[ 0 ] == 0:
 		print "No cols pass the significance cutoff of %f" % sig_cutoff
 
-	client.close()
 
 	return pvals
 
-def agglom( x = [ 0,1 ], x_type = None, y_type = None, x_input_type = None, y_output_type = None, logic = "or", host = "localhost", port = 27017, db = "",  verbose = False, gre_lim = 10, pval_cutoff = 0.05, translate = True ):
+def agglom( x = [ 0,1 ], x_type = None, y_type = None, x_input_type = None, y_output_type = None, logic = "or", host = "localhost", port = 27017, db = "",  verbose = False, gre_lim = 10, pval_cutoff = 0.05, translate = True, session = None, incidence = False ):
 	"""
 	Determine enrichment of y given x through bicluster co-membership. 
 
@@ -249,6 +227,9 @@ def agglom( x = [ 0,1 ], x_type = None, y_type = None, x_input_type = None, y_ou
 	'bicluster': takes or outputs bicluster '_id'
 	''
 
+	With 'incidence' the query is answered from the session's in-memory incidence matrices (see 
+	query/incidence.py) rather than MongoDB. The results are the same.
+
 	"""
 
 	print "Using %s logic" % logic
@@ -273,14 +254,15 @@ def agglom( x = [ 0,1 ], x_type = None, y_type = None, x_input_type = None, y_ou
 		# single
 		x = [ x ]
 
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
+	session = getSession( host, port, db, session )
+	client, db = session.client, session.dbname
 
 	# Check input types
 
 	if x_type == "rows" or x_type == "row" or x_type == "gene" or x_type == "genes":
 		x_type = "rows"
 		x_o = x
-		x = row2id_batch( x, host, port, db, input_type = x_input_type, return_field="row_id" )
+		x = row2id_batch( x, host, port, db, session = session, input_type = x_input_type, return_field="row_id" )
 		x = list( set( x ) )
 		if len( x ) == 0:
 			print "Cannot translate row names: %s" % x_o
@@ -288,7 +270,7 @@ def agglom( x = [ 0,1 ], x_type = None, y_type = None, x_input_type = None, y_ou
 	elif x_type == "columns" or x_type == "column" or x_type == "col" or x_type == "cols" or x_type == "condition" or x_type == "conditions" or x_type == "conds":
 		x_type = "columns"
 		x_o = x
-		x = col2id_batch( x, host, port, db, input_type = x_input_type, return_field="col_id" )
+		x = col2id_batch( x, host, port, db, session = session, input_type = x_input_type, return_field="col_id" )
 		x = list( set( x ) )
 		if len( x ) == 0:
 			print "Cannot translate col names: %s" % x_o
@@ -319,7 +301,14 @@ def agglom( x = [ 0,1 ], x_type = None, y_type = None, x_input_type = None, y_ou
 
 	# Compose query
 
-	if logic in [ "and","or","nor" ]:
+	if logic in [ "and","or","nor" ] and incidence:
+		engine = session.incidence()
+		selected = engine.select( x_type, x, logic )
+		query = pd.DataFrame( { "_id": engine.ids[ selected ] } )
+		N = query.shape[ 0 ]
+		if y_type != "_id":
+			counts, all_counts, N = engine.counts( y_type, selected )
+	elif logic in [ "and","or","nor" ]:
 		q = { "$"+logic: [ { x_type : i } for i in x ] }
 		o = { y_type: 1 }
 		if x_type == "gre_id":
@@ -330,149 +319,94 @@ def agglom( x = [ 0,1 ], x_type = None, y_type = None, x_input_type = None, y_ou
 			query = pd.DataFrame( list( client[db].motif_info.find(  { "cluster_id": { "$in": queryPre } }, { y_type : 1 } ) ) )
 		else:
 			query = pd.DataFrame( list( client[db].bicluster_info.find( q, o ) ) )
+		N = query.shape[ 0 ]
 	else:
 		print "I don't recognize the logic you are trying to use. 'logic' must be 'and', 'or', or 'nor'."
 		return None
 	
-	client.close()
-
-	if query.shape[0] > 0: 
-
-		mapColumns = Code("""
-			function () {
-			this.columns.forEach(function(z) {
-				emit(z, 1);
-				});
-		 	}
-		 	""")
-		mapRows = Code("""
-			function () {
-			this.rows.forEach(function(z) {
-				emit(z, 1);
-				});
-		 	}
-		 	""")
-		mapGREs = Code("""
-			function () {
-			print(this);
-			emit(this.gre_id, 1);
-		 	}
-		 	""")
-		reduce = Code("""
-			function (key, values) {
-			               var total = 0;
-			               for (var i = 0; i < values.length; i++) {
-			               	total += values[i];
-		               		}
-	               		return total;
-		               }
-		               """)
+
+	if N > 0: 
 
 		if y_type == "_id":
 			return query
 		else:
 			if y_type == "rows":
 
-				if client[db].rowsCount_mapreduce.count() == 0:
-					print "Initializing MapReduce lookup table. Future queries will be much faster!"
-					client[db].bicluster_info.map_reduce(mapRows,reduce,"rowsCount_mapreduce")
+				if incidence:
+					rows = counts.to_frame( "counts" )
 				else:
-					# do spot check to make sure mapreduce is up to date
-					random_id = random.randint( 0, client[db].rowsCount_mapreduce.count() )
-					ref = client[db].rowsCount_mapreduce.find_one( { "_id": random_id } )["value"]
-					test = client[db].bicluster_info.find( { "rows": random_id } ).count()
-					if ref != test:
-						print "Initializing MapReduce lookup table. Future queries will be much faster!"
-						client[db].bicluster_info.map_reduce(mapRows,reduce,"rowsCount_mapreduce")
-
-				rows = pd.Series( list( itertools.chain( *query.rows.tolist() ) ) ).value_counts().to_frame( "counts" )
+					rows = pd.Series( list( itertools.chain( *query.rows.tolist() ) ) ).value_counts().to_frame( "counts" )
 				
 				# filter out rows that aren't in the database - i.e. not annotated in MicrobesOnline
-				in_db = pd.DataFrame( list( client[db].row_info.find( { }, { "_id" : 0, "row_id": 1 } ) ) ).row_id.tolist()
+				in_db = session.info( "row" ).row_id.tolist()
 				common_rows = list(set(rows.index).intersection(set(in_db)))
 				rows = rows.loc[common_rows]
 				
-				# find all bicluster counts
-				all_counts = pd.DataFrame( list( client[db].rowsCount_mapreduce.find( ) ) )
-				all_counts = all_counts.set_index("_id")
+				# bicluster counts of these rows, materialized at assembly (see assemble/counts.py)
+				if incidence:
+					all_counts = all_counts.to_frame( "value" )
+				else:
+					all_counts = get_counts( session.db, "rows", rows.index )
 
 				# combine two data frames
-				to_r = rows.join(all_counts).sort("counts",ascending=False)
+				to_r = rows.join(all_counts).sort_values("counts",ascending=False)
 				to_r.columns = ["counts","all_counts"]
 
 				if translate:
-					to_r.index = row2id_batch( to_r.index.tolist(), host, port, db, return_field = "egrin2_row_name", input_type = "row_id" )
+					to_r.index = row2id_batch( to_r.index.tolist(), host, port, db, session = session, return_field = "egrin2_row_name", input_type = "row_id" )
 
 			if y_type == "columns":
 
-				if client[db].columnsCount_mapreduce.count() == 0:
-					print "Initializing MapReduce lookup table. Future queries will be much faster!"
-					client[db].bicluster_info.map_reduce(mapColumns,reduce,"columnsCount_mapreduce")
+				if incidence:
+					cols = counts.to_frame( "counts" )
 				else:
-					# do spot check to make sure mapreduce is up to date
-					random_id = random.randint( 0, client[db].columnsCount_mapreduce.count() )
-					ref = client[db].columnsCount_mapreduce.find_one( { "_id": random_id } )["value"]
-					test = client[db].bicluster_info.find( { "columns": random_id } ).count()
-					if ref != test:
-						print "Initializing MapReduce lookup table. Future queries will be much faster!"
-						client[db].bicluster_info.map_reduce(mapColumns,reduce,"columnsCount_mapreduce")
-
-				if client[db].columnsCount_mapreduce.count() == 0:
-					client[db].bicluster_info.map_reduce(mapColumns,reduce,"columnsCount_mapreduce")
-				
-				cols = pd.Series( list( itertools.chain( *query["columns"].tolist() ) ) ).value_counts().to_frame( "counts" )
+					cols = pd.Series( list( itertools.chain( *query["columns"].tolist() ) ) ).value_counts().to_frame( "counts" )
 				
 				# filter out columns that aren't in the database - i.e. not annotated in MicrobesOnline
-				in_db = pd.DataFrame( list( client[db].col_info.find( { }, { "_id" : 0, "col_id": 1 } ) ) ).col_id.tolist()
+				in_db = session.info( "col" ).col_id.tolist()
 				common_cols = list( set( cols.index ).intersection( set( in_db )  ))
 				cols = cols.loc[common_cols]
 				
-				# find all bicluster counts
-				all_counts = pd.DataFrame( list( client[db].columnsCount_mapreduce.find( ) ) )
-				all_counts = all_counts.set_index("_id")
+				# bicluster counts of these cols
+				if incidence:
+					all_counts = all_counts.to_frame( "value" )
+				else:
+					all_counts = get_counts( session.db, "columns", cols.index )
 
 				# combine two data frames
-				to_r = cols.join(all_counts).sort("counts",ascending=False)
+				to_r = cols.join(all_counts).sort_values("counts",ascending=False)
 				to_r.columns = ["counts","all_counts"]
 
 				if translate:
-					to_r.index = col2id_batch( to_r.index.tolist(), host, port, db, return_field = "egrin2_col_name", input_type = "col_id" )
+					to_r.index = col2id_batch( to_r.index.tolist(), host, port, db, session = session, return_field = "egrin2_col_name", input_type = "col_id" )
 
 
 			if y_type == "gre_id":
 
-				if client[db].gresCount_mapreduce.count() == 0:
-					print "Initializing MapReduce lookup table. Future queries will be much faster!"
-					client[db].motif_info.map_reduce(mapGREs,reduce,"gresCount_mapreduce")
+				if incidence:
+					gres = counts.to_frame( "counts" )
+					all_counts = all_counts.to_frame( "value" )
 				else:
-					# do spot check to make sure mapreduce is up to date
-					random_id = random.randint( 0, client[db].gresCount_mapreduce.count() )
-					ref = client[db].gresCount_mapreduce.find_one( { "_id": random_id } )["value"]
-					test = client[db].motif_info.find( { "gre_id": random_id } ).count()
-					if ref != test:
-						print "Initializing MapReduce lookup table. Future queries will be much faster!"
-						client[db].motif_info.map_reduce(mapGREs,reduce,"gresCount_mapreduce")
-
-				gres = query.gre_id.tolist() 
-				gres = filter(lambda x: x != "NaN", gres )
-				gres = pd.Series( gres ).value_counts().to_frame( "counts" )
-
-				# find all bicluster counts
-				all_counts = pd.DataFrame( list( client[db].gresCount_mapreduce.find( ) ) )
-				all_counts = all_counts.set_index("_id")
+					gres = query.gre_id.tolist() 
+					gres = filter(lambda x: x != "NaN", gres )
+					gres = pd.Series( gres ).value_counts().to_frame( "counts" )
+
+					# motif counts of these GREs
+					all_counts = get_counts( session.db, "gre_id", gres.index )
 
 				# combine two data frames
-				to_r = gres.join(all_counts).sort("counts",ascending=False)
+				to_r = gres.join(all_counts).sort_values("counts",ascending=False)
 				to_r.columns = ["counts","all_counts"]
 
 				# filter by GREs with more than 10 instances
 				to_r = to_r.loc[ to_r.all_counts>=gre_lim, : ]
 
 
-			to_r["pval"] = to_r.apply( compute_p, axis=1, M = client[db].bicluster_info.count(),  N = query.shape[ 0 ] )
+			M = engine.n_biclusters() if incidence else client[db].bicluster_info.count()
+			to_r["pval"] = to_r.apply( compute_p, axis=1, M = M,  N = N )
 			to_r["qval_BH"] = multipletests( to_r.pval, method='fdr_bh' )[1]
 			to_r["qval_bonferroni"] = multipletests( to_r.pval, method='bonferroni' )[1]
-			to_r = to_r.sort( ["pval","counts"], ascending=True )
+			to_r = to_r.sort_values( ["pval","counts"], ascending=True )
 			# only return below pval cutoff
 			to_r = to_r.loc[ to_r.pval <= pval_cutoff, : ]
 
@@ -483,7 +417,190 @@ def agglom( x = [ 0,1 ], x_type = None, y_type = None, x_input_type = None, y_ou
 		print "Could not find any biclusters matching your criteria"
 		return None
 
-def fimoFinder( start = None, stop = None, locusId = None, strand = None, mot_pval_cutoff = None, filterby = None, filter_type = None, filterby_input_type = None, host = "localhost", port = 27017, db = None, use_fimo_small = True, logic = "or", return_format = "file", outfile = None, tosingle = True ):
+# canonical agglomBatch types of the names agglom accepts
+AGGLOM_TYPES = {
+	"rows": [ "rows", "row", "gene", "genes" ],
+	"columns": [ "columns", "column", "col", "cols", "condition", "conditions", "conds" ],
+	"gre_id": [ "motif", "gre", "motc", "motif.gre", "motifs", "gres", "motcs", "gre_id" ],
+	"_id": [ "cluster", "clusters", "bicluster", "biclusters", "bcs", "_id" ]
+}
+
+def agglom_type( name ):
+	for i in AGGLOM_TYPES:
+		if name in AGGLOM_TYPES[ i ]:
+			return i
+	return None
+
+def _lbinom( a, b ):
+	return gammaln( a + 1 ) - gammaln( b + 1 ) - gammaln( a - b + 1 )
+
+def hypergeom_sf( k, M, n, N, eps = 1e-17 ):
+	"""hypergeom.sf( k, M, n, N ) for arrays, vectorized (scipy sums the pmf of each element in a python loop).
+	The pmf is summed from the start of the shorter tail with its ratio recurrence, all elements at a time, 
+	until the remaining terms are negligible: the upper tail from k + 1 up, or, for k below the mean, the 
+	lower tail from k down ( sf = 1 - cdf ). NaN for parameters outside the support, as scipy"""
+	k, M, n, N = [ i.astype( float ).ravel() for i in np.broadcast_arrays( k, M, n, N ) ]
+	valid = ( M > 0 ) & ( n >= 0 ) & ( n <= M ) & ( N >= 0 ) & ( N <= M )
+	upper = k + 1 > N * n / np.where( valid, M, 1 )
+	x = np.where( upper, k + 1, k )
+	low = np.maximum( 0, N + n - M )
+	high = np.minimum( n, N )
+	inside = valid & ( x >= low ) & ( x <= high )
+	term = np.zeros( len( k ) )
+	ni, xi, Mi, Ni = n[ inside ], x[ inside ], M[ inside ], N[ inside ]
+	term[ inside ] = np.exp( _lbinom( ni, xi ) + _lbinom( Mi - ni, Ni - xi ) - _lbinom( Mi, Ni ) )
+	total = term.copy()
+	active = np.flatnonzero( inside & ( term > 0 ) )
+	while len( active ) > 0:
+		xa, Ma, na, Na, up = x[ active ], M[ active ], n[ active ], N[ active ], upper[ active ]
+		ratio = np.where( up, ( na - xa ) * ( Na - xa ) / ( ( xa + 1 ) * ( Ma - na - Na + xa + 1 ) ), xa * ( Ma - na - Na + xa ) / ( ( na - xa + 1 ) * ( Na - xa + 1 ) ) )
+		x[ active ] = np.where( up, xa + 1, xa - 1 )
+		term[ active ] *= ratio
+		total[ active ] += term[ active ]
+		xa = x[ active ]
+		keep = np.where( up, xa < high[ active ], xa > low[ active ] ) & ( term[ active ] > total[ active ] * eps )
+		active = active[ keep ]
+	sf = np.clip( np.where( upper, total, 1 - total ), 0, 1 )
+	sf[ ~valid ] = np.nan
+	return sf
+
+def grouped_qvals( pvals, groups ):
+	"""BH and Bonferroni corrections of 'pvals', each group of 'groups' corrected on its own (as multipletests
+	per group), vectorized over all groups. Returns ( qval_BH, qval_bonferroni )"""
+	pvals = np.asarray( pvals, dtype = float )
+	groups = np.asarray( groups )
+	if len( pvals ) == 0:
+		return pvals.copy(), pvals.copy()
+	order = np.lexsort( ( pvals, groups ) )
+	p = pvals[ order ]
+	g = groups[ order ]
+	starts = np.r_[ 0, np.flatnonzero( g[ 1: ] != g[ :-1 ] ) + 1 ]
+	sizes = np.diff( np.r_[ starts, len( p ) ] )
+	m = np.repeat( sizes, sizes ).astype( float )
+	rank = np.arange( len( p ) ) - np.repeat( starts, sizes ) + 1
+	# BH: running minimum of p * m / rank from the largest p-value of each group down
+	bh = pd.Series( ( p * m / rank )[ ::-1 ] ).groupby( g[ ::-1 ] ).cummin().values[ ::-1 ]
+	qval_bh = np.empty( len( p ) )
+	qval_bh[ order ] = np.minimum( bh, 1 )
+	qval_bonferroni = np.empty( len( p ) )
+	qval_bonferroni[ order ] = np.minimum( p * m, 1 )
+	return qval_bh, qval_bonferroni
+
+def _agglom_chunk( engine, task ):
+	"""Counts and hypergeometric p-values of the query sets of one chunk. task is ( offset, sets, x_type, y_type, logic, keep ).
+	Returns arrays ( query set, key position, counts, all_counts, N, pval ) of the keys in 'keep' found by each set"""
+	offset, sets, x_type, y_type, logic, keep = task
+	selected, complement = engine._select_many( x_type, sets, logic )
+	counts, n = engine._counts_many( y_type, selected, complement )
+	found = keep[ counts.col ] & ( counts.data > 0 )
+	query = counts.row[ found ]
+	key = counts.col[ found ]
+	z = counts.data[ found ]
+	all_counts = engine.matrices[ y_type ].totals[ key ]
+	N = n[ query ]
+	pval = hypergeom_sf( z, len( engine.ids ), all_counts, N )
+	return query + offset, key, z, all_counts, N, pval
+
+_agglom_engine = None
+
+def _init_agglom_worker( engine ):
+	"""Pool initializer for agglomBatch. Workers are forked with the loaded incidence matrices and do not use MongoDB"""
+	global _agglom_engine
+	_agglom_engine = engine
+
+def _agglom_worker( task ):
+	return _agglom_chunk( _agglom_engine, task )
+
+def agglomBatch( xs, x_type = None, y_type = None, x_input_type = None, logic = "or", host = "localhost", port = 27017, db = "", gre_lim = 10, pval_cutoff = 0.05, translate = True, session = None, chunk_size = 500, n_jobs = 1 ):
+	"""
+	agglom for many query sets at once, eg one per corem or gene set.
+
+	'xs' is a list of query sets (each as 'x' of agglom) or a dictionary name -> query set. x_type, y_type 
+	( rows, columns or gre ), logic, gre_lim and pval_cutoff are as in agglom; the results of each set are 
+	those of agglom( x, incidence = True ).
+
+	All names are translated in one call and the sets are answered from the session's incidence matrices
+	(see query/incidence.py), 'chunk_size' sets per sparse product. P-values and the BH and Bonferroni 
+	corrections (within each set) are computed for all sets at once, in numpy (see hypergeom_sf). With 
+	n_jobs > 1 chunks are computed in a pool of 'n_jobs' worker processes.
+
+	Returns a long-format DataFrame, one row per set and enriched y, with columns query (list position or
+	dictionary key), y_type, counts, all_counts, N (documents drawn by the set), pval, qval_BH, qval_bonferroni.
+	"""
+
+	print "Using %s logic" % logic
+
+	if isinstance( xs, dict ):
+		names = xs.keys()
+		sets = [ xs[ i ] for i in names ]
+	else:
+		sets = list( xs )
+		names = range( len( sets ) )
+	sets = [ [ i ] if type( i ) == str or type( i ) == int else list( i ) for i in sets ]
+
+	x_type = agglom_type( x_type )
+	y_type = agglom_type( y_type )
+	if x_type is None or y_type is None or y_type == "_id":
+		print "ERROR: Can't recognize your 'x_type' or 'y_type' argument. Types include: 'rows' (genes), 'columns' (conditions), 'gres'; x_type also 'bicluster'"
+		return None
+	if logic not in [ "and","or","nor" ]:
+		print "I don't recognize the logic you are trying to use. 'logic' must be 'and', 'or', or 'nor'."
+		return None
+
+	session = getSession( host, port, db, session )
+	db = session.dbname
+
+	# translate the names of all sets at once
+	if x_type in [ "rows", "columns" ]:
+		flat = list( itertools.chain( *sets ) )
+		if x_type == "rows":
+			flat = row2id_batch( flat, host, port, db, session = session, input_type = x_input_type, return_field = "row_id" )
+		else:
+			flat = col2id_batch( flat, host, port, db, session = session, input_type = x_input_type, return_field = "col_id" )
+		ends = np.cumsum( [ len( i ) for i in sets ] )
+		sets = [ list( set( flat[ e - len( i ):e ] ) ) for i, e in zip( sets, ends ) ]
+
+	engine = session.incidence()
+	engine.load()
+	keys = engine.matrices[ y_type ].keys
+	if y_type == "rows":
+		# rows and columns not annotated in the database are left out, as in agglom
+		keep = keys.isin( session.info( "row" ).row_id )
+	elif y_type == "columns":
+		keep = keys.isin( session.info( "col" ).col_id )
+	else:
+		keep = engine.matrices[ y_type ].totals >= gre_lim
+
+	tasks = [ ( start, sets[ start:start + chunk_size ], x_type, y_type, logic, keep ) for start in xrange( 0, len( sets ), chunk_size ) ]
+	if n_jobs > 1 and len( tasks ) > 1:
+		pool = multiprocessing.Pool( processes = n_jobs, initializer = _init_agglom_worker, initargs = ( engine, ) )
+		try:
+			results = pool.map( _agglom_worker, tasks )
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		results = [ _agglom_chunk( engine, i ) for i in tasks ]
+
+	columns = [ "query", y_type, "counts", "all_counts", "N", "pval" ]
+	if len( results ) == 0:
+		results = [ [ np.zeros( 0, dtype = np.int64 ) ] * len( columns ) ]
+	to_r = pd.DataFrame( dict( zip( columns, [ np.concatenate( i ) for i in zip( *results ) ] ) ), columns = columns )
+	to_r[ "qval_BH" ], to_r[ "qval_bonferroni" ] = grouped_qvals( to_r.pval.values, to_r[ "query" ].values )
+	to_r = to_r.loc[ to_r.pval <= pval_cutoff, : ]
+	to_r = to_r.sort_values( [ "query", "pval", "counts" ], ascending = True )
+
+	y = keys[ to_r[ y_type ].values ].tolist()
+	if translate and y_type == "rows":
+		y = row2id_batch( y, host, port, db, session = session, return_field = "egrin2_row_name", input_type = "row_id" )
+	elif translate and y_type == "columns":
+		y = col2id_batch( y, host, port, db, session = session, return_field = "egrin2_col_name", input_type = "col_id" )
+	to_r[ y_type ] = y
+	to_r[ "query" ] = [ names[ i ] for i in to_r[ "query" ].values ]
+
+	return to_r.reset_index( drop = True )
+
+def fimoFinder( start = None, stop = None, locusId = None, strand = None, mot_pval_cutoff = None, filterby = None, filter_type = None, filterby_input_type = None, host = "localhost", port = 27017, db = None, use_fimo_small = True, logic = "or", return_format = "file", outfile = None, tosingle = True, session = None ):
 	"""Find motifs/GREs that fall within a specific range. Filter by biclusters/genes/conditions/etc."""
 	
 	def getBCs( x, x_type ):
@@ -505,15 +622,16 @@ def fimoFinder( start = None, stop = None, locusId = None, strand = None, mot_pv
 			to_r.sort()
 		return( to_r )
 
+	if db is None and session is None:
+		print "Please provide a database name, e.g. *org*_db, where *org* is a three lettter short organism code"
+		return None
+
 	try:
-		client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
+		session = getSession( host, port, db, session )
+		client, db = session.client, session.dbname
 	except Exception:
 		print "Cant connect to MongoDB at host = %s, port = %s" % ( host, str(port) )
 
-	if db is None:
-		print "Please provide a database name, e.g. *org*_db, where *org* is a three lettter short organism code"
-		return None
-
 	db_chr = pd.DataFrame( list( client[ db ].genome.find( { }, { "scaffoldId":1, "NCBI_RefSeq":1 } ) ) )
 	db_scaffoldId = db_chr.scaffoldId.tolist( )
 	db_NCBI_RefSeq = db_chr.NCBI_RefSeq.tolist( )
@@ -528,7 +646,8 @@ def fimoFinder( start = None, stop = None, locusId = None, strand = None, mot_pv
 		print "LocusId %s not in EGRIN 2.0 database %s. \n\nLocusIds in this database include: \n\nScaffoldId\n%s\n\nNCBI_RefSeq\n%s" % ( locusId, db, (", ").join( db_scaffoldId ), (", ").join( db_NCBI_RefSeq ) )
 		return None
 
-	chromosome = client[ db ].genome.find_one( { "$or": [ { "scaffoldId": locusId }, { "NCBI_RefSeq": locusId } ] } )
+	# metadata only. the sequence is not needed
+	chromosome = genomeStore( client[ db ] ).info( locusId )
 	scaffoldId = chromosome[ "scaffoldId" ]
 	ncbi = chromosome[ "NCBI_RefSeq" ]
 
@@ -539,7 +658,7 @@ def fimoFinder( start = None, stop = None, locusId = None, strand = None, mot_pv
 
 	if stop is None:
 		print "Stop not provided. Assuming end of chromosome"
-		stop = len( chromosome["sequence"] )
+		stop = chromosome[ "length" ]
 
 	if use_fimo_small:
 		fimo_collection = "fimo_small"
@@ -554,7 +673,7 @@ def fimoFinder( start = None, stop = None, locusId = None, strand = None, mot_pv
 		if filter_type == "rows" or filter_type == "row" or filter_type == "gene" or filter_type == "genes":
 			filter_type = "rows"
 			filterby_o = filterby
-			filterby = row2id_batch( filterby, host, port, db, input_type = filter_input_type, return_field="row_id" )
+			filterby = row2id_batch( filterby, host, port, db, session = session, input_type = filter_input_type, return_field="row_id" )
 			filterby = list( set( filterby ) )
 			if len( filterby ) == 0:
 				print "Cannot translate row names: %s" % filterby_o
@@ -562,7 +681,7 @@ def fimoFinder( start = None, stop = None, locusId = None, strand = None, mot_pv
 		elif filter_type == "columns" or filter_type == "column" or filter_type == "col" or filter_type == "cols" or filter_type == "condition" or filter_type == "conditions" or filter_type == "conds":
 			filter_type = "columns"
 			filterby_o = filterby
-			filterby = col2id_batch( filterby, host, port, db, input_type = filterby_input_type, return_field="col_id" )
+			filterby = col2id_batch( filterby, host, port, db, session = session, input_type = filterby_input_type, return_field="col_id" )
 			filterby = list( set( filterby ) )
 			if len( filterby ) == 0:
 				print "Cannot translate col names: %s" % filterby_o
@@ -618,11 +737,10 @@ def fimoFinder( start = None, stop = None, locusId = None, strand = None, mot_pv
 				gres_scans.to_csv(  outfile, sep="\t", index=False )
 				return None
 
-	client.close()
 
 	return gre_scans
 
-def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes", y_return_field = None, count = False, logic = "or", host = "localhost", port = 27017, db = "" ):
+def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes", y_return_field = None, count = False, logic = "or", host = "localhost", port = 27017, db = "", session = None, incidence = False ):
 
 	"""
 	Fetch corem-related info 'y' given query 'x'. 
@@ -638,6 +756,8 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 	'gre': x should be a GRE or a list of GRE IDs, eg [4, 19]
 
 	'edge': x should be an edge or list of edges. Genes in edges should be separated by '-', eg ["carA-carB"] or ["275-276"]
+
+	With 'incidence' corems are selected from the session's in-memory incidence matrices (see query/incidence.py).
 	
 	"""
 
@@ -651,14 +771,15 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 		# single
 		x = [ x ]
 
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
+	session = getSession( host, port, db, session )
+	client, db = session.client, session.dbname
 
 	# Check input types
 
 	if x_type == "rows" or x_type == "row" or x_type == "gene" or x_type == "genes":
 		x_type = "rows"
 		x_o = x
-		x = row2id_batch( x, host, port, db, input_type = x_input_type, return_field="row_id" )
+		x = row2id_batch( x, host, port, db, session = session, input_type = x_input_type, return_field="row_id" )
 		x = list( set( x ) )
 		if len( x ) == 0:
 			print "Cannot translate row names: %s" % x_o
@@ -666,7 +787,7 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 	elif x_type == "columns" or x_type == "column" or x_type == "col" or x_type == "cols" or x_type == "condition" or x_type == "conditions" or x_type == "conds":
 		x_type = "cols.col_id"
 		x_o = x
-		x = col2id_batch( x, host, port, db, input_type = x_input_type, return_field="col_id" )
+		x = col2id_batch( x, host, port, db, session = session, input_type = x_input_type, return_field="col_id" )
 		x = list( set( x ) )
 		if len( x ) == 0:
 			print "Cannot translate row names: %s" % x_o
@@ -679,7 +800,7 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 		x_type = "edges"
 		x_new = []
 		for i in x:
-			i_trans = row2id_batch( i.split("-"), host, port, db, input_type = x_input_type, return_field="row_id", verbose = False )
+			i_trans = row2id_batch( i.split("-"), host, port, db, session = session, input_type = x_input_type, return_field="row_id", verbose = False )
 			i_trans = [ str( j ) for j in i_trans ]
 			x_new.append( "-".join( i_trans ) )
 			i_trans.reverse()
@@ -708,7 +829,10 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 		else:
 			q = { "$"+logic: [ { x_type : i } for i in x ] }
 		o = { y_type: 1 }
-		query = pd.DataFrame( list( client[db].corem.find( q, o ) ) )
+		if incidence:
+			query = session.incidence().select_corems( x_type, x, "or" if logic == "and" and x_type == "corem_id" else logic, y_type )
+		else:
+			query = pd.DataFrame( list( client[db].corem.find( q, o ) ) )
 	else:
 		print "I don't recognize the logic you are trying to use. 'logic' must be 'and', 'or', or 'nor'."
 		return None
@@ -723,14 +847,14 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 				if count:
 					to_r = to_r[ to_r >= query.shape[0] ]
 					if to_r.shape[0] > 0:
-						to_r.index = row2id_batch( to_r.index.tolist(), host, port, db, return_field = y_return_field, input_type = "row_id" )
+						to_r.index = row2id_batch( to_r.index.tolist(), host, port, db, session = session, return_field = y_return_field, input_type = "row_id" )
 					else:
 						print "No genes found"
 						return None
 				else:
 					to_r = to_r[ to_r > query.shape[0] ].index.tolist()
 					if len( to_r ):
-						to_r = row2id_batch( to_r, host, port, db, return_field = y_return_field, input_type = "row_id" )
+						to_r = row2id_batch( to_r, host, port, db, session = session, return_field = y_return_field, input_type = "row_id" )
 						to_r.sort()
 					else:
 						print "No genes found"
@@ -739,20 +863,20 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 				if count:
 					to_r = pd.Series( to_r ).value_counts()
 					if to_r.shape[0] > 0:
-						to_r.index = row2id_batch( to_r.index.tolist(), host, port, db, return_field = y_return_field, input_type = "row_id" )
+						to_r.index = row2id_batch( to_r.index.tolist(), host, port, db, session = session, return_field = y_return_field, input_type = "row_id" )
 					else:
 						print "No genes found"
 						return None
 				else:
 					to_r = list( set( to_r ) )
 					if len( to_r ):
-						to_r = row2id_batch( to_r, host, port, db, return_field = y_return_field, input_type = "row_id" )
+						to_r = row2id_batch( to_r, host, port, db, session = session, return_field = y_return_field, input_type = "row_id" )
 						to_r.sort()
 					else:
 						print "No genes found"
 						return None 
 		else:
-			to_r = row2id_batch( query.rows[0], host, port, db, return_field = y_return_field, input_type = "row_id" )
+			to_r = row2id_batch( query.rows[0], host, port, db, session = session, return_field = y_return_field, input_type = "row_id" )
 
 	elif y_type == "cols.col_id":
 		if y_return_field is None:
@@ -764,14 +888,14 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 				if count:
 					to_r = to_r[ to_r >= query.shape[0] ]
 					if to_r.shape[0] > 0:
-						to_r.index = col2id_batch( to_r.index.tolist(), host, port, db, return_field = y_return_field, input_type = "col_id" )
+						to_r.index = col2id_batch( to_r.index.tolist(), host, port, db, session = session, return_field = y_return_field, input_type = "col_id" )
 					else:
 						print "No conditions found"
 						return None
 				else:
 					to_r = to_r[ to_r >= query.shape[0] ].index.tolist()
 					if len( to_r ):
-						to_r = col2id_batch( to_r, host, port, db, return_field = y_return_field, input_type = "col_id" )
+						to_r = col2id_batch( to_r, host, port, db, session = session, return_field = y_return_field, input_type = "col_id" )
 						to_r.sort()
 					else:
 						print "No conditions found"
@@ -780,21 +904,21 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 				if count:
 					to_r = pd.Series( to_r ).value_counts()
 					if to_r.shape[0] > 0:
-						to_r.index = col2id_batch( to_r.index.tolist(), host, port, db, return_field = y_return_field, input_type = "col_id" )
+						to_r.index = col2id_batch( to_r.index.tolist(), host, port, db, session = session, return_field = y_return_field, input_type = "col_id" )
 					else:
 						print "No conditions found"
 						return None
 				else:
 					to_r = list( set( to_r ) )
 					if len( to_r ):
-						to_r = col2id_batch( to_r, host, port, db, return_field = y_return_field, input_type = "col_id" )
+						to_r = col2id_batch( to_r, host, port, db, session = session, return_field = y_return_field, input_type = "col_id" )
 						to_r.sort()
 					else:
 						print "No conditions found"
 						return None 
 		else:
 			to_r = [int(i["col_id"]) for i in list(itertools.chain( *query.cols.values.tolist())) if i["col_id"] if type(i["col_id"]) is float]
-			to_r = col2id_batch( to_r, host, port, db, return_field = y_return_field, input_type = "col_id" )
+			to_r = col2id_batch( to_r, host, port, db, session = session, return_field = y_return_field, input_type = "col_id" )
 	elif y_type == "corem_id":
 		to_r = query.corem_id.tolist()
 	elif y_type == "edges":
@@ -803,7 +927,7 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 		to_r = list( itertools.chain( *query.edges.values.tolist() ) )
 		to_r_new = []
 		for i in to_r:
-			i_trans = row2id_batch( [ int( j ) for j in i.split("-") ], host, port, db, input_type = "row_id", return_field=y_return_field, verbose = False )
+			i_trans = row2id_batch( [ int( j ) for j in i.split("-") ], host, port, db, session = session, input_type = "row_id", return_field=y_return_field, verbose = False )
 			i_trans = [ str( j ) for j in i_trans ]
 			to_r_new.append( "-".join( i_trans ) )
 		to_r = to_r_new
@@ -813,14 +937,14 @@ def coremFinder( x, x_type = "corem_id", x_input_type = None, y_type = "genes",
 		print "Could not find corems matching your query"
 		to_r = None
 
-	client.close()
 
 	return to_r
 
-def expressionFinder( rows = None, cols = None, standardized = True, host = "localhost", port = 27017, db = "" ):
+def expressionFinder( rows = None, cols = None, standardized = True, host = "localhost", port = 27017, db = "", session = None ):
 	"""Fetch gene expression given rows and columns."""
 	
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
+	session = getSession( host, port, db, session )
+	client, db = session.client, session.dbname
 
 	input_type_rows = None
 	input_type_cols = None
@@ -843,33 +967,33 @@ def expressionFinder( rows = None, cols = None, standardized = True, host = "loc
 
 	# translate rows/cols
 
-	rows = row2id_batch( rows, host, port, db,  verbose = False, return_field = "row_id", input_type = input_type_rows )
-	cols = col2id_batch( cols, host, port, db,  verbose = False, return_field = "col_id", input_type = input_type_cols )
+	rows = row2id_batch( rows, host, port, db, session = session,  verbose = False, return_field = "row_id", input_type = input_type_rows )
+	cols = col2id_batch( cols, host, port, db, session = session,  verbose = False, return_field = "col_id", input_type = input_type_cols )
 
 	if len( rows ) > 1000 or len( cols ) > 1000:
 		print "WARNING: This is a large query. Please be patient. If you need faster access, I would suggest saving this matrix and loading directly from file."
 
 	# get expression data
 	data = pd.DataFrame( None,columns = cols, index = rows )
-	query = pd.DataFrame ( list( client[ db ].gene_expression.find( { "$and": [ { "row_id": { "$in": rows } }, { "col_id": { "$in": cols } } ] } ) ) )
-	for i in query:
+	query = expressionRecords( client, db, rows = rows, cols = cols )
+	if query.shape[ 0 ] > 0:
 		if standardized:
 			data = query.pivot(index="row_id",columns="col_id",values="standardized_expression")
 		else:
 			data = query.pivot(index="row_id",columns="col_id",values="raw_expression")
 
-	data.index = row2id_batch( data.index.tolist(), host, port, db,  verbose = False, return_field = "egrin2_row_name", input_type = "row_id" )
-	data.columns = col2id_batch( data.columns.tolist(), host, port, db,  verbose = False, return_field = "egrin2_col_name", input_type = "col_id" )
+	data.index = row2id_batch( data.index.tolist(), host, port, db, session = session,  verbose = False, return_field = "egrin2_row_name", input_type = "row_id" )
+	data.columns = col2id_batch( data.columns.tolist(), host, port, db, session = session,  verbose = False, return_field = "egrin2_col_name", input_type = "col_id" )
 	data = data.sort_index( )
 	data = data.reindex_axis( sorted( data.columns ), axis=1 )
 
-	client.close()
 
 	return data
 
-def ggbwebModule( genes = None, outfile = None, host = "localhost", port = 27017, db = "" ):
+def ggbwebModule( genes = None, outfile = None, host = "localhost", port = 27017, db = "", session = None ):
 	
-	client = MongoClient( 'mongodb://'+host+':'+str(port)+'/' )
+	session = getSession( host, port, db, session )
+	client, db = session.client, session.dbname
 
 	if genes is None:
 		print "Please provide a gene or list of genes"
@@ -882,7 +1006,7 @@ def ggbwebModule( genes = None, outfile = None, host = "localhost", port = 27017
 	def locFormat(x):
     		return( "chromosome" + x.strand + ":" + str( x.start ) + "-" + str( x.stop ) )
 	
-	gene_info = pd.DataFrame( row2id_batch( genes, host=host, port=port, db=db,  return_field = "all", verbose = False ) )
+	gene_info = pd.DataFrame( row2id_batch( genes, host=host, port=port, db=db, session = session,  return_field = "all", verbose = False ) )
 
 	to_r = pd.DataFrame( gene_info.loc[ :, "egrin2_row_name" ] )
 	to_r[ "loc" ] = [ locFormat( gene_info.iloc[ i ] ) for i in range( gene_info.shape[ 0 ] ) ]
@@ -893,7 +1017,6 @@ def ggbwebModule( genes = None, outfile = None, host = "localhost", port = 27017
 		to_r.to_csv( os.path.abspath( outfile ), sep="\t", index=False, header=False)
 		return None
 
-	client.close()
 
 	return to_r
 
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+"""
+In-memory sparse incidence matrices for bicluster and corem membership queries.
+
+bicluster_info is read once into scipy.sparse matrices: biclusters x rows, biclusters x columns and
+biclusters x GREs (number of motifs of each GRE). The corem collection is read the same way (corems
+x rows, cols, edges and corem_id) the first time it is queried, and again when corems are added or
+updated (the number of corems or the corem version, bumped by makeCorems, changes). "or", "and" and
+"nor" membership queries become column slices of the CSC form, and member counts over a set of
+biclusters become row sums of the CSR form. Matrices are reloaded when the ensemble version of the
+database changes (see assemble/counts.py).
+
+Queries follow the semantics of the corresponding MongoDB queries in egrin2_query, eg
+{ "$and": [ { "rows": 1 }, { "rows": 2 } ] } selects the biclusters containing both rows, while
+GRE queries match motif_info documents, which hold a single gre_id each.
+
+Example:
+
+engine = incidenceEngine( client[ "eco_db" ] )
+mask = engine.select( "rows", [ 275, 276 ], "and" )
+counts, all_counts, n = engine.counts( "columns", mask )
+
+Many query sets are answered at once with select_many and counts_many (see agglomBatch).
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "0.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from assemble.counts import ensemble_version
+from assemble.registry import collection_version
+
+class incidenceMatrix:
+
+	def __init__( self, lists ):
+		"""Documents x keys incidence from one list of keys per document. Repeated keys are counted"""
+		lengths = np.array( [ len( i ) for i in lists ], dtype = np.int64 )
+		values = pd.Index( [ j for i in lists for j in i ], dtype = object )
+		self.keys = pd.Index( values.unique().tolist() )
+		columns = self.keys.get_indexer( values )
+		rows = np.repeat( np.arange( len( lists ) ), lengths )
+		self.csr = sparse.csr_matrix( ( np.ones( len( columns ), dtype = np.int64 ), ( rows, columns ) ), shape = ( len( lists ), len( self.keys ) ) )
+		self.csr.sum_duplicates()
+		self.csc = self.csr.tocsc()
+		self.totals = np.asarray( self.csr.sum( axis = 0 ) ).ravel()
+
+	def select( self, x, logic ):
+		"""Boolean mask of the documents that contain any ( "or" ), all ( "and" ) or none ( "nor" ) of keys 'x'"""
+		x = pd.Index( x ).unique()
+		idx = self.keys.get_indexer( x )
+		known = idx[ idx >= 0 ]
+		hits = np.asarray( ( self.csc[ :, known ] > 0 ).sum( axis = 1 ) ).ravel()
+		if logic == "or":
+			return hits > 0
+		if logic == "and":
+			return hits == len( x )
+		return hits == 0
+
+	def select_many( self, sets, logic ):
+		"""Sparse 0/1 matrix, query sets x documents, and a complement flag: select( x, logic ) for each x of 'sets'
+		in one sparse product. For "nor" the matrix holds the "or" selection and the flag is True, so that the
+		mostly full "nor" selection is never built"""
+		queried = [ pd.Index( x ).unique() for x in sets ]
+		idx = [ self.keys.get_indexer( x ) for x in queried ]
+		known = [ i[ i >= 0 ] for i in idx ]
+		rows = np.repeat( np.arange( len( sets ) ), [ len( i ) for i in known ] )
+		columns = np.concatenate( known + [ np.zeros( 0, dtype = np.int64 ) ] )
+		queries = sparse.csr_matrix( ( np.ones( len( columns ), dtype = np.int64 ), ( rows, columns ) ), shape = ( len( sets ), len( self.keys ) ) )
+		if not hasattr( self, "binary" ):
+			self.binary = ( self.csc > 0 ).astype( np.int64 ).T.tocsr()
+		hits = ( queries * self.binary ).tocsr()
+		if logic == "and":
+			# entries hold the number of the set's keys a document contains
+			lengths = np.array( [ len( i ) for i in queried ] )
+			found = hits.data == np.repeat( lengths, np.diff( hits.indptr ) )
+		else:
+			found = hits.data > 0
+		hits.data = found.astype( np.int64 )
+		hits.eliminate_zeros()
+		return hits, logic == "nor"
+
+	def counts( self, mask ):
+		"""Keys and their number of occurrences in the documents of 'mask', for keys that occur"""
+		counts = np.asarray( self.csr[ np.flatnonzero( mask ) ].sum( axis = 0 ) ).ravel()
+		present = counts > 0
+		return pd.Series( counts[ present ], index = self.keys[ present ] )
+
+	def all_counts( self ):
+		return pd.Series( self.totals, index = self.keys )
+
+class incidenceEngine:
+
+	def __init__( self, db ):
+		self.db = db
+		self.version = None
+		self.corem_version = None
+
+	def current( self ):
+		return [ ensemble_version( self.db, "rows" ), ensemble_version( self.db, "gre_id" ) ]
+
+	def load( self ):
+		"""(Re)read bicluster_info and the GREs of motif_info if the ensemble has changed"""
+		version = self.current()
+		if version == self.version:
+			return
+		ids = []
+		lists = { "rows": [], "columns": [] }
+		for i in self.db.bicluster_info.find( {}, { "rows": 1, "columns": 1 } ):
+			ids.append( i[ "_id" ] )
+			for j in lists:
+				lists[ j ].append( i.get( j, [] ) )
+		self.ids = np.array( ids, dtype = object )
+		position = dict( [ ( j, i ) for i, j in enumerate( ids ) ] )
+		# motifs: the bicluster of each motif_info document and its gre_id
+		motif_cluster = []
+		motif_gre = []
+		for i in self.db.motif_info.find( {}, { "_id": 0, "cluster_id": 1, "gre_id": 1 } ):
+			if i.get( "cluster_id" ) in position:
+				motif_cluster.append( position[ i[ "cluster_id" ] ] )
+				motif_gre.append( i.get( "gre_id", "NaN" ) )
+		self.motif_cluster = np.array( motif_cluster, dtype = np.int64 )
+		self.motif_gre = pd.Index( motif_gre, dtype = object )
+		self.n_motifs = np.bincount( self.motif_cluster, minlength = len( ids ) )
+		gres = [ [] for i in ids ]
+		for i, gre in zip( motif_cluster, motif_gre ):
+			if gre != "NaN":
+				gres[ i ].append( gre )
+		self.matrices = { "rows": incidenceMatrix( lists[ "rows" ] ), "columns": incidenceMatrix( lists[ "columns" ] ), "gre_id": incidenceMatrix( gres ) }
+		self.version = version
+
+	def select( self, x_type, x, logic ):
+		"""Boolean mask over biclusters ( ids ) matching the agglom query of 'x' of 'x_type' ( rows, columns, gre_id or _id )"""
+		self.load()
+		return self._select( x_type, x, logic )
+
+	def select_many( self, x_type, sets, logic ):
+		"""Sparse 0/1 matrix, query sets x biclusters, and a complement flag: select( x_type, x, logic ) for each x
+		of 'sets'. If the flag is True the sets select the biclusters the matrix does not (see incidenceMatrix.select_many)"""
+		self.load()
+		return self._select_many( x_type, sets, logic )
+
+	def _select_many( self, x_type, sets, logic ):
+		# _select, _select_many and _counts_many read the loaded matrices only, not MongoDB, so they also run in forked workers
+		if x_type in [ "rows", "columns" ]:
+			return self.matrices[ x_type ].select_many( sets, logic )
+		complement = x_type == "_id" and logic == "nor"
+		if complement:
+			logic = "or"
+		# one set at a time: a mask over biclusters, kept as the positions it selects
+		positions = [ np.flatnonzero( self._select( x_type, x, logic ) ) for x in sets ]
+		rows = np.repeat( np.arange( len( sets ) ), [ len( i ) for i in positions ] )
+		columns = np.concatenate( positions + [ np.zeros( 0, dtype = np.int64 ) ] )
+		selected = sparse.csr_matrix( ( np.ones( len( columns ), dtype = np.int64 ), ( rows, columns ) ), shape = ( len( sets ), len( self.ids ) ) )
+		return selected, complement
+
+	def _select( self, x_type, x, logic ):
+		if x_type == "_id":
+			selected = np.in1d( self.ids, np.array( x, dtype = object ) )
+			if logic == "and":
+				# a document has one _id
+				selected = selected & ( len( set( x ) ) == 1 )
+			elif logic == "nor":
+				selected = ~selected
+			return selected
+		if x_type == "gre_id":
+			# matched per motif_info document, as in agglom, then mapped to their biclusters
+			motifs = self.motif_gre.isin( x )
+			if logic == "and":
+				motifs = motifs & ( len( set( x ) ) == 1 )
+			elif logic == "nor":
+				motifs = ~motifs
+			selected = np.zeros( len( self.ids ), dtype = bool )
+			selected[ self.motif_cluster[ motifs ] ] = True
+			return selected
+		return self.matrices[ x_type ].select( x, logic )
+
+	def counts( self, y_type, mask ):
+		"""( occurrences of each key of 'y_type' in the biclusters of 'mask', occurrences in all biclusters, number
+		of documents drawn ). For GREs the documents are the motifs of the biclusters, as in agglom"""
+		self.load()
+		matrix = self.matrices[ y_type ]
+		if y_type == "gre_id":
+			n = int( self.n_motifs[ mask ].sum() )
+		else:
+			n = int( mask.sum() )
+		return matrix.counts( mask ), matrix.all_counts(), n
+
+	def counts_many( self, y_type, selected, complement = False ):
+		"""For sparse 0/1 matrix query sets x biclusters 'selected' (and complement flag) from select_many: ( sparse
+		matrix, query sets x keys of 'y_type', of occurrences in the selected biclusters, number of documents drawn
+		by each set ), as counts() for each set"""
+		self.load()
+		return self._counts_many( y_type, selected, complement )
+
+	def _counts_many( self, y_type, selected, complement = False ):
+		matrix = self.matrices[ y_type ]
+		if y_type == "gre_id":
+			n = selected * self.n_motifs
+			total = self.n_motifs.sum()
+		else:
+			n = np.asarray( selected.sum( axis = 1 ) ).ravel()
+			total = len( self.ids )
+		counts = selected * matrix.csr
+		if complement:
+			# counts in the other biclusters: all occurrences less those in the selected ones
+			counts = sparse.csr_matrix( matrix.totals[ None, : ] - counts.toarray() )
+			n = total - n
+		return counts.tocoo(), n
+
+	def n_biclusters( self ):
+		self.load()
+		return len( self.ids )
+
+	def reset( self ):
+		"""Reload everything on next use, eg after corems were updated in place"""
+		self.version = None
+		self.corem_version = None
+
+	def load_corems( self ):
+		"""(Re)read the corem collection if corems were added or updated since it was read"""
+		version = [ self.db.corem.count(), collection_version( self.db, "corem" ) ]
+		if version == self.corem_version:
+			return
+		self.corems = list( self.db.corem.find( {}, { "corem_id": 1, "rows": 1, "cols": 1, "edges": 1 } ) )
+		self.corem_matrices = {
+		"corem_id": incidenceMatrix( [ [ i.get( "corem_id" ) ] for i in self.corems ] ),
+		"rows": incidenceMatrix( [ i.get( "rows", [] ) for i in self.corems ] ),
+		"cols.col_id": incidenceMatrix( [ [ j.get( "col_id" ) for j in i.get( "cols", [] ) ] for i in self.corems ] ),
+		"edges": incidenceMatrix( [ i.get( "edges", [] ) for i in self.corems ] )
+		}
+		self.corem_version = version
+
+	def select_corems( self, x_type, x, logic, y_type ):
+		"""Corem documents matching the coremFinder query of 'x' of 'x_type', with _id and the field of 'y_type', as a DataFrame"""
+		self.load_corems()
+		mask = self.corem_matrices[ x_type ].select( x, logic )
+		field = y_type.split( "." )[ 0 ]
+		docs = []
+		for i in np.flatnonzero( mask ):
+			doc = { "_id": self.corems[ i ][ "_id" ] }
+			if field in self.corems[ i ]:
+				doc[ field ] = self.corems[ i ][ field ]
+				if "." in y_type:
+					# projected to the subfield, as MongoDB does for { "cols.col_id": 1 }
+					sub = y_type.split( "." )[ 1 ]
+					doc[ field ] = [ { sub: j[ sub ] } for j in doc[ field ] if sub in j ]
+			docs.append( doc )
+		return pd.DataFrame( docs )
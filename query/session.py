@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""
+Long-lived connection to an EGRIN2.0 MongoDB for the query functions in egrin2_query.
+
+A session owns one MongoClient (which pools its connections), the ID registry of the database
+and warm lookup tables of row_info and col_info, so repeated queries neither reconnect nor reread
+the annotations. The tables (a translationCache) are reread when the registry version of their kind
+changes.
+
+Query functions take a 'session'. Without one they use getSession( host, port, db ), a session
+cached per process (a MongoClient must not be shared across fork).
+
+Example:
+
+s = egrin2Session( host = "primordial", db = "eco_db" )
+expressionFinder( rows = [ "carA", "carB" ], session = s )
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "0.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import os
+
+from pymongo import MongoClient
+import pandas as pd
+
+from assemble.registry import idRegistry
+from query.incidence import incidenceEngine
+
+# names a row or col can be given by, in row2id / col2id order. detection prefers earlier fields
+FIELDS = {
+	"row": [ "row_id", "egrin2_row_name", "GI", "accession", "name", "sysName" ],
+	"col": [ "col_id", "egrin2_col_name" ]
+}
+INFO = { "row": "row_info", "col": "col_info" }
+
+class translationCache:
+
+	def __init__( self, db, registry ):
+		"""In-memory translation of row and col identifiers of 'db'. row_info and col_info are read once
+		into hash maps (identifier field -> value -> document positions) and reread when the version of
+		their kind in 'registry' changes"""
+		self.db = db
+		self.registry = registry
+		self.tables = {}
+		self.versions = {}
+		self.maps = {}
+		self.lookups = {}
+		self.frames = {}
+
+	def documents( self, kind ):
+		"""row_info ( kind "row" ) or col_info ( "col" ) documents, reread if the registry has changed"""
+		version = self.registry.version( kind )
+		if kind not in self.tables or self.versions[ kind ] != version:
+			docs = list( self.db[ INFO[ kind ] ].find() )
+			maps = dict( [ ( field, {} ) for field in FIELDS[ kind ] ] )
+			lookup = {}
+			for i, doc in enumerate( docs ):
+				for field in FIELDS[ kind ]:
+					if field in doc:
+						maps[ field ].setdefault( doc[ field ], [] ).append( i )
+						positions = lookup.setdefault( doc[ field ], [] )
+						if i not in positions:
+							positions.append( i )
+			self.tables[ kind ] = docs
+			self.maps[ kind ] = maps
+			self.lookups[ kind ] = lookup
+			self.versions[ kind ] = version
+			self.frames.pop( kind, None )
+		return self.tables[ kind ]
+
+	def info( self, kind ):
+		"""documents( kind ) as a DataFrame"""
+		docs = self.documents( kind )
+		if kind not in self.frames:
+			self.frames[ kind ] = pd.DataFrame( docs )
+		return self.frames[ kind ]
+
+	def lookup( self, kind, field = None ):
+		"""value -> document positions of identifier 'field', or of any identifier field if None"""
+		self.documents( kind )
+		if field is None:
+			return self.lookups[ kind ]
+		return self.maps[ kind ][ field ]
+
+	def match( self, kind, name ):
+		"""Documents of 'kind' that 'name' matches in any of its identifier fields"""
+		docs = self.documents( kind )
+		return [ docs[ i ] for i in self.lookup( kind ).get( name, [] ) ]
+
+	def detect( self, kind, names ):
+		"""Identifier field of 'names', in one pass: the first field of FIELDS that holds all of them,
+		None if they are of mixed types (or unknown)"""
+		self.documents( kind )
+		return self._detect( kind, names )
+
+	def _detect( self, kind, names ):
+		maps = self.maps[ kind ]
+		candidates = list( FIELDS[ kind ] )
+		for name in names:
+			candidates = [ i for i in candidates if name in maps[ i ] ]
+			if len( candidates ) == 0:
+				return None
+		return candidates[ 0 ] if len( candidates ) > 0 else None
+
+	def _first_match( self, kind, name ):
+		"""Document positions of 'name' in the first field of FIELDS that holds it"""
+		for field in FIELDS[ kind ]:
+			if name in self.maps[ kind ][ field ]:
+				return self.maps[ kind ][ field ][ name ]
+		return []
+
+	def translate( self, kind, names, return_field, input_type = None, verbose = True ):
+		"""Translate identifiers 'names' of 'kind' to 'return_field' ( "all": whole documents ), looking them
+		up as 'input_type'. By default the field is detected: the first field of FIELDS that holds all names.
+		If none does (a mixed list), each name is looked up in the first field of FIELDS that holds it. Either
+		way a name that also matches other documents through another field (eg a number that is both a
+		row_id and a GI) is translated through the chosen field, with a warning. Names that are unknown or
+		match several documents in the field they are looked up in become None and are reported together"""
+		docs = self.documents( kind )
+		detected = input_type not in FIELDS[ kind ]
+		if detected:
+			input_type = self._detect( kind, names )
+		id_field = FIELDS[ kind ][ 0 ]
+		to_r = []
+		ambiguous = []
+		unknown = []
+		shadowed = []
+		for name in names:
+			if input_type is None:
+				positions = self._first_match( kind, name )
+			else:
+				positions = self.maps[ kind ][ input_type ].get( name, [] )
+			if detected and len( positions ) > 0 and len( self.lookups[ kind ].get( name, [] ) ) > len( positions ) and name not in shadowed:
+				shadowed.append( name )
+			if len( positions ) == 1:
+				doc = docs[ positions[ 0 ] ]
+				if return_field == "all":
+					to_r.append( doc )
+				else:
+					to_r.append( doc.get( return_field, doc[ id_field ] ) )
+				continue
+			reported = unknown if len( positions ) == 0 else ambiguous
+			if name not in reported:
+				reported.append( name )
+			to_r.append( None )
+		if len( ambiguous ) > 0:
+			print "ERROR: Multiple %ss match the %s name(s): %s" % ( kind, kind, ", ".join( [ str( i ) for i in ambiguous ] ) )
+			if verbose:
+				print [ self.match( kind, i ) for i in ambiguous ]
+		if len( unknown ) > 0:
+			print "ERROR: Cannot identify %s name(s): %s" % ( kind, ", ".join( [ str( i ) for i in unknown ] ) )
+		if len( shadowed ) > 0:
+			how = "as %s" % input_type if input_type is not None else "through the first of %s that holds each" % ", ".join( FIELDS[ kind ] )
+			print "WARNING: %s name(s) %s also match other %ss in another identifier field. Translated %s. Give 'input_type' to choose the field" % ( kind, ", ".join( [ str( i ) for i in shadowed ] ), kind, how )
+		return to_r
+
+class egrin2Session:
+
+	def __init__( self, host = "localhost", port = 27017, db = "", client = None, **kwargs ):
+		"""Session on database 'db'. 'kwargs' go to MongoClient (eg maxPoolSize). An existing 'client' is used as is"""
+		self.host = host
+		self.port = port
+		self.dbname = db
+		if client is None:
+			client = MongoClient( 'mongodb://'+host+':'+str(port)+'/', **kwargs )
+		self.client = client
+		self.db = client[ db ]
+		self.registry = idRegistry( self.db )
+		self.translations = translationCache( self.db, self.registry )
+		self.engine = None
+
+	def info( self, kind ):
+		return self.translations.info( kind )
+
+	def match( self, kind, name ):
+		return self.translations.match( kind, name )
+
+	def translate( self, kind, names, return_field, input_type = None, verbose = True ):
+		return self.translations.translate( kind, names, return_field, input_type, verbose )
+
+	def incidence( self ):
+		"""In-memory incidence matrices of the database (an incidenceEngine), built on first use"""
+		if self.engine is None:
+			self.engine = incidenceEngine( self.db )
+		return self.engine
+
+	def close( self ):
+		self.client.close()
+
+_sessions = {}
+
+def getSession( host = "localhost", port = 27017, db = "", session = None ):
+	"""'session' if given, otherwise the session of this process on host:port/db"""
+	if session is not None:
+		return session
+	key = ( os.getpid(), host, port, db )
+	if key not in _sessions:
+		_sessions[ key ] = egrin2Session( host, port, db )
+	return _sessions[ key ]
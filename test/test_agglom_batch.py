@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+"""
+agglomBatch must return, for each query set, what agglom( x, incidence = True ) returns for it
+(test_incidence checks that against the MongoDB queries). Uses the synthetic ensemble of test_incidence.
+
+python -m unittest test.test_agglom_batch
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "0.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import unittest
+
+import numpy as np
+
+try:
+	import mongomock
+except ImportError:
+	mongomock = None
+
+from query.session import egrin2Session
+from query.egrin2_query import agglom, agglomBatch
+from test.test_incidence import synthetic_db
+
+FIELDS = [ "counts", "all_counts", "pval", "qval_BH", "qval_bonferroni" ]
+
+@unittest.skipIf( mongomock is None, "mongomock is not installed" )
+class agglomBatchTest( unittest.TestCase ):
+
+	def setUp( self ):
+		self.client = mongomock.MongoClient()
+		self.db = synthetic_db( self.client )
+		self.session = egrin2Session( client = self.client, db = "egrin2_test" )
+		ids = [ i[ "_id" ] for i in self.db.bicluster_info.find( {}, { "_id": 1 } ) ]
+		self.queries = {
+		"rows": [ [ 1 ], [ 2, 5 ], [ 0, 3, 7 ], [ 4, 9 ], [ 1, 2, 3, 4, 5, 6 ] ],
+		"columns": [ [ 0 ], [ 1, 4 ], [ 2, 3, 5 ] ],
+		"gre": [ [ 1 ], [ 2, 3 ], [ 1, 2, 3 ] ],
+		"bicluster": [ ids[ :1 ], ids[ 3:6 ] ]
+		}
+
+	def assertSameAsAgglom( self, batch, sets, kwargs, msg ):
+		y_type = batch.columns[ 1 ]
+		for name, x in sets:
+			expected = agglom( x, incidence = True, **kwargs )
+			found = batch.loc[ batch[ "query" ] == name, : ].set_index( y_type )
+			m = "%s, set %s" % ( msg, name )
+			if expected is None or expected.shape[ 0 ] == 0:
+				self.assertEqual( found.shape[ 0 ], 0, m )
+				continue
+			expected = expected.sort_index()
+			found = found.sort_index()
+			self.assertEqual( found.index.tolist(), expected.index.tolist(), m )
+			for i in FIELDS:
+				self.assertTrue( np.allclose( found[ i ].values.astype( float ), expected[ i ].values.astype( float ) ), "%s: %s" % ( m, i ) )
+
+	def test_agglomBatch( self ):
+		input_types = { "rows": "row_id", "columns": "col_id" }
+		for x_type in self.queries:
+			for y_type in [ "rows", "columns", "gre" ]:
+				if x_type == "gre" and y_type == "gre":
+					continue
+				for logic in [ "or", "and", "nor" ]:
+					kwargs = dict( x_type = x_type, y_type = y_type, logic = logic, x_input_type = input_types.get( x_type ), pval_cutoff = 1.1, gre_lim = 0, session = self.session )
+					sets = self.queries[ x_type ]
+					# two sets per sparse product, so results of several chunks are concatenated
+					batch = agglomBatch( sets, chunk_size = 2, **kwargs )
+					self.assertEqual( batch.columns.tolist()[ :2 ], [ "query", "gre_id" if y_type == "gre" else y_type ] )
+					self.assertSameAsAgglom( batch, list( enumerate( sets ) ), kwargs, "%s -> %s, %s" % ( x_type, y_type, logic ) )
+
+	def test_names_and_cutoffs( self ):
+		sets = dict( [ ( "set%i" % i, x ) for i, x in enumerate( self.queries[ "rows" ] ) ] )
+		for y_type, translate in [ ( "rows", True ), ( "columns", True ), ( "gre", False ) ]:
+			kwargs = dict( x_type = "rows", y_type = y_type, x_input_type = "row_id", pval_cutoff = 0.5, gre_lim = 5, translate = translate, session = self.session )
+			batch = agglomBatch( sets, **kwargs )
+			self.assertTrue( ( batch.pval <= 0.5 ).all() )
+			self.assertSameAsAgglom( batch, sets.items(), kwargs, "rows -> %s" % y_type )
+
+if __name__ == '__main__':
+	unittest.main()
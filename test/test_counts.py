@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+Materialized bicluster counts (assemble/counts.py) must equal the counts taken directly from the
+documents, as the map_reduce counts of agglom did: after update_counts, after remove_run, and through
+the on-the-fly aggregation get_counts falls back to while the counts are out of date.
+
+python -m unittest test.test_counts
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "0.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import collections
+import unittest
+
+try:
+	import mongomock
+except ImportError:
+	mongomock = None
+
+import assemble.counts as counts
+from assemble.counts import update_counts, remove_run, get_counts, counts_current, counted_runs, COUNTS
+from test.test_incidence import synthetic_db
+
+def direct_counts( db, kind ):
+	"""key -> number of biclusters (motifs, for GREs) of the countable runs, counted document by document"""
+	runs = set( counts.countable_runs( db, kind ) )
+	c = collections.Counter()
+	if kind == "gre_id":
+		clusters = set( [ i[ "_id" ] for i in db.bicluster_info.find( { "run_id": { "$in": list( runs ) } } ) ] )
+		c.update( [ i[ "gre_id" ] for i in db.motif_info.find() if i[ "cluster_id" ] in clusters and i[ "gre_id" ] != "NaN" ] )
+	else:
+		for i in db.bicluster_info.find( { "run_id": { "$in": list( runs ) } } ):
+			c.update( i[ kind ] )
+	return dict( c )
+
+@unittest.skipIf( mongomock is None, "mongomock is not installed" )
+class countsTest( unittest.TestCase ):
+
+	def setUp( self ):
+		self.db = synthetic_db( mongomock.MongoClient() )
+		self.UpdateOne = counts.UpdateOne
+		try:
+			self.db.probe.bulk_write( [ counts.UpdateOne( { "_id": 1 }, { "$inc": { "value": 1 } }, upsert = True ) ] )
+		except TypeError:
+			# mongomock does not take the UpdateOne of newer pymongo versions. use the pymongo 2.x bulk API
+			counts.UpdateOne = None
+		self.db.probe.drop()
+
+	def tearDown( self ):
+		counts.UpdateOne = self.UpdateOne
+
+	def stored( self, kind ):
+		return dict( [ ( i[ "_id" ], i[ "value" ] ) for i in self.db[ COUNTS[ kind ][ 0 ] ].find() if i[ "value" ] != 0 ] )
+
+	def assertCounts( self, current ):
+		for kind in COUNTS:
+			self.assertEqual( counts_current( self.db, kind ), current, kind )
+			expected = direct_counts( self.db, kind )
+			self.assertEqual( get_counts( self.db, kind ).value.to_dict(), expected, kind )
+			keys = sorted( expected.keys() )[ :3 ] + [ 1000 ]
+			self.assertEqual( get_counts( self.db, kind, keys ).value.to_dict(), dict( [ ( k, expected[ k ] ) for k in keys if k in expected ] ), kind )
+			if current:
+				self.assertEqual( self.stored( kind ), expected, kind )
+
+	def test_update_counts( self ):
+		# before any update, counts are aggregated on the fly
+		self.assertCounts( False )
+		update_counts( self.db, verbose = False )
+		self.assertCounts( True )
+		self.assertEqual( sorted( counted_runs( self.db, "rows" ) ), [ 0, 1, 2 ] )
+
+	def test_remove_run( self ):
+		update_counts( self.db, verbose = False )
+		cluster_ids = [ i[ "_id" ] for i in self.db.bicluster_info.find( { "run_id": 1 } ) ]
+		remove_run( self.db, 1 )
+		self.assertEqual( sorted( counted_runs( self.db, "rows" ) ), [ 0, 2 ] )
+		# as sql2mongoDB.rollback_run: the documents of the run go after its counts
+		self.db.motif_info.remove( { "cluster_id": { "$in": cluster_ids } } )
+		self.db.bicluster_info.remove( { "run_id": 1 } )
+		for kind in COUNTS:
+			self.assertEqual( self.stored( kind ), direct_counts( self.db, kind ), kind )
+		# fewer biclusters than counted at: out of date until the next update
+		self.assertCounts( False )
+		update_counts( self.db, verbose = False )
+		self.assertCounts( True )
+
+	def test_stale( self ):
+		update_counts( self.db, verbose = False )
+		stored = dict( [ ( kind, self.stored( kind ) ) for kind in COUNTS ] )
+		new = self.db.bicluster_info.insert( { "run_id": 3, "cluster": 100, "rows": [ 0, 1, 2 ], "columns": [ 5 ] } )
+		self.db.motif_info.insert( { "cluster_id": new, "motif_num": 1, "gre_id": 2 } )
+		# aggregated with the new run, stored counts untouched
+		self.assertCounts( False )
+		for kind in COUNTS:
+			self.assertEqual( self.stored( kind ), stored[ kind ], kind )
+		update_counts( self.db, verbose = False )
+		self.assertCounts( True )
+		# a run whose bicluster_info stage is incomplete is not counted
+		self.db.bicluster_info.insert( { "run_id": 4, "cluster": 101, "rows": [ 0 ], "columns": [ 0 ] } )
+		self.db.ingest_manifest.insert( { "run_name": "run_4", "run_id": 4, "stages": { "bicluster_info": { "complete": False } } } )
+		update_counts( self.db, verbose = False )
+		self.assertCounts( True )
+		self.assertEqual( sorted( counted_runs( self.db, "rows" ) ), [ 0, 1, 2, 3 ] )
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""
+genomeStore: sequences packed 4 bits per base in chunks must fetch back as stored, across chunk
+boundaries, for odd lengths and IUPAC codes, and legacy genome documents must read the same.
+
+python -m unittest test.test_genome
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "0.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import random
+import unittest
+
+try:
+	import mongomock
+except ImportError:
+	mongomock = None
+
+from bson.binary import Binary
+
+from assemble.genome import genomeStore, pack, unpack, reverse_complement
+
+def random_sequence( length, seed = 0 ):
+	"""Mostly ACGT, with IUPAC codes, gaps, lower case and letters that are stored as N"""
+	rng = random.Random( seed )
+	return "".join( [ rng.choice( "ACGTACGTACGTACGTNRYSWKMBDHV-acgtnxZ*" ) for i in range( length ) ] )
+
+def expected( sequence ):
+	return "".join( [ i if i in "ACGTNRYSWKMBDHV-" else "N" for i in sequence.upper() ] )
+
+@unittest.skipIf( mongomock is None, "mongomock is not installed" )
+class genomeTest( unittest.TestCase ):
+
+	def setUp( self ):
+		self.db = mongomock.MongoClient()[ "egrin2_test" ]
+		self.sequence = random_sequence( 1001 )
+		self.stored = expected( self.sequence )
+
+	def test_pack( self ):
+		for n in [ 0, 1, 2, 17 ]:
+			self.assertEqual( unpack( pack( self.sequence[ :n ] ), n ), self.stored[ :n ] )
+
+	def test_fetch( self ):
+		for chunk_size in [ 64, 7, 2000 ]:
+			genomeStore( self.db ).put( "7", self.sequence, chunk_size = chunk_size, NCBI_RefSeq = "NC_000913" )
+			# a small cache, so chunks are read again
+			g = genomeStore( self.db, cache_chunks = 3 )
+			self.assertEqual( g.length( "7" ), 1001 )
+			self.assertEqual( g.fetch( "7" ), self.stored )
+			self.assertEqual( g.fetch( "NC_000913" ), self.stored )
+			for start in [ 1, chunk_size - 1, chunk_size, chunk_size + 1, 2 * chunk_size, 995 ]:
+				for stop in [ start, start + 1, start + chunk_size, start + 3 * chunk_size + 1, 1001 ]:
+					msg = "chunk_size %i, %i..%i" % ( chunk_size, start, stop )
+					self.assertEqual( g.fetch( "7", start, stop ), self.stored[ start - 1:stop ], msg )
+					self.assertEqual( g.fetch( "7", start, stop, "-" ), reverse_complement( self.stored[ start - 1:stop ] ), msg )
+			# clipped to the chromosome
+			self.assertEqual( g.fetch( "7", -5, 3 ), self.stored[ :3 ] )
+			self.assertEqual( g.fetch( "7", 999, 2000 ), self.stored[ 998: ] )
+			self.assertEqual( g.fetch( "7", 10, 9 ), "" )
+			self.assertTrue( g.verify( "7" ) )
+			self.assertEqual( self.db.genome_chunks.find( { "scaffoldId": "7" } ).count(), ( 1001 + chunk_size - 1 ) // chunk_size )
+
+	def test_verify( self ):
+		genomeStore( self.db ).put( "7", self.sequence, chunk_size = 64 )
+		chunk = self.db.genome_chunks.find_one( { "scaffoldId": "7", "chunk": 3 } )
+		data = bytearray( chunk[ "data" ] )
+		data[ 0 ] = data[ 0 ] ^ 0x11
+		self.db.genome_chunks.update( { "_id": chunk[ "_id" ] }, { "$set": { "data": Binary( str( data ) ) } } )
+		self.assertFalse( genomeStore( self.db ).verify( "7" ) )
+
+	def test_legacy( self ):
+		self.db.genome.insert( { "scaffoldId": "9", "NCBI_RefSeq": "NC_000914", "sequence": self.sequence } )
+		g = genomeStore( self.db )
+		self.assertEqual( g.length( "NC_000914" ), 1001 )
+		self.assertEqual( g.fetch( "9" ), self.stored )
+		self.assertEqual( g.fetch( "9", 100, 350, "-" ), reverse_complement( self.stored[ 99:350 ] ) )
+		self.assertTrue( g.verify( "9" ) )
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+agglom and coremFinder answered from the in-memory incidence matrices ( incidence = True ) must
+return what the MongoDB queries return. Runs against a small synthetic ensemble in mongomock.
+
+python -m unittest test.test_incidence
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "0.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import random
+import unittest
+
+import numpy as np
+
+try:
+	import mongomock
+except ImportError:
+	mongomock = None
+
+from assemble.registry import bump_version
+from query.session import egrin2Session
+from query.egrin2_query import agglom, coremFinder
+
+N_ROWS = 30
+N_COLS = 12
+
+def synthetic_db( client, seed = 0 ):
+	"""Random ensemble: 60 biclusters, motifs with 3 GREs (and NaN), 8 corems. Corem col_ids are floats, as
+	makeCorems.finishCorems writes them"""
+	rng = random.Random( seed )
+	db = client[ "egrin2_test" ]
+	db.row_info.insert( [ { "row_id": i, "egrin2_row_name": "g%i" % i } for i in range( N_ROWS ) ] )
+	db.col_info.insert( [ { "col_id": i, "egrin2_col_name": "c%i" % i } for i in range( N_COLS ) ] )
+	biclusters = [ { "run_id": i % 3, "cluster": i, "rows": rng.sample( range( N_ROWS ), rng.randint( 3, 10 ) ), "columns": rng.sample( range( N_COLS ), rng.randint( 2, 6 ) ) } for i in range( 60 ) ]
+	db.bicluster_info.insert( biclusters )
+	ids = [ i[ "_id" ] for i in db.bicluster_info.find( {}, { "_id": 1 } ) ]
+	db.motif_info.insert( [ { "cluster_id": ids[ i / 2 ], "motif_num": i % 2 + 1, "gre_id": rng.choice( [ 1, 2, 3, "NaN" ] ) } for i in range( 80 ) ] )
+	corems = []
+	for i in range( 8 ):
+		rows = sorted( rng.sample( range( N_ROWS ), 4 ) )
+		corems.append( { "corem_id": i + 1, "rows": rows, "edges": [ "%i-%i" % ( rows[ 0 ], j ) for j in rows[ 1: ] ], "cols": [ { "col_id": float( j ), "pval": 0.01 } for j in rng.sample( range( N_COLS ), 3 ) ] } )
+	db.corem.insert( corems )
+	return db
+
+@unittest.skipIf( mongomock is None, "mongomock is not installed" )
+class incidenceTest( unittest.TestCase ):
+
+	def setUp( self ):
+		self.client = mongomock.MongoClient()
+		self.db = synthetic_db( self.client )
+		self.session = egrin2Session( client = self.client, db = "egrin2_test" )
+		self.ids = [ i[ "_id" ] for i in self.db.bicluster_info.find( {}, { "_id": 1 } ) ]
+
+	def assertSameResult( self, a, b, msg ):
+		if a is None or b is None:
+			self.assertTrue( a is None and b is None, msg )
+		elif "_id" in a.columns:
+			self.assertEqual( sorted( a._id.tolist() ), sorted( b._id.tolist() ), msg )
+		else:
+			a = a.sort_index()
+			b = b.sort_index()
+			self.assertEqual( a.index.tolist(), b.index.tolist(), msg )
+			self.assertEqual( a.columns.tolist(), b.columns.tolist(), msg )
+			self.assertTrue( np.allclose( a.values.astype( float ), b.values.astype( float ), equal_nan = True ), msg )
+
+	def test_agglom( self ):
+		queries = {
+		"rows": [ [ 1 ], [ 2, 5 ], [ 0, 3, 7 ] ],
+		"columns": [ [ 0 ], [ 1, 4 ] ],
+		"gre": [ [ 1 ], [ 2, 3 ] ],
+		"bicluster": [ self.ids[ :1 ], self.ids[ 3:6 ] ]
+		}
+		input_types = { "rows": "row_id", "columns": "col_id" }
+		for x_type in queries:
+			for y_type in [ "rows", "columns", "gre", "bicluster" ]:
+				if x_type == "gre" and y_type == "gre":
+					continue
+				for logic in [ "or", "and", "nor" ]:
+					for x in queries[ x_type ]:
+						kwargs = dict( x_type = x_type, y_type = y_type, logic = logic, x_input_type = input_types.get( x_type ), pval_cutoff = 1.1, translate = False, gre_lim = 0, session = self.session )
+						try:
+							a = agglom( x, **kwargs )
+						except ( KeyError, AttributeError ):
+							# the MongoDB path fails on some queries that match nothing
+							a = None
+						b = agglom( x, incidence = True, **kwargs )
+						self.assertSameResult( a, b, "%s -> %s, %s %s" % ( x_type, y_type, logic, x ) )
+
+	def test_coremFinder( self ):
+		corem = self.db.corem.find_one()
+		queries = [ ( [ 1 ], "corem_id", "genes", "or" ), ( [ 1, 2 ], "corem_id", "genes", "or" ), ( [ 1 ], "corem_id", "conditions", "or" ), ( [ 2, 3 ], "corem_id", "conditions", "or" ), ( [ 2, 3 ], "corem_id", "conditions", "and" ), ( corem[ "rows" ][ :1 ], "rows", "corem_id", "or" ), ( corem[ "rows" ][ :2 ], "rows", "corem_id", "and" ), ( corem[ "rows" ][ :2 ], "rows", "genes", "or" ), ( corem[ "edges" ][ :1 ], "edges", "corem_id", "or" ) ]
+		for x, x_type, y_type, logic in queries:
+			kwargs = dict( x_type = x_type, y_type = y_type, logic = logic, x_input_type = "row_id", session = self.session )
+			self.assertEqual( coremFinder( x, **kwargs ), coremFinder( x, incidence = True, **kwargs ), "%s -> %s, %s %s" % ( x_type, y_type, logic, x ) )
+
+	def test_corems_updated_in_place( self ):
+		kwargs = dict( x_type = "corem_id", y_type = "conditions", session = self.session )
+		coremFinder( [ 1 ], incidence = True, **kwargs )
+		# as makeCorems.finishCorems: new cols, same number of corems
+		self.db.corem.update( { "corem_id": 1 }, { "$set": { "cols": [ { "col_id": float( N_COLS - 1 ), "pval": 0.001 } ] } } )
+		bump_version( self.db, "corem" )
+		self.assertEqual( coremFinder( [ 1 ], incidence = True, **kwargs ), [ "c%i" % ( N_COLS - 1 ) ] )
+		self.assertEqual( coremFinder( [ 1 ], incidence = True, **kwargs ), coremFinder( [ 1 ], **kwargs ) )
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+load_ratios and its binary sidecar (.npy + .names.json): what it loads must equal pd.read_csv of the
+ratios file, and a changed ratios file must be parsed again.
+
+python -m unittest test.test_ratios
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "0.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from assemble.ratios import load_ratios, sidecar_files
+
+def random_ratios( seed = 0, n_rows = 20, n_cols = 6 ):
+	rng = np.random.RandomState( seed )
+	return pd.DataFrame( rng.randn( n_rows, n_cols ), index = [ "b%04d" % i for i in range( n_rows ) ], columns = [ "cond_%i" % i for i in range( n_cols ) ] )
+
+def memory_mapped( a ):
+	while a is not None:
+		if isinstance( a, np.memmap ):
+			return True
+		a = getattr( a, "base", None )
+	return False
+
+class ratiosTest( unittest.TestCase ):
+
+	def setUp( self ):
+		self.dir = tempfile.mkdtemp()
+
+	def tearDown( self ):
+		shutil.rmtree( self.dir )
+
+	def write( self, name, ratios, sep = "\t", gzipped = False ):
+		f = os.path.join( self.dir, name )
+		text = ratios.to_csv( sep = sep )
+		with ( gzip.open( f, 'wb' ) if gzipped else open( f, 'wb' ) ) as out:
+			out.write( text )
+		return f
+
+	def assertSameRatios( self, a, f, sep ):
+		b = pd.read_csv( f, index_col = 0, sep = sep )
+		self.assertEqual( a.index.tolist(), b.index.tolist() )
+		self.assertEqual( a.columns.tolist(), b.columns.tolist() )
+		self.assertTrue( np.array_equal( np.asarray( a.values ), b.values ) )
+
+	def test_tab_gzipped( self ):
+		f = self.write( "ratios.tsv.gz", random_ratios(), gzipped = True )
+		first = load_ratios( f )
+		npy_file, names_file = sidecar_files( f )
+		self.assertTrue( os.path.isfile( npy_file ) and os.path.isfile( names_file ) )
+		self.assertSameRatios( first, f, "\t" )
+		second = load_ratios( f )
+		self.assertSameRatios( second, f, "\t" )
+		# read from the sidecar, as a copy-on-write memory map
+		self.assertTrue( memory_mapped( second.values ) )
+		second.iloc[ 0, 0 ] = 1e6
+		self.assertSameRatios( load_ratios( f ), f, "\t" )
+
+	def test_comma( self ):
+		f = self.write( "ratios.csv", random_ratios( 1 ), sep = "," )
+		self.assertSameRatios( load_ratios( f ), f, "," )
+		self.assertSameRatios( load_ratios( f ), f, "," )
+
+	def test_changed_file( self ):
+		f = self.write( "ratios.tsv", random_ratios( 2 ) )
+		load_ratios( f )
+		npy_file, names_file = sidecar_files( f )
+		with open( names_file ) as info:
+			md5 = json.load( info )[ "md5" ]
+		# new values, same size, another mtime
+		changed = random_ratios( 2 )
+		changed.iloc[ :, 0 ] = changed.iloc[ :, 1 ].values
+		f = self.write( "ratios.tsv", changed )
+		os.utime( f, ( 0, 1e9 ) )
+		ratios = load_ratios( f )
+		self.assertSameRatios( ratios, f, "\t" )
+		with open( names_file ) as info:
+			info = json.load( info )
+		self.assertNotEqual( info[ "md5" ], md5 )
+		self.assertEqual( info[ "mtime" ], os.stat( f ).st_mtime )
+		self.assertSameRatios( load_ratios( f ), f, "\t" )
+
+	def test_touched_file( self ):
+		f = self.write( "ratios.tsv", random_ratios( 3 ) )
+		load_ratios( f )
+		npy_file, names_file = sidecar_files( f )
+		os.utime( f, ( 0, 1e9 ) )
+		os.utime( npy_file, ( 0, 1e8 ) )
+		ratios = load_ratios( f )
+		self.assertSameRatios( ratios, f, "\t" )
+		# same contents: the sidecar is kept, only its mtime record is updated
+		self.assertEqual( os.stat( npy_file ).st_mtime, 1e8 )
+		with open( names_file ) as info:
+			self.assertEqual( json.load( info )[ "mtime" ], 1e9 )
+
+	def test_dtype( self ):
+		f = self.write( "ratios.tsv", random_ratios( 4 ) )
+		self.assertEqual( load_ratios( f, dtype = np.float32 ).values.dtype, np.float32 )
+		self.assertEqual( load_ratios( f, dtype = np.float32 ).values.dtype, np.float32 )
+
+if __name__ == '__main__':
+	unittest.main()
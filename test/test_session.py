@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""
+Row and col name translation of a session (translationCache): detection of the identifier field,
+numeric names that are both row_ids and GIs, mixed lists and names shared across fields.
+
+python -m unittest test.test_session
+"""
+
+__author__ = "Aaron Brooks"
+__copyright__ = "Copyright 2014, cMonkey2"
+__credits__ = ["Aaron Brooks"]
+__license__ = "GPL"
+__version__ = "0.0.1"
+__maintainer__ = "Aaron Brooks"
+__email__ = "brooksan@uw.edu"
+__status__ = "Development"
+
+import sys
+import unittest
+from StringIO import StringIO
+
+try:
+	import mongomock
+except ImportError:
+	mongomock = None
+
+from query.session import egrin2Session
+from query.egrin2_query import row2id, row2id_batch, col2id_batch
+
+ROWS = [
+	{ "row_id": 0, "egrin2_row_name": "b0001", "GI": 5, "accession": "NP_1", "name": "thrL", "sysName": "b0001" },
+	{ "row_id": 5, "egrin2_row_name": "b0005", "GI": 100, "accession": "NP_5", "name": "yaaX", "sysName": "b0005" },
+	# its name is the egrin2_row_name of row 5
+	{ "row_id": 7, "egrin2_row_name": "b0007", "GI": 101, "accession": "NP_7", "name": "b0005", "sysName": "b0007" },
+	{ "row_id": 8, "egrin2_row_name": "b0008", "GI": 102, "accession": "NP_8", "name": "dup", "sysName": "b0008" },
+	{ "row_id": 9, "egrin2_row_name": "b0009", "GI": 103, "accession": "NP_9", "name": "dup", "sysName": "b0009" }
+]
+
+@unittest.skipIf( mongomock is None, "mongomock is not installed" )
+class translationTest( unittest.TestCase ):
+
+	def setUp( self ):
+		client = mongomock.MongoClient()
+		client[ "egrin2_test" ].row_info.insert( [ dict( i ) for i in ROWS ] )
+		client[ "egrin2_test" ].col_info.insert( [ { "col_id": 0, "egrin2_col_name": "heat" }, { "col_id": 1, "egrin2_col_name": "cold" } ] )
+		self.session = egrin2Session( client = client, db = "egrin2_test" )
+
+	def translate( self, f, *args, **kwargs ):
+		"""Result of f and what it printed"""
+		stdout = sys.stdout
+		sys.stdout = StringIO()
+		try:
+			result = f( *args, session = self.session, **kwargs )
+			printed = sys.stdout.getvalue()
+		finally:
+			sys.stdout = stdout
+		return result, printed
+
+	def test_detect( self ):
+		t = self.session.translations
+		self.assertEqual( t.detect( "row", [ 0, 5 ] ), "row_id" )
+		self.assertEqual( t.detect( "row", [ 5, 100 ] ), "GI" )
+		self.assertEqual( t.detect( "row", [ "b0001", "b0005" ] ), "egrin2_row_name" )
+		self.assertEqual( t.detect( "row", [ "thrL", "NP_5" ] ), None )
+		self.assertEqual( t.detect( "row", [ "unknown" ] ), None )
+
+	def test_numeric( self ):
+		# 5 is the row_id of b0005 and the GI of b0001. row_id is preferred, with a warning
+		result, printed = self.translate( row2id_batch, [ 5, 0 ], return_field = "egrin2_row_name" )
+		self.assertEqual( result, [ "b0005", "b0001" ] )
+		self.assertTrue( "WARNING" in printed and "5" in printed )
+		# with 100 in the list only GI holds all names
+		result, printed = self.translate( row2id_batch, [ 5, 100 ], return_field = "egrin2_row_name" )
+		self.assertEqual( result, [ "b0001", "b0005" ] )
+		self.assertTrue( "WARNING" in printed )
+		# an explicit input_type is used as is
+		result, printed = self.translate( row2id_batch, [ 5 ], return_field = "egrin2_row_name", input_type = "GI" )
+		self.assertEqual( result, [ "b0001" ] )
+		self.assertEqual( printed, "" )
+		result, printed = self.translate( row2id, 5, return_field = "egrin2_row_name" )
+		self.assertEqual( result, "b0005" )
+		self.assertTrue( "WARNING" in printed )
+
+	def test_mixed( self ):
+		# no field holds all names: each is looked up in the first field that holds it
+		result, printed = self.translate( row2id_batch, [ "thrL", "b0005", "NP_7", "b0001" ] )
+		self.assertEqual( result, [ 0, 5, 7, 0 ] )
+		# b0005 is also the name of row 7. b0001 is the egrin2_row_name and sysName of the same row
+		self.assertTrue( "WARNING" in printed and "b0005" in printed )
+		self.assertFalse( "b0001" in printed )
+		self.assertFalse( "ERROR" in printed )
+		result, printed = self.translate( row2id_batch, [ "b0005" ], input_type = "name" )
+		self.assertEqual( result, [ 7 ] )
+
+	def test_ambiguous_and_unknown( self ):
+		result, printed = self.translate( row2id_batch, [ "dup", "thrL", "nope" ] )
+		self.assertEqual( result, [ None, 0, None ] )
+		self.assertTrue( "Multiple rows match" in printed and "dup" in printed )
+		self.assertTrue( "Cannot identify" in printed and "nope" in printed )
+		result, printed = self.translate( row2id_batch, [ "dup" ], return_field = "all", verbose = False )
+		self.assertEqual( result, [ None ] )
+
+	def test_cols( self ):
+		result, printed = self.translate( col2id_batch, [ "cold", "heat" ] )
+		self.assertEqual( result, [ 1, 0 ] )
+		result, printed = self.translate( col2id_batch, [ 1, "heat" ], return_field = "egrin2_col_name" )
+		self.assertEqual( result, [ "cold", "heat" ] )
+		self.assertEqual( printed, "" )
+
+if __name__ == '__main__':
+	unittest.main()